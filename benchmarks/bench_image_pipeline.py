@@ -0,0 +1,130 @@
+# bench_image_pipeline.py - Compara el pipeline de imagen anterior (doble decodificación)
+# con ImageUpload (cabecera única + draft + una sola decodificación).
+#
+# Uso:
+#   python benchmarks/bench_image_pipeline.py [carpeta_con_fotos] [--repeat N]
+#
+# Sin carpeta se genera un corpus sintético de fotos tipo teléfono (4032x3024 JPEG).
+# Cada variante corre en un proceso hijo para medir su pico de memoria (VmHWM).
+import argparse
+import io
+import os
+import random
+import resource
+import sys
+import time
+from multiprocessing import get_context
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFilter
+
+
+def legacy_pipeline(image_content):
+    """Ruta anterior: validate_image abre la imagen y analyze_image_with_gemini la vuelve a abrir y reduce"""
+    image = Image.open(io.BytesIO(image_content))
+    if image.size[0] < 10 or image.size[1] < 10 or image.format not in ['JPEG', 'PNG', 'WEBP']:
+        return None
+    image = Image.open(io.BytesIO(image_content))
+    max_size = (1024, 1024)
+    if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
+        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def new_pipeline(image_content):
+    import webapp
+    upload = webapp.open_image_upload(image_content)
+    if upload is None or not upload.is_valid():
+        return None
+    return upload.prepared()
+
+
+def synthetic_corpus(count=6, size=(4032, 3024)):
+    rng = random.Random(42)
+    corpus = []
+    for _ in range(count):
+        image = Image.new('RGB', size, tuple(rng.randint(0, 255) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(60):
+            x, y = rng.randint(0, size[0]), rng.randint(0, size[1])
+            r = rng.randint(50, 600)
+            draw.ellipse([x - r, y - r, x + r, y + r], fill=tuple(rng.randint(0, 255) for _ in range(3)))
+        image = image.filter(ImageFilter.GaussianBlur(2))
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=92)
+        corpus.append(buffer.getvalue())
+    return corpus
+
+
+def load_corpus(folder):
+    corpus = []
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
+            with open(os.path.join(folder, name), 'rb') as f:
+                corpus.append(f.read())
+    return corpus
+
+
+def peak_rss_kb():
+    """Pico de RSS del proceso actual; VmHWM no hereda el pico del padre como ru_maxrss"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_variant(name, corpus, repeat):
+    if name == 'new':
+        import webapp  # noqa: F401 - importar fuera de la medición
+    pipeline = new_pipeline if name == 'new' else legacy_pipeline
+    baseline_rss = peak_rss_kb()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(repeat):
+        for image_content in corpus:
+            pipeline(image_content)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    peak_rss = peak_rss_kb()
+    return {
+        'cpu_ms_per_image': cpu * 1000 / (repeat * len(corpus)),
+        'wall_ms_per_image': wall * 1000 / (repeat * len(corpus)),
+        'peak_rss_mb': peak_rss / 1024,
+        'peak_rss_delta_mb': (peak_rss - baseline_rss) / 1024
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del pipeline de imagen')
+    parser.add_argument('corpus', nargs='?', help='Carpeta con fotos (JPEG/PNG/WEBP)')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus()
+    if not corpus:
+        sys.exit('Corpus vacío')
+    total_mb = sum(len(c) for c in corpus) / (1024 * 1024)
+    print(f"Corpus: {len(corpus)} imágenes, {total_mb:.1f} MB, repeat={args.repeat}")
+
+    ctx = get_context('spawn')
+    results = {}
+    for name in ('legacy', 'new'):
+        with ctx.Pool(1) as pool:
+            results[name] = pool.apply(run_variant, (name, corpus, args.repeat))
+
+    print(f"{'variante':<10}{'cpu ms/img':>12}{'wall ms/img':>13}{'pico RSS MB':>13}{'delta RSS MB':>14}")
+    for name, r in results.items():
+        print(f"{name:<10}{r['cpu_ms_per_image']:>12.1f}{r['wall_ms_per_image']:>13.1f}{r['peak_rss_mb']:>13.1f}{r['peak_rss_delta_mb']:>14.1f}")
+    speedup = results['legacy']['cpu_ms_per_image'] / max(results['new']['cpu_ms_per_image'], 1e-9)
+    print(f"CPU: {speedup:.1f}x más rápido")
+
+
+if __name__ == '__main__':
+    main()
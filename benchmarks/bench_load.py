@@ -0,0 +1,344 @@
+# bench_load.py - Prueba de carga de extremo a extremo sin consumir cuota de APIs pagas.
+#
+# Levanta mock_upstreams (SerpAPI, Gemini, identity-toolkit) y la app en un proceso aparte
+# (servidor de desarrollo con threads o gunicorn), y usuarios virtuales concurrentes que hacen
+# /auth/login y luego /api/search (texto e imagen) y /results. Reporta p50/p95/p99, throughput y RSS.
+#
+# Uso:
+#   python benchmarks/bench_load.py [--concurrency 8] [--duration 20] [--server gunicorn --workers 2 --threads 8]
+#                                   [--mix search=6,image=1,results=3] [--json actual.json] [--baseline base.json]
+#
+# Para comparar un cambio: correr con --json base.json en el commit anterior (o --app-dir a otro checkout)
+# y luego con --baseline base.json.
+import argparse
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_upstreams import MockUpstreams, UpstreamConfig
+
+QUERY_WORDS = (
+    ['wireless', 'bluetooth', 'cheap', 'black', 'stainless', 'portable', 'organic', 'kids', 'large', 'smart'],
+    ['headphones', 'coffee maker', 'running shoes', 'desk lamp', 'backpack', 'water bottle', 'blender', 'keyboard']
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_tree_rss_kb(pid):
+    """RSS del proceso y sus descendientes (workers de gunicorn) según /proc; None fuera de Linux"""
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+                        break
+            for task in os.listdir(f'/proc/{current}/task'):
+                try:
+                    with open(f'/proc/{current}/task/{task}/children') as f:
+                        pending.extend(int(child) for child in f.read().split())
+                except OSError:
+                    pass
+    except OSError:
+        return None if total == 0 else total
+    return total
+
+
+def sample_images(count=3):
+    """JPEGs sintéticos de ~1600x1200; sin Pillow no hay búsquedas por imagen"""
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        return []
+    rng = random.Random(3)
+    images = []
+    for _ in range(count):
+        image = Image.new('RGB', (1600, 1200), tuple(rng.randint(0, 255) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(25):
+            x, y, r = rng.randint(0, 1600), rng.randint(0, 1200), rng.randint(40, 300)
+            draw.ellipse([x - r, y - r, x + r, y + r], fill=tuple(rng.randint(0, 255) for _ in range(3)))
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=88)
+        images.append(buffer.getvalue())
+    return images
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))]
+
+
+def start_app(args, env):
+    port = free_port()
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '--threads', str(args.threads),
+                   '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'webapp:app']
+    else:
+        command = [sys.executable, '-c', f"import webapp; webapp.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    log = open(os.path.join(env['BENCH_TMP'], 'app.log'), 'wb')
+    process = subprocess.Popen(command, cwd=os.path.abspath(args.app_dir), env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"La app terminó al iniciar (ver {log.name})")
+        try:
+            if requests.get(f'{base_url}/api/health', timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    process.kill()
+    sys.exit(f"La app no respondió en {args.startup_timeout}s (ver {log.name})")
+
+
+class LoadDriver:
+    def __init__(self, base_url, args, images):
+        self.base_url = base_url
+        self.args = args
+        self.images = images
+        self.samples = []  # (operación, segundos, ok, t_fin)
+        self._lock = threading.Lock()
+        rng = random.Random(11)
+        self.queries = [f'{rng.choice(QUERY_WORDS[0])} {rng.choice(QUERY_WORDS[1])}' for _ in range(args.queries)]
+        mix = dict(item.split('=') for item in args.mix.split(','))
+        self.operations = [op for op in ('search', 'image', 'results') if float(mix.get(op, 0)) > 0 and (op != 'image' or images)]
+        self.weights = [float(mix[op]) for op in self.operations]
+
+    def record(self, operation, started, ok):
+        finished = time.perf_counter()
+        with self._lock:
+            self.samples.append((operation, finished - started, ok, finished))
+
+    def user(self, index, stop_at):
+        rng = random.Random(index)
+        http = requests.Session()
+        started = time.perf_counter()
+        try:
+            response = http.post(f'{self.base_url}/auth/login', data={'email': f'user{index}@bench.local', 'password': 'x'},
+                                 allow_redirects=False, timeout=30)
+            ok = response.status_code == 302 and 'session' in http.cookies
+        except requests.RequestException:
+            ok = False
+        self.record('login', started, ok)
+        if not ok:
+            return
+        last_search_id = None
+        while time.perf_counter() < stop_at:
+            operation = rng.choices(self.operations, self.weights)[0]
+            if operation == 'results' and not last_search_id:
+                # Sin búsqueda previa no hay enlace que abrir
+                operation = 'search'
+            started = time.perf_counter()
+            try:
+                if operation == 'search':
+                    response = http.post(f'{self.base_url}/api/search', data={'query': rng.choice(self.queries)}, timeout=30)
+                elif operation == 'image':
+                    files = {'image_file': ('foto.jpg', rng.choice(self.images), 'image/jpeg')}
+                    response = http.post(f'{self.base_url}/api/search', files=files, timeout=30)
+                else:
+                    # Enlace compartible en una conexión nueva (como quien lo recibe): con varios workers lo puede
+                    # atender uno distinto al que buscó. Un 302 es la redirección "No hay busquedas recientes": error
+                    response = requests.get(f'{self.base_url}/results', params={'id': last_search_id}, cookies=http.cookies,
+                                            allow_redirects=False, timeout=30)
+                ok = response.status_code == 200
+                if ok and operation != 'results':
+                    last_search_id = response.json().get('search_id') or last_search_id
+            except (requests.RequestException, ValueError):
+                ok = False
+            self.record(operation, started, ok)
+
+    def run(self):
+        start = time.perf_counter()
+        stop_at = start + self.args.warmup + self.args.duration
+        threads = [threading.Thread(target=self.user, args=(i, stop_at), daemon=True) for i in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return start + self.args.warmup, stop_at
+
+
+def summarize(samples, measure_from, measure_to):
+    report = {}
+    window = max(1e-9, measure_to - measure_from)
+    by_operation = {}
+    for operation, seconds, ok, finished in samples:
+        # login se mide siempre; el resto solo fuera del calentamiento
+        if operation != 'login' and finished < measure_from:
+            continue
+        by_operation.setdefault(operation, []).append((seconds, ok))
+    for operation, values in sorted(by_operation.items()):
+        latencies = [seconds * 1000 for seconds, _ in values]
+        report[operation] = {
+            'count': len(values),
+            'errors': sum(1 for _, ok in values if not ok),
+            'rps': round(len(values) / window, 2) if operation != 'login' else None,
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'max_ms': round(max(latencies), 1)
+        }
+    measured = sum(v['count'] for op, v in report.items() if op != 'login')
+    report['total'] = {'count': measured, 'rps': round(measured / window, 2)}
+    return report
+
+
+def check_image_path(result):
+    """Advertencia si hubo búsquedas por imagen pero ninguna llegó a Gemini (p. ej. sin google-generativeai en la app)"""
+    image = result['operations'].get('image')
+    if image and image['count'] and not result['upstream_calls'].get('gemini'):
+        return ("Las búsquedas por imagen no llamaron a Gemini (0 llamadas al mock): la fila 'image' mide la ruta "
+                "de respaldo de texto/ejemplos, no la búsqueda por imagen. ¿Falta google-generativeai en el entorno de la app?")
+    return None
+
+
+def print_report(result, baseline=None):
+    print(f"\n{'operación':<10}{'n':>7}{'err':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for operation, row in result['operations'].items():
+        if operation == 'total':
+            continue
+        rps = '-' if row['rps'] is None else f"{row['rps']:.1f}"
+        print(f"{operation:<10}{row['count']:>7}{row['errors']:>6}{rps:>9}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+    total = result['operations']['total']
+    print(f"\nThroughput: {total['rps']:.1f} req/s ({total['count']} peticiones medidas)")
+    if result['rss_peak_mb'] is not None:
+        print(f"RSS de la app: pico {result['rss_peak_mb']:.1f} MB, final {result['rss_final_mb']:.1f} MB")
+    print(f"Llamadas a upstreams: {result['upstream_calls']}")
+    for warning in result.get('warnings', []):
+        print(f"\n⚠️  {warning}")
+    if baseline:
+        print("\nComparación con la línea base (negativo = mejor en latencia):")
+        for operation, row in result['operations'].items():
+            base = baseline['operations'].get(operation)
+            if not base or operation == 'total':
+                continue
+            deltas = '  '.join(f"{key} {(row[key] - base[key]) / base[key] * 100:+.1f}%" for key in ('p50_ms', 'p95_ms', 'p99_ms') if base[key])
+            print(f"  {operation:<10}{deltas}")
+        base_total = baseline['operations']['total']['rps']
+        if base_total:
+            print(f"  throughput {(total['rps'] - base_total) / base_total * 100:+.1f}%")
+        if result['rss_peak_mb'] and baseline.get('rss_peak_mb'):
+            print(f"  RSS pico {(result['rss_peak_mb'] - baseline['rss_peak_mb']) / baseline['rss_peak_mb'] * 100:+.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga con upstreams simulados')
+    parser.add_argument('--app-dir', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument('--server', choices=('dev', 'gunicorn'), default='dev')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help='Segundos medidos')
+    parser.add_argument('--warmup', type=float, default=3, help='Segundos iniciales descartados')
+    parser.add_argument('--mix', default='search=6,image=1,results=3', help='Pesos por operación')
+    parser.add_argument('--queries', type=int, default=40, help='Consultas de texto distintas (controla el hit rate)')
+    parser.add_argument('--serp-latency-ms', type=float, default=300)
+    parser.add_argument('--serp-jitter-ms', type=float, default=100)
+    parser.add_argument('--serp-error-rate', type=float, default=0.0)
+    parser.add_argument('--gemini-latency-ms', type=float, default=900)
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+    parser.add_argument('--env', action='append', default=[], metavar='CLAVE=VALOR', help='Variables extra para la app')
+    parser.add_argument('--startup-timeout', type=float, default=30)
+    parser.add_argument('--json', help='Guardar resultados en este archivo')
+    parser.add_argument('--baseline', help='Comparar con un resultado guardado con --json')
+    args = parser.parse_args()
+
+    mock = MockUpstreams(
+        serpapi=UpstreamConfig(args.serp_latency_ms, args.serp_jitter_ms, args.serp_error_rate),
+        gemini=UpstreamConfig(args.gemini_latency_ms, args.gemini_latency_ms / 3, args.gemini_error_rate)
+    ).start()
+
+    tmp = tempfile.mkdtemp(prefix='pricefinder-bench-')
+    env = dict(os.environ)
+    env.update(mock.environment())
+    env.update({
+        'BENCH_TMP': tmp,
+        'SECRET_KEY': 'bench-secret',
+        'SERPAPI_QPS': '1000',
+        'SERPAPI_BURST': '1000',
+        'PRICE_HISTORY_PATH': os.path.join(tmp, 'history.sqlite3'),
+        # Los *_PATH solo se usan con el backend sqlite: fijarlo explícitamente (se puede cambiar con --env)
+        'SEARCH_CACHE_BACKEND': 'sqlite',
+        'SEARCH_CACHE_PATH': os.path.join(tmp, 'cache.sqlite3'),
+        'RESULT_STORE_BACKEND': 'sqlite',
+        'RESULT_STORE_PATH': os.path.join(tmp, 'results.sqlite3'),
+        'PYTHONUNBUFFERED': '1'
+    })
+    env.update(item.split('=', 1) for item in args.env)
+
+    images = sample_images()
+    process, base_url = start_app(args, env)
+    rss_samples = []
+    stop_sampling = threading.Event()
+
+    def sample_rss():
+        while not stop_sampling.wait(0.5):
+            rss = process_tree_rss_kb(process.pid)
+            if rss:
+                rss_samples.append(rss)
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    print(f"App en {base_url} ({args.server}), mocks en {mock.url}, {args.concurrency} usuarios, "
+          f"{args.warmup:.0f}s calentamiento + {args.duration:.0f}s medidos")
+    try:
+        driver = LoadDriver(base_url, args, images)
+        measure_from, measure_to = driver.run()
+    finally:
+        stop_sampling.set()
+        sampler.join()
+        final_rss = process_tree_rss_kb(process.pid)
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        mock.stop()
+
+    result = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('json', 'baseline')},
+        'operations': summarize(driver.samples, measure_from, measure_to),
+        'rss_peak_mb': round(max(rss_samples) / 1024, 1) if rss_samples else None,
+        'rss_final_mb': round(final_rss / 1024, 1) if final_rss else None,
+        'upstream_calls': dict(mock.calls)
+    }
+    image_warning = check_image_path(result)
+    result['warnings'] = [image_warning] if image_warning else []
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+        print(f"\nResultados guardados en {args.json}")
+    if image_warning:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
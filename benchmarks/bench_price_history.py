@@ -0,0 +1,86 @@
+# bench_price_history.py - Latencia de PriceHistoryStore.summary con una tabla grande.
+#
+# Llena un SQLite temporal con --rows observaciones repartidas entre --queries consultas a lo largo de
+# --days días y mide summary() de una consulta (30 días, con y sin filtro de tienda) frente a la ruta
+# anterior (traer todos los precios a Python y calcular con price_summary).
+#
+# Uso:
+#   python benchmarks/bench_price_history.py [--rows 2000000] [--queries 2000] [--repeat 50]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STORES = ['amazon', 'walmart', 'target', 'best buy', 'ebay', 'newegg']
+
+
+def populate(store, rows, queries, days, seed=7):
+    rng = random.Random(seed)
+    now = int(time.time())
+    conn = store._connect()
+    conn.execute('BEGIN')
+    batch = []
+    for i in range(rows):
+        query = i % queries
+        batch.append((f'search_q{query}', STORES[i % len(STORES)], f'https://example.com/p/{query}/{i % 40}',
+                      round(20 + query % 300 + rng.gauss(0, 5), 2) or 1.0, now - rng.randint(0, days * 86400)))
+        if len(batch) >= 50000:
+            conn.executemany('INSERT INTO price_observations VALUES (?, ?, ?, ?, ?)', batch)
+            batch = []
+    conn.executemany('INSERT INTO price_observations VALUES (?, ?, ?, ?, ?)', batch)
+    conn.execute('COMMIT')
+    conn.execute('ANALYZE')
+
+
+def legacy_summary(store, webapp, query_key, since, until, store_name=None):
+    """Ruta anterior: todas las filas a Python y price_summary"""
+    sql = 'SELECT price FROM price_observations WHERE query_key = ?'
+    params = [query_key]
+    if store_name:
+        sql += ' AND store = ?'
+        params.append(store_name)
+    sql += ' AND observed_at BETWEEN ? AND ?'
+    params.extend([since, until])
+    return webapp.price_summary([row[0] for row in store._connect().execute(sql, params)]) or {'count': 0}
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) * 1000 / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del historial de precios')
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault('PRICE_HISTORY_ENABLED', '0')
+    import webapp
+
+    path = os.path.join(tempfile.mkdtemp(prefix='pricefinder-history-'), 'history.sqlite3')
+    store = webapp.PriceHistoryStore(path)
+    started = time.perf_counter()
+    populate(store, args.rows, args.queries, args.days)
+    print(f"{args.rows} filas ({args.rows // args.queries} por consulta) en {time.perf_counter() - started:.1f} s")
+
+    until = int(time.time())
+    since = until - 30 * 86400
+    print(f"{'consulta':<24}{'filas':>8}{'summary ms':>12}{'anterior ms':>13}")
+    for label, store_name in (('30 días', None), ('30 días, una tienda', 'walmart')):
+        new_ms, new = timed(lambda: store.summary('search_q7', since, until, store=store_name), args.repeat)
+        old_ms, old = timed(lambda: legacy_summary(store, webapp, 'search_q7', since, until, store_name), args.repeat)
+        assert new == old, (new, old)
+        print(f"{label:<24}{new['count']:>8}{new_ms:>12.3f}{old_ms:>13.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# bench_products.py - Memoria por resultado en cache y costo de serialización de /api/search:
+# dicts de texto (representación anterior) frente a Product.
+#
+# Uso:
+#   python benchmarks/bench_products.py [--results N] [--repeat N]
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def legacy_product(i):
+    """Dict tal como lo construía _process_results"""
+    price = 19.99 + i * 3.5
+    return {
+        'title': f'Wireless Headphones Model {i} - Noise Cancelling',
+        'price': f'${price:.2f}',
+        'price_numeric': price,
+        'source': ['Amazon', 'Walmart', 'Target'][i % 3],
+        'link': f'https://www.example.com/product/{i}?ref=shopping',
+        'rating': str(4.0 + (i % 10) / 10),
+        'reviews': str(100 + i * 17),
+        'image': '',
+        'search_source': 'text',
+        'original_query': 'wireless headphones'
+    }
+
+
+def build_results(factory, count):
+    return [[factory(r * 6 + i) for i in range(6)] for r in range(count)]
+
+
+def memory_per_result(factory, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    results = build_results(factory, count)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return (after - before) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de la representación de productos')
+    parser.add_argument('--results', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    import webapp
+
+    def new_product(i):
+        return webapp.Product.from_dict(legacy_product(i))
+
+    print(f"{'variante':<10}{'bytes/resultado':>17}{'us/respuesta':>14}")
+    with webapp.app.app_context():
+        for name, factory, encode in (
+            ('dict', legacy_product, lambda payload: webapp.jsonify(payload).get_data()),
+            ('Product', new_product, lambda payload: webapp.json_response(payload).get_data()),
+        ):
+            memory = memory_per_result(factory, args.results)
+            products = [factory(i) for i in range(6)]
+            payload = {'success': True, 'products': products, 'total': len(products), 'search_id': 'abcdefghijkl'}
+            assert json.loads(encode(payload))['products'] == [legacy_product(i) for i in range(6)]
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                encode(payload)
+            elapsed = (time.perf_counter() - start) * 1e6 / args.repeat
+            print(f"{name:<10}{memory:>17.0f}{elapsed:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
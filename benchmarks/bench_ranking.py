@@ -0,0 +1,86 @@
+# bench_ranking.py - Compara el ranking anterior (sort por precio + min/avg en bucles)
+# con rank_products (puntaje compuesto, descarte de atípicos y percentiles en una pasada).
+#
+# Uso:
+#   python benchmarks/bench_ranking.py [--candidates N] [--repeat N]
+#
+# Mide la versión de Python puro, la de NumPy (si está instalado) y la selección automática
+# por NUMPY_MIN_CANDIDATES sobre los mismos candidatos.
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def legacy_rank(products):
+    """Ruta anterior: _fetch_and_cache ordena con lambda y compute_price_stats recorre los precios"""
+    ranked = sorted(products, key=lambda x: x['price_numeric'])[:6]
+    prices = [p.get('price_numeric', 0) for p in products if p.get('price_numeric', 0) > 0]
+    stats = {'min_price': round(min(prices), 2), 'avg_price': round(sum(prices) / len(prices), 2), 'count': len(prices)}
+    return ranked, stats
+
+
+def synthetic_candidates(count, seed=42):
+    rng = random.Random(seed)
+    stores = ['Amazon', 'Walmart', 'Target', 'Best Buy', 'eBay', 'Newegg', 'Tienda Local']
+    products = []
+    for i in range(count):
+        price = rng.lognormvariate(3.5, 0.4)
+        if rng.random() < 0.03:
+            price *= rng.choice([0.05, 20])  # accesorios y lotes que distorsionan el precio
+        products.append({
+            'title': f'Producto {i}',
+            'price': f'${price:.2f}',
+            'price_numeric': price,
+            'source': rng.choice(stores),
+            'link': f'https://example.com/p/{i}',
+            'rating': str(round(rng.uniform(2.5, 5), 1)) if rng.random() < 0.8 else '',
+            'reviews': f'{rng.randint(0, 20000):,}' if rng.random() < 0.8 else '',
+            'image': ''
+        })
+    return products
+
+
+def measure(fn, products, repeat):
+    fn(products)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(products)
+    return (time.perf_counter() - start) * 1e6 / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del ranking de resultados')
+    parser.add_argument('--candidates', type=int, nargs='+', default=[18, 100, 500, 2000])
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    import webapp
+
+    def forced(numpy_available, min_candidates):
+        """rank_products forzando una implementación"""
+        def rank(products):
+            saved = webapp.NUMPY_AVAILABLE, webapp.NUMPY_MIN_CANDIDATES
+            webapp.NUMPY_AVAILABLE, webapp.NUMPY_MIN_CANDIDATES = numpy_available, min_candidates
+            try:
+                return webapp.rank_products(products)
+            finally:
+                webapp.NUMPY_AVAILABLE, webapp.NUMPY_MIN_CANDIDATES = saved
+        return rank
+
+    variants = [('legacy', legacy_rank), ('python', forced(False, 0))]
+    if webapp.NUMPY_AVAILABLE:
+        variants += [('numpy', forced(True, 0)), ('auto', webapp.rank_products)]
+
+    print(f"{'candidatos':<12}" + ''.join(f"{name + ' us':>14}" for name, _ in variants))
+    for count in args.candidates:
+        products = synthetic_candidates(count)
+        row = [measure(fn, products, args.repeat) for _, fn in variants]
+        print(f"{count:<12}" + ''.join(f"{value:>14.1f}" for value in row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# bench_render.py - CPU por petición de /search y /results con el cliente de pruebas de Flask.
+#
+# Uso:
+#   python benchmarks/bench_render.py [--requests N] [--app-dir RUTA]
+#
+# --app-dir permite medir otra copia de webapp.py (p. ej. un checkout anterior) para comparar.
+import argparse
+import os
+import sys
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de renderizado de páginas')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--app-dir', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.app_dir))
+    import webapp
+
+    client = webapp.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 'bench-user'
+        session['user_name'] = 'Benchmark'
+        session['user_email'] = 'bench@example.com'
+    client.post('/api/search', data={'query': 'wireless headphones'})
+
+    print(f"{'ruta':<10}{'cpu ms/req':>12}{'bytes':>10}")
+    for path in ('/search', '/results'):
+        response = client.get(path)  # calentamiento: compila la plantilla si aplica
+        cpu_start = time.process_time()
+        for _ in range(args.requests):
+            response = client.get(path)
+        cpu = time.process_time() - cpu_start
+        print(f"{path:<10}{cpu * 1000 / args.requests:>12.3f}{len(response.data):>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# bench_session_middleware.py - Costo por petición del middleware de sesión.
+#
+# Mide CPU por petición y cuántas respuestas reenvían Set-Cookie en /api/health (ruta exenta)
+# y en /search (ruta con sesión), con una sesión de usuario iniciada.
+#
+# Uso:
+#   python benchmarks/bench_session_middleware.py [--requests N] [--app-dir RUTA]
+#
+# --app-dir permite medir otra copia de webapp.py (p. ej. un checkout anterior) para comparar.
+import argparse
+import os
+import sys
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del middleware de sesión')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--app-dir', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.app_dir))
+    import webapp
+
+    client = webapp.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 'bench-user'
+        session['user_name'] = 'Benchmark'
+        session['user_email'] = 'bench@example.com'
+        session['id_token'] = 'x' * 900  # tamaño típico de un ID token de Firebase
+        session.permanent = True
+
+    print(f"{'ruta':<14}{'cpu us/req':>12}{'Set-Cookie':>12}")
+    for path in ('/api/health', '/search'):
+        client.get(path)
+        set_cookie = 0
+        cpu_start = time.process_time()
+        for _ in range(args.requests):
+            response = client.get(path)
+            if 'Set-Cookie' in response.headers:
+                set_cookie += 1
+        cpu = time.process_time() - cpu_start
+        print(f"{path:<14}{cpu * 1e6 / args.requests:>12.1f}{set_cookie / args.requests:>11.0%}")
+
+
+if __name__ == '__main__':
+    main()
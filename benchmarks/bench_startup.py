@@ -0,0 +1,130 @@
+# bench_startup.py - Tiempo de arranque de un worker: import de webapp y latencia de la primera petición.
+#
+# Cada repetición corre en un intérprete nuevo (como un worker recién creado) contra mock_upstreams sin
+# latencia, así que solo se mide el costo local: imports, construcción de clientes y primeras compilaciones.
+# Variantes:
+#   lazy   SDKs (PIL, Gemini, NumPy) importados en el primer uso (por defecto)
+#   eager  PRELOAD_HEAVY_MODULES=1: los importa al cargar el módulo (lo que hace el master con --preload)
+#
+# Uso:
+#   python benchmarks/bench_startup.py [--runs 5] [--variants lazy,eager] [--app-dir OTRO_CHECKOUT]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_upstreams import MockUpstreams, UpstreamConfig
+
+CHILD_SCRIPT = r'''
+import io, json, sys, time
+started = time.perf_counter()
+import webapp
+import_ms = (time.perf_counter() - started) * 1000
+heavy = [name for name in ('PIL.Image', 'google.generativeai', 'numpy') if name in sys.modules]
+
+def rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    except (OSError, StopIteration):
+        return None
+
+rss_after_import = rss_kb()
+client = webapp.app.test_client()
+with client.session_transaction() as s:
+    s['user_id'] = 'bench'
+    s['user_email'] = 'bench@example.com'
+    s['login_time'] = int(time.time())
+
+def timed(fn):
+    t = time.perf_counter()
+    response = fn()
+    assert response.status_code == 200, response.status_code
+    return (time.perf_counter() - t) * 1000
+
+from PIL import Image as PILImage
+buf = io.BytesIO()
+PILImage.new('RGB', (640, 480), (200, 40, 40)).save(buf, 'JPEG')
+
+result = {
+    'import_ms': import_ms,
+    'heavy_modules_at_import': heavy,
+    'rss_after_import_kb': rss_after_import,
+    'health_ms': timed(lambda: client.get('/api/health')),
+    'text_search_ms': timed(lambda: client.post('/api/search', data={'query': 'wireless headphones'})),
+    'image_search_ms': timed(lambda: client.post('/api/search', data={'image_file': (io.BytesIO(buf.getvalue()), 'photo.jpg')},
+                                                 content_type='multipart/form-data')),
+    'rss_after_requests_kb': rss_kb()
+}
+print('BENCH_RESULT ' + json.dumps(result))
+'''
+
+METRICS = ('import_ms', 'health_ms', 'text_search_ms', 'image_search_ms', 'rss_after_import_kb', 'rss_after_requests_kb')
+
+
+def run_child(app_dir, env):
+    completed = subprocess.run([sys.executable, '-c', CHILD_SCRIPT], cwd=app_dir, env=env,
+                               capture_output=True, text=True, timeout=120)
+    for line in completed.stdout.splitlines():
+        if line.startswith('BENCH_RESULT '):
+            return json.loads(line[len('BENCH_RESULT '):])
+    raise RuntimeError(f"El proceso de prueba falló:\n{completed.stdout[-2000:]}\n{completed.stderr[-2000:]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de arranque de workers')
+    parser.add_argument('--app-dir', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--variants', default='lazy,eager')
+    parser.add_argument('--json', help='Guardar resultados en este archivo')
+    args = parser.parse_args()
+
+    mock = MockUpstreams(serpapi=UpstreamConfig(0, 0), gemini=UpstreamConfig(0, 0), firebase=UpstreamConfig(0, 0)).start()
+    tmp = tempfile.mkdtemp(prefix='pricefinder-startup-')
+    base_env = dict(os.environ)
+    base_env.update(mock.environment())
+    base_env.update({
+        'SECRET_KEY': 'bench-secret',
+        'PRICE_HISTORY_ENABLED': '0',
+        'RESULT_STORE_PATH': os.path.join(tmp, 'results.sqlite3')
+    })
+    variants = {
+        'lazy': {'PRELOAD_HEAVY_MODULES': '0'},
+        'eager': {'PRELOAD_HEAVY_MODULES': '1'}
+    }
+
+    # Una corrida descartada para que el bytecode (.pyc) y la cache del SO no sesguen la primera variante
+    run_child(args.app_dir, base_env)
+
+    report = {}
+    try:
+        for name in [v.strip() for v in args.variants.split(',') if v.strip()]:
+            env = dict(base_env, **variants[name])
+            runs = [run_child(args.app_dir, env) for _ in range(args.runs)]
+            report[name] = {metric: statistics.median(r[metric] for r in runs if r[metric] is not None)
+                            for metric in METRICS if any(r[metric] is not None for r in runs)}
+            report[name]['heavy_modules_at_import'] = runs[0]['heavy_modules_at_import']
+    finally:
+        mock.stop()
+
+    print(f"Mediana de {args.runs} intérpretes nuevos por variante (upstreams sin latencia)")
+    print(f"{'variante':<8}{'import ms':>11}{'health ms':>11}{'texto ms':>10}{'imagen ms':>11}{'RSS import MB':>15}{'RSS final MB':>14}")
+    for name, values in report.items():
+        rss_import = values.get('rss_after_import_kb', 0) / 1024
+        rss_final = values.get('rss_after_requests_kb', 0) / 1024
+        print(f"{name:<8}{values['import_ms']:>11.0f}{values['health_ms']:>11.1f}{values['text_search_ms']:>10.1f}"
+              f"{values['image_search_ms']:>11.1f}{rss_import:>15.1f}{rss_final:>14.1f}")
+        print(f"{'':<8}cargados al importar: {', '.join(values['heavy_modules_at_import']) or 'ninguno'}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
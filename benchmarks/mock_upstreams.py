@@ -0,0 +1,191 @@
+# mock_upstreams.py - Stand-in local de SerpAPI, Gemini e identity-toolkit de Firebase para pruebas de carga.
+#
+# Rutas:
+#   GET  /search                                   SerpAPI: repite payloads grabados (fixtures/serpapi_shopping.json)
+#   POST /v1beta/models/<modelo>:generateContent   Gemini (transporte REST): consulta fija de producto
+#   POST /identitytoolkit/v1/accounts:signInWithPassword   Firebase: acepta cualquier correo/contraseña
+#   GET  /__stats                                  llamadas recibidas por ruta
+#
+# Uso independiente:
+#   python benchmarks/mock_upstreams.py [--port 8090] [--latency-ms 300] [--jitter-ms 100] [--error-rate 0.02]
+#
+# Variables para la app: SERPAPI_BASE_URL=http://HOST:PORT/search, GEMINI_API_ENDPOINT=http://HOST:PORT,
+# FIREBASE_AUTH_URL=http://HOST:PORT/identitytoolkit/v1 (ver mock_environment()).
+import argparse
+import base64
+import json
+import os
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'serpapi_shopping.json')
+
+
+class UpstreamConfig:
+    """Latencia (media + jitter uniforme) y tasa de errores 5xx por servicio"""
+    def __init__(self, latency_ms=300, jitter_ms=100, error_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+    def delay(self, rng):
+        return max(0.0, self.latency_ms + rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000.0
+
+
+class MockUpstreams:
+    def __init__(self, host='127.0.0.1', port=0, serpapi=None, gemini=None, firebase=None, fixtures_path=FIXTURES_PATH, seed=1):
+        with open(fixtures_path, encoding='utf-8') as f:
+            self.payloads = json.load(f)
+        self.config = {
+            'serpapi': serpapi or UpstreamConfig(300, 100),
+            'gemini': gemini or UpstreamConfig(900, 300),
+            'firebase': firebase or UpstreamConfig(120, 40)
+        }
+        self.calls = {'serpapi': 0, 'gemini': 0, 'firebase': 0, 'errors': 0}
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def environment(self):
+        """Variables de entorno que apuntan la app a este stand-in"""
+        return {
+            'SERPAPI_KEY': 'bench-serpapi-key',
+            'SERPAPI_BASE_URL': f'{self.url}/search',
+            'GEMINI_API_KEY': 'bench-gemini-key',
+            'GEMINI_API_ENDPOINT': self.url,
+            'FIREBASE_WEB_API_KEY': 'bench-firebase-key',
+            'FIREBASE_AUTH_URL': f'{self.url}/identitytoolkit/v1'
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='mock-upstreams', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _simulate(self, service):
+        """Aplica la latencia configurada; devuelve True si esta llamada debe fallar"""
+        config = self.config[service]
+        with self._lock:
+            self.calls[service] += 1
+            delay = config.delay(self._rng)
+            failed = self._rng.random() < config.error_rate
+            if failed:
+                self.calls['errors'] += 1
+        time.sleep(delay)
+        return failed
+
+    def serpapi_payload(self, query):
+        """Payload grabado elegido por la consulta, con títulos marcados para distinguir consultas"""
+        payload = self.payloads[sum(query.encode('utf-8')) % len(self.payloads)]
+        results = [dict(item, title=f"{item['title']} ({query[:30]})") for item in payload['shopping_results']]
+        return dict(payload, search_parameters=dict(payload['search_parameters'], q=query), shopping_results=results)
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                if parsed.path == '/__stats':
+                    with mock._lock:
+                        return self._send(200, dict(mock.calls))
+                if parsed.path != '/search':
+                    return self._send(404, {'error': 'not found'})
+                query = parse_qs(parsed.query).get('q', [''])[0]
+                if mock._simulate('serpapi'):
+                    return self._send(503, {'error': 'Simulated upstream error'})
+                self._send(200, mock.serpapi_payload(query))
+
+            def do_POST(self):
+                parsed = urlparse(self.path)
+                body = self._read_body()
+                if parsed.path.endswith(':generateContent'):
+                    if mock._simulate('gemini'):
+                        return self._send(503, {'error': {'code': 503, 'message': 'Simulated overload', 'status': 'UNAVAILABLE'}})
+                    # Consulta estable por imagen: la misma foto produce la misma consulta
+                    seed = sum(body[-4096:]) if body else 0
+                    query = ['wireless headphones black', 'drip coffee maker 12 cup', 'mens running shoes size 10'][seed % 3]
+                    return self._send(200, {
+                        'candidates': [{'content': {'parts': [{'text': f'"{query}"'}], 'role': 'model'}, 'finishReason': 'STOP', 'index': 0}],
+                        'usageMetadata': {'promptTokenCount': 300, 'candidatesTokenCount': 8, 'totalTokenCount': 308}
+                    })
+                if parsed.path.endswith('/accounts:signInWithPassword'):
+                    if mock._simulate('firebase'):
+                        return self._send(503, {'error': {'code': 503, 'message': 'UNAVAILABLE'}})
+                    try:
+                        email = json.loads(body or b'{}').get('email', 'bench@example.com')
+                    except ValueError:
+                        return self._send(400, {'error': {'code': 400, 'message': 'INVALID_JSON'}})
+                    local_id = base64.urlsafe_b64encode(email.encode('utf-8')).decode('ascii').rstrip('=')[:28]
+                    return self._send(200, {
+                        'kind': 'identitytoolkit#VerifyPasswordResponse',
+                        'localId': local_id,
+                        'email': email,
+                        'displayName': email.split('@')[0],
+                        'idToken': 'bench.' + 'x' * 900,
+                        'registered': True,
+                        'refreshToken': 'bench-refresh',
+                        'expiresIn': '3600'
+                    })
+                self._send(404, {'error': 'not found'})
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in local de SerpAPI, Gemini y Firebase')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-ms', type=float, default=300, help='Latencia media de SerpAPI')
+    parser.add_argument('--jitter-ms', type=float, default=100)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fracción de respuestas 503 de SerpAPI')
+    parser.add_argument('--gemini-latency-ms', type=float, default=900)
+    args = parser.parse_args()
+
+    mock = MockUpstreams(
+        args.host, args.port,
+        serpapi=UpstreamConfig(args.latency_ms, args.jitter_ms, args.error_rate),
+        gemini=UpstreamConfig(args.gemini_latency_ms, args.gemini_latency_ms / 3)
+    )
+    print(f"Mock upstreams en {mock.url}")
+    for key, value in mock.environment().items():
+        print(f"  {key}={value}")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+# Pruebas de FirebaseTokenVerifier con un par de claves local y un servidor JWKS de prueba.
+#
+# Uso:
+#   python -m unittest discover -s tests
+import base64
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import webapp
+
+try:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import rsa, padding
+    CRYPTOGRAPHY_AVAILABLE = True
+except ImportError:
+    CRYPTOGRAPHY_AVAILABLE = False
+
+PROJECT_ID = 'price-finder-test'
+
+
+def b64url(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def segment(obj):
+    return b64url(json.dumps(obj))
+
+
+class KeyServer:
+    """Servidor JWKS local: publica las claves públicas de `keys` (kid -> clave privada)"""
+    def __init__(self):
+        self.keys = {}
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests += 1
+                jwks = []
+                for kid, private_key in server.keys.items():
+                    numbers = private_key.public_key().public_numbers()
+                    jwks.append({
+                        'kty': 'RSA', 'alg': 'RS256', 'use': 'sig', 'kid': kid,
+                        'n': b64url(numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, 'big')),
+                        'e': b64url(numbers.e.to_bytes(3, 'big'))
+                    })
+                body = json.dumps({'keys': jwks}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Cache-Control', 'public, max-age=3600')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/jwks'
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@unittest.skipUnless(CRYPTOGRAPHY_AVAILABLE, 'requiere cryptography para firmar tokens de prueba')
+class FirebaseTokenVerifierTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        cls.other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        cls.server = KeyServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.server.keys = {'key-1': self.key}
+        self.server.requests = 0
+        self.now = time.time()
+        self.verifier = webapp.FirebaseTokenVerifier(PROJECT_ID, jwks_url=self.server.url, clock=lambda: self.now)
+
+    def claims(self, **overrides):
+        claims = {
+            'iss': f'https://securetoken.google.com/{PROJECT_ID}',
+            'aud': PROJECT_ID,
+            'sub': 'user-123',
+            'email': 'user@example.com',
+            'iat': int(self.now) - 10,
+            'auth_time': int(self.now) - 10,
+            'exp': int(self.now) + 3600
+        }
+        claims.update(overrides)
+        return claims
+
+    def token(self, claims=None, kid='key-1', key=None, alg='RS256'):
+        signing_input = f"{segment({'alg': alg, 'kid': kid, 'typ': 'JWT'})}.{segment(claims or self.claims())}"
+        signature = (key or self.key).sign(signing_input.encode('ascii'), padding.PKCS1v15(), hashes.SHA256())
+        return f'{signing_input}.{b64url(signature)}'
+
+    def test_valid_token(self):
+        claims = self.verifier.verify(self.token())
+        self.assertEqual(claims['sub'], 'user-123')
+        self.assertEqual(self.verifier.stats()['verified'], 1)
+
+    def test_valid_token_is_cached(self):
+        token = self.token()
+        self.verifier.verify(token)
+        self.assertIsNotNone(self.verifier.verify(token))
+        self.assertEqual(self.verifier.stats()['cache_hits'], 1)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_tampered_payload(self):
+        header, _, signature = self.token().split('.')
+        forged = f"{header}.{segment(self.claims(sub='admin'))}.{signature}"
+        self.assertIsNone(self.verifier.verify(forged))
+
+    def test_signed_with_unknown_key(self):
+        self.assertIsNone(self.verifier.verify(self.token(key=self.other_key)))
+
+    def test_wrong_audience(self):
+        self.assertIsNone(self.verifier.verify(self.token(self.claims(aud='another-project'))))
+
+    def test_wrong_issuer(self):
+        self.assertIsNone(self.verifier.verify(self.token(self.claims(iss='https://securetoken.google.com/another-project'))))
+
+    def test_expired(self):
+        self.assertIsNone(self.verifier.verify(self.token(self.claims(exp=int(self.now) - 3600))))
+
+    def test_cached_token_expires(self):
+        token = self.token(self.claims(exp=int(self.now) + 30))
+        self.assertIsNotNone(self.verifier.verify(token))
+        self.now += 3600
+        self.assertIsNone(self.verifier.verify(token))
+
+    def test_alg_none(self):
+        unsigned = f"{segment({'alg': 'none', 'kid': 'key-1'})}.{segment(self.claims())}."
+        self.assertIsNone(self.verifier.verify(unsigned))
+
+    def test_malformed_tokens_are_rejected(self):
+        for token in ('W10.e30.AA', 'e30.W10.AA', 'not-a-token', 'a.b.c.d', '!!.??.%%',
+                      f"{segment({'alg': 'RS256', 'kid': ['key-1']})}.{segment(self.claims())}.AA",
+                      f"{segment({'alg': 'RS256', 'kid': {'a': 1}})}.{segment(self.claims())}.AA",
+                      f"{segment({'alg': 'RS256', 'kid': 'key-1'})}.{segment(self.claims())}.AA"):
+            self.assertIsNone(self.verifier.verify(token), token)
+        self.assertEqual(self.verifier.stats()['rejected'], 8)
+
+    def test_key_rotation(self):
+        self.assertIsNotNone(self.verifier.verify(self.token()))
+        # Google publica una clave nueva: un kid desconocido fuerza una recarga (como mucho una por minuto)
+        self.server.keys = {'key-2': self.other_key}
+        rotated = self.token(kid='key-2', key=self.other_key)
+        self.assertIsNone(self.verifier.verify(rotated))
+        self.now += 61
+        self.assertIsNotNone(self.verifier.verify(rotated))
+        self.assertEqual(self.server.requests, 2)
+
+
+@unittest.skipUnless(CRYPTOGRAPHY_AVAILABLE, 'requiere cryptography para firmar tokens de prueba')
+class BearerTokenRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.verifier = webapp.firebase_auth.token_verifier
+        self.project_id = self.verifier.project_id
+        self.verifier.project_id = PROJECT_ID
+        self.client = webapp.app.test_client()
+
+    def tearDown(self):
+        self.verifier.project_id = self.project_id
+
+    def test_malformed_bearer_is_unauthorized(self):
+        for token in ('W10.e30.AA', f"{segment({'alg': 'RS256', 'kid': ['x']})}.e30.AA"):
+            response = self.client.post('/api/search', data={'query': 'lamp'}, headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.status_code, 401, token)
+
+
+if __name__ == '__main__':
+    unittest.main()
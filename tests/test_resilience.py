@@ -0,0 +1,309 @@
+# Pruebas de CircuitBreaker, Deadline, SingleFlight y TokenBucket, y del registro de fallos de upstreams.
+#
+# Uso:
+#   python -m unittest discover -s tests
+import os
+import sys
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import webapp
+from webapp import CircuitBreaker, Deadline, SingleFlight, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def skips(stage):
+    return webapp.DEADLINE_SKIPS._values.get((stage,), 0)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker('test', min_timeout=1.0, max_timeout=8.0, failure_threshold=3,
+                                      reset_timeout=30, clock=self.clock)
+
+    def fail(self, times):
+        for _ in range(times):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.fail(1)
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.stats()['short_circuited'], 1)
+        self.assertEqual(self.breaker.stats()['opened'], 1)
+
+    def test_success_resets_failure_count(self):
+        self.fail(2)
+        self.breaker.record_success(0.2)
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_allows_a_single_probe(self):
+        self.fail(3)
+        self.clock.now += 30
+        self.assertEqual(self.breaker.stats()['state'], CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open_probe_success_closes(self):
+        self.fail(3)
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success(0.2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_probe_failure_reopens(self):
+        self.fail(3)
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.stats()['opened'], 2)
+        # Vuelve a esperar reset_timeout completo desde la reapertura
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow())
+
+    def test_release_probe_lets_next_call_probe(self):
+        self.fail(3)
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        # La sonda no llegó a salir (rate limit, deadline): ni éxito ni fallo
+        self.breaker.release_probe()
+        self.assertEqual(self.breaker.stats()['state'], CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+
+    def test_timeout_uses_ceiling_until_enough_samples(self):
+        self.assertEqual(self.breaker.timeout(), 8.0)
+        self.assertEqual(self.breaker.timeout(5.0), 5.0)
+        self.assertEqual(self.breaker.timeout(20.0), 8.0)
+
+    def test_adaptive_timeout_follows_p99(self):
+        for _ in range(webapp.ADAPTIVE_TIMEOUT_MIN_SAMPLES):
+            self.breaker.record_success(0.9)
+        self.assertAlmostEqual(self.breaker.timeout(), 0.9 * webapp.ADAPTIVE_TIMEOUT_FACTOR)
+        for _ in range(webapp.ADAPTIVE_TIMEOUT_MIN_SAMPLES):
+            self.breaker.record_success(0.1)
+        # Acotado por abajo a min_timeout y por arriba al techo pedido
+        self.assertEqual(self.breaker.timeout(0.5), 0.5)
+        for _ in range(200):
+            self.breaker.record_success(0.05)
+        self.assertEqual(self.breaker.timeout(), 1.0)
+
+
+class RecordUpstreamFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('test', min_timeout=1.0, max_timeout=8.0, failure_threshold=2, clock=FakeClock())
+
+    def test_deadline_cut_timeout_is_not_a_failure(self):
+        before = skips('test_stage')
+        for _ in range(5):
+            self.assertTrue(self.breaker.allow())
+            webapp.record_upstream_failure(self.breaker, requests.exceptions.ReadTimeout(), 'test_stage', deadline_cut=True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.stats()['failures'], 0)
+        self.assertEqual(skips('test_stage') - before, 5)
+
+    def test_timeout_within_breaker_timeout_is_a_failure(self):
+        for _ in range(2):
+            webapp.record_upstream_failure(self.breaker, requests.exceptions.ReadTimeout(), 'test_stage', deadline_cut=False)
+        self.assertTrue(self.breaker.is_open)
+
+    def test_other_errors_count_even_when_deadline_cut(self):
+        for _ in range(2):
+            webapp.record_upstream_failure(self.breaker, ValueError('respuesta inválida'), 'test_stage', deadline_cut=True)
+        self.assertTrue(self.breaker.is_open)
+
+    def test_timeout_detection(self):
+        self.assertTrue(webapp.is_timeout_error(requests.exceptions.ReadTimeout()))
+        self.assertTrue(webapp.is_timeout_error(TimeoutError()))
+        self.assertTrue(webapp.is_timeout_error(type('DeadlineExceeded', (Exception,), {})()))
+        self.assertFalse(webapp.is_timeout_error(requests.exceptions.ConnectionError('refused')))
+        # requests con Retry en el adapter: MaxRetryError(reason=ReadTimeoutError) dentro de ConnectionError
+        wrapped = requests.exceptions.ConnectionError(type('MaxRetryError', (Exception,), {'reason': webapp.PoolTimeoutError()})())
+        self.assertTrue(webapp.is_timeout_error(wrapped))
+
+
+class SlowServer:
+    """Upstream sano que responde {} tras `delay` segundos"""
+    def __init__(self, delay):
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(delay)
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', '2')
+                    self.end_headers()
+                    self.wfile.write(b'{}')
+                except OSError:
+                    pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/search'
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class SerpApiDeadlineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = SlowServer(delay=1.0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.finder = webapp.price_finder
+        self.saved = (self.finder.api_key, self.finder.base_url, self.finder.breaker)
+        self.finder.api_key = 'test-key'
+        self.finder.base_url = self.server.url
+        self.finder.breaker = CircuitBreaker('serpapi-test', min_timeout=0.3, max_timeout=8.0, failure_threshold=3)
+
+    def tearDown(self):
+        self.finder.api_key, self.finder.base_url, self.finder.breaker = self.saved
+
+    def test_deadline_shortened_timeouts_keep_breaker_closed(self):
+        for _ in range(4):
+            self.assertIsNone(self.finder._make_api_request('google_shopping', 'lamp', deadline=Deadline(0.5)))
+        self.assertEqual(self.finder.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.finder.breaker.stats()['failures'], 0)
+
+    def test_breaker_timeouts_open_breaker(self):
+        self.finder.breaker.max_timeout = 0.3
+        for _ in range(3):
+            self.assertIsNone(self.finder._make_api_request('google_shopping', 'lamp', deadline=Deadline(5)))
+        self.assertTrue(self.finder.breaker.is_open)
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_timeout_respects_cap_and_reserve(self):
+        deadline = Deadline(10)
+        self.assertLessEqual(deadline.timeout(), 10)
+        self.assertEqual(deadline.timeout(cap=2), 2)
+        self.assertLessEqual(deadline.timeout(reserve=9), 1)
+        self.assertEqual(deadline.timeout(reserve=20), 0.0)
+
+    def test_child_never_exceeds_parent(self):
+        parent = Deadline(1)
+        self.assertLessEqual(parent.child(30).expires_at, parent.expires_at)
+        self.assertLess(parent.child(0.1).expires_at, parent.expires_at)
+
+    def test_skip_records_stage(self):
+        before = skips('test_skip')
+        self.assertFalse(Deadline(5).skip('test_skip', 1))
+        self.assertTrue(Deadline(0.5).skip('test_skip', 1))
+        self.assertTrue(Deadline(0).expired)
+        self.assertEqual(skips('test_skip') - before, 1)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'resultado'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('k', slow)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(flight.do('k', slow, timeout=5))) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        while flight.coalesced < 3:
+            time.sleep(0.01)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual(results, ['resultado'] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((flight.executions, flight.coalesced), (1, 3))
+
+    def test_error_is_shared_and_key_released(self):
+        flight = SingleFlight()
+        with self.assertRaises(ValueError):
+            flight.do('k', lambda: (_ for _ in ()).throw(ValueError('falló')))
+        self.assertEqual(flight.do('k', lambda: 'otra vez'), 'otra vez')
+        self.assertEqual(flight.errors, 1)
+
+    def test_follower_timeout(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        leader = threading.Thread(target=lambda: flight.do('k', lambda: release.wait(5)))
+        leader.start()
+        while not flight._calls:
+            time.sleep(0.01)
+        with self.assertRaises(TimeoutError):
+            flight.do('k', lambda: None, timeout=0.05)
+        release.set()
+        leader.join(5)
+        self.assertEqual(flight.timeouts, 1)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_reject(self):
+        bucket = TokenBucket(rate=1, burst=2)
+        self.assertTrue(bucket.acquire())
+        self.assertTrue(bucket.acquire())
+        self.assertFalse(bucket.acquire())
+        self.assertEqual(bucket.stats()['admitted'], 2)
+        self.assertEqual(bucket.stats()['rejected'], 1)
+
+    def test_queues_within_timeout(self):
+        bucket = TokenBucket(rate=20, burst=1)
+        self.assertTrue(bucket.acquire())
+        started = time.monotonic()
+        self.assertTrue(bucket.acquire(timeout=1))
+        self.assertGreaterEqual(time.monotonic() - started, 0.03)
+        self.assertEqual(bucket.stats()['queued'], 1)
+
+    def test_reservations_wait_in_order(self):
+        bucket = TokenBucket(rate=1, burst=1)
+        self.assertEqual(bucket._reserve(0), 0.0)
+        first = bucket._reserve(10)
+        second = bucket._reserve(10)
+        self.assertGreater(second, first)
+        self.assertIsNone(bucket._reserve(0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,52 +1,187 @@
 # webapp.py - Price Finder USA con Búsqueda por Imagen
-from flask import Flask, request, jsonify, session, redirect, url_for, render_template_string, flash
+from flask import Flask, Response, request, jsonify, session, redirect, url_for, render_template, flash, stream_with_context, g
+from flask.sessions import SecureCookieSessionInterface
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
+from jinja2 import DictLoader
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import TimeoutError as PoolTimeoutError
 import os
 import re
 import html
 import time
 import io
+import hashlib
+import threading
+import bisect
+import json
+import math
+import queue
+import uuid
+import secrets
+import base64
+import hmac
+import sqlite3
+import tempfile
+import unicodedata
+import importlib
+import importlib.util
+import gc
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from urllib.parse import urlparse, quote_plus
 from functools import wraps
 
-# Imports para búsqueda por imagen (opcionales)
-try:
-    from PIL import Image
-    PIL_AVAILABLE = True
+# ==============================================================================
+# IMPORTS DIFERIDOS (PIL, Gemini, NumPy)
+# ==============================================================================
+
+def module_available(name):
+    """True si el módulo está instalado, sin importarlo"""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+class LazyModule:
+    """Módulo que se importa en el primer acceso a un atributo, una sola vez aunque lo pidan varios threads.
+    
+    `setup(módulo)` (p. ej. configurar el cliente) corre una vez tras el import; si falla, el error se
+    conserva y se repite en los accesos siguientes sin reintentar.
+    """
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+        self._error = None
+        self._lock = threading.Lock()
+        self.load_seconds = None
+    
+    def load(self):
+        module = self._module
+        if module is not None:
+            return module
+        with self._lock:
+            if self._module is None:
+                if self._error is not None:
+                    raise self._error
+                started = time.perf_counter()
+                try:
+                    module = importlib.import_module(self._name)
+                    if self._setup:
+                        self._setup(module)
+                except Exception as e:
+                    self._error = e
+                    raise
+                self.load_seconds = time.perf_counter() - started
+                self._module = module
+            return self._module
+    
+    @property
+    def loaded(self):
+        return self._module is not None
+    
+    def reset_after_fork(self):
+        # Los clientes creados por setup (canales, sesiones) no se comparten con el proceso padre
+        self._lock = threading.Lock()
+        if self._setup:
+            self._module = None
+            self._error = None
+    
+    def stats(self):
+        return {
+            'loaded': self._module is not None,
+            'load_seconds': round(self.load_seconds, 4) if self.load_seconds is not None else None,
+            'error': str(self._error) if self._error else None
+        }
+    
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+# Imports para búsqueda por imagen (opcionales): se detectan sin importarlos y se cargan en el primer uso
+PIL_AVAILABLE = module_available('PIL')
+Image = LazyModule('PIL.Image') if PIL_AVAILABLE else None
+if PIL_AVAILABLE:
     print("✅ PIL (Pillow) disponible para procesamiento de imagen")
-except ImportError:
-    PIL_AVAILABLE = False
+else:
     print("⚠️ PIL (Pillow) no disponible - búsqueda por imagen limitada")
 
-try:
-    import google.generativeai as genai
-    from google.api_core import exceptions as google_exceptions
-    GEMINI_AVAILABLE = True
+GEMINI_AVAILABLE = module_available('google.generativeai')
+if GEMINI_AVAILABLE:
     print("✅ Google Generative AI (Gemini) disponible")
-except ImportError:
-    genai = None
-    google_exceptions = None
-    GEMINI_AVAILABLE = False
+else:
     print("⚠️ Google Generative AI no disponible - instalar con: pip install google-generativeai")
 
+# NumPy (opcional) para ranking vectorizado; sin él se usa la versión en Python puro
+NUMPY_AVAILABLE = module_available('numpy')
+np = LazyModule('numpy') if NUMPY_AVAILABLE else None
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'fallback-key-change-in-production')
 app.config['PERMANENT_SESSION_LIFETIME'] = 1800
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SECURE'] = True if os.environ.get('RENDER') else False
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+# Margen para los demás campos y las cabeceras multipart del formulario
+UPLOAD_FORM_OVERHEAD = 1024 * 1024
+# Werkzeug corta la lectura del cuerpo al pasar este límite (413), también con Transfer-Encoding: chunked,
+# antes de volcar la subida a disco; la validación por fragmentos de read_image_upload viene después
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD
+# La cookie se reescribe solo cuando cambia la sesión (ver before_request), no en cada respuesta
+app.config['SESSION_REFRESH_EACH_REQUEST'] = False
+
+SESSION_IDLE_TIMEOUT = 1200  # 20 minutos
+SESSION_TOUCH_INTERVAL = int(os.environ.get('SESSION_TOUCH_INTERVAL', 60))
+
+class ActivitySessionInterface(SecureCookieSessionInterface):
+    """Sesión en cookie firmada que ni se lee ni se escribe en rutas exentas (health, estáticos)"""
+    exempt_paths = {'/api/health', '/assets/app.css', '/metrics'}
+    
+    def open_session(self, app, request):
+        if request.path in self.exempt_paths:
+            return self.make_null_session(app)
+        return super().open_session(app, request)
+
+app.session_interface = ActivitySessionInterface()
+
+def session_epoch(value):
+    """Segundos epoch de un valor de sesión: entero o ISO de cookies anteriores"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str) and len(value) > 10:
+        try:
+            return int(datetime.fromisoformat(value).timestamp())
+        except ValueError:
+            return None
+    return None
 
 # Configuración de Gemini
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-if GEMINI_AVAILABLE and GEMINI_API_KEY:
+# GEMINI_API_ENDPOINT (p. ej. http://127.0.0.1:8090) usa transporte REST contra un endpoint alternativo
+GEMINI_API_ENDPOINT = os.environ.get('GEMINI_API_ENDPOINT')
+
+def configure_gemini(module):
+    """Configura el SDK de Gemini; corre una vez por proceso, en el primer análisis de imagen"""
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        print("✅ API de Google Gemini configurada correctamente")
-        GEMINI_READY = True
+        if GEMINI_API_ENDPOINT:
+            module.configure(api_key=GEMINI_API_KEY, transport='rest', client_options={'api_endpoint': GEMINI_API_ENDPOINT})
+        else:
+            module.configure(api_key=GEMINI_API_KEY)
     except Exception as e:
         print(f"❌ Error configurando Gemini: {e}")
-        GEMINI_READY = False
+        raise
+    print("✅ API de Google Gemini configurada correctamente")
+
+# google.generativeai tarda ~0.4 s en importarse: los workers que nunca analizan imágenes no lo cargan
+genai = LazyModule('google.generativeai', setup=configure_gemini) if GEMINI_AVAILABLE else None
+google_exceptions = LazyModule('google.api_core.exceptions') if GEMINI_AVAILABLE else None
+
+if GEMINI_AVAILABLE and GEMINI_API_KEY:
+    print("✅ Gemini habilitado (el SDK se carga en el primer análisis de imagen)")
+    GEMINI_READY = True
 elif GEMINI_AVAILABLE and not GEMINI_API_KEY:
     print("⚠️ Gemini disponible pero falta GEMINI_API_KEY en variables de entorno")
     GEMINI_READY = False
@@ -54,10 +189,527 @@ else:
     print("⚠️ Gemini no está disponible - búsqueda por imagen deshabilitada")
     GEMINI_READY = False
 
+# ==============================================================================
+# MÉTRICAS (formato de texto de Prometheus)
+# ==============================================================================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _label_text(names, values, extra=''):
+    pairs = [f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), chr(92) + "n")}"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """Contador con etiquetas; inc() solo toma un lock por llamada"""
+    kind = 'counter'
+    
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_label_text(self.labelnames, labels)} {value}' for labels, value in items]
+
+class Histogram:
+    """Histograma acumulativo con buckets fijos por combinación de etiquetas"""
+    kind = 'histogram'
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # etiquetas -> [conteos por bucket..., +Inf, suma]
+        self._lock = threading.Lock()
+    
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+    
+    def time(self, *labels):
+        return Span(self, labels)
+    
+    def render(self):
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        lines = []
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{_label_text(self.labelnames, labels, f"le={chr(34)}{le}{chr(34)}")} {cumulative}')
+            lines.append(f'{self.name}_sum{_label_text(self.labelnames, labels)} {series[-1]:.6f}')
+            lines.append(f'{self.name}_count{_label_text(self.labelnames, labels)} {cumulative}')
+        return lines
+
+class Gauge:
+    """Valor calculado al momento del scrape (p. ej. hit ratio a partir de stats())"""
+    kind = 'gauge'
+    
+    def __init__(self, name, help_text, labelnames, collect):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.collect = collect  # () -> {etiquetas: valor}
+    
+    def render(self):
+        try:
+            items = sorted(self.collect().items())
+        except Exception as e:
+            print(f"Error recolectando {self.name}: {e}")
+            return []
+        return [f'{self.name}{_label_text(self.labelnames, labels)} {value}' for labels, value in items]
+
+class Span:
+    """Mide la duración de un bloque: with STAGE_SECONDS.time('gemini'): ..."""
+    __slots__ = ('histogram', 'labels', 'started')
+    
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+class MetricsRegistry:
+    """Métricas del proceso; con varios workers de gunicorn cada uno expone las suyas"""
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+    
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+    
+    def gauge(self, name, help_text, labelnames, collect):
+        return self.register(Gauge(name, help_text, labelnames, collect))
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram('pricefinder_stage_seconds', 'Duración por etapa de la búsqueda', ('stage',))
+REQUEST_SECONDS = metrics.histogram('pricefinder_http_request_seconds', 'Duración de las peticiones HTTP por endpoint', ('endpoint', 'method', 'status'))
+UPSTREAM_SECONDS = metrics.histogram('pricefinder_upstream_seconds', 'Duración de las llamadas a servicios externos', ('upstream', 'engine'))
+UPSTREAM_RESPONSES = metrics.counter('pricefinder_upstream_responses_total', 'Respuestas de servicios externos por código', ('upstream', 'engine', 'status'))
+CACHE_REQUESTS = metrics.counter('pricefinder_cache_requests_total', 'Consultas a caches por resultado', ('cache', 'result'))
+
+def timed(stage):
+    """Decorador: registra la duración de la función en pricefinder_stage_seconds"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage)
+        return wrapper
+    return decorator
+
+# ==============================================================================
+# SESIONES HTTP CON POOL DE CONEXIONES
+# ==============================================================================
+
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE') or os.environ.get('GUNICORN_THREADS') or 10)
+HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.3))
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+def create_http_session(retries=2, methods=('GET',), pool_size=None, backoff=None):
+    """Session de requests con keep-alive, pool dimensionado a los threads del worker y reintentos en 429/5xx"""
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        backoff_factor=HTTP_RETRY_BACKOFF if backoff is None else backoff,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(methods),
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size or HTTP_POOL_SIZE, max_retries=retry)
+    http = requests.Session()
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    return http
+
+# ==============================================================================
+# CIRCUIT BREAKERS Y TIMEOUTS ADAPTATIVOS
+# ==============================================================================
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('CIRCUIT_RESET_SECONDS', 30))
+ADAPTIVE_TIMEOUT_FACTOR = float(os.environ.get('ADAPTIVE_TIMEOUT_FACTOR', 2.0))
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 20
+
+class CircuitBreaker:
+    """Breaker por servicio externo (closed/open/half_open) con timeout derivado del p99 de latencia observada.
+    
+    Tras `failure_threshold` fallos seguidos se abre y rechaza llamadas durante `reset_timeout` segundos;
+    luego deja pasar una sonda (half_open) que lo cierra si tiene éxito o lo vuelve a abrir si falla.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+    
+    def __init__(self, name, min_timeout, max_timeout, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=CIRCUIT_RESET_SECONDS, window=200, clock=time.monotonic):
+        self.name = name
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.opened = 0
+        self.short_circuited = 0
+        self.successes = 0
+        self.failures = 0
+    
+    def allow(self):
+        """True si la llamada puede salir; en half_open solo pasa una sonda a la vez"""
+        with self._lock:
+            if self.state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.short_circuited += 1
+            return False
+    
+    def release_probe(self):
+        """Libera el turno de sonda half-open cuando la llamada no llegó a hacerse"""
+        with self._lock:
+            self._probe_in_flight = False
+    
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.state == self.OPEN and self.clock() - self._opened_at < self.reset_timeout
+    
+    def record_success(self, latency):
+        with self._lock:
+            self.successes += 1
+            self._latencies.append(latency)
+            self._consecutive_failures = 0
+            self._probe_in_flight = False
+            self.state = self.CLOSED
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                    print(f"🔌 Circuit breaker de {self.name} abierto tras {self._consecutive_failures} fallos")
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+    
+    def _percentile(self, pct):
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else None
+    
+    def timeout(self, ceiling=None):
+        """Timeout de lectura: p99 observado x ADAPTIVE_TIMEOUT_FACTOR, acotado a [min_timeout, max_timeout]"""
+        ceiling = self.max_timeout if ceiling is None else min(ceiling, self.max_timeout)
+        with self._lock:
+            if len(self._latencies) < ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+                return ceiling
+            p99 = self._percentile(99)
+        return max(min(self.min_timeout, ceiling), min(ceiling, p99 * ADAPTIVE_TIMEOUT_FACTOR))
+    
+    def stats(self):
+        timeout = self.timeout()
+        with self._lock:
+            if self.state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+                state = self.HALF_OPEN
+            else:
+                state = self.state
+            return {
+                'state': state,
+                'consecutive_failures': self._consecutive_failures,
+                'opened': self.opened,
+                'short_circuited': self.short_circuited,
+                'successes': self.successes,
+                'failures': self.failures,
+                'timeout': round(timeout, 3),
+                'latency_p50': round(self._percentile(50), 3) if self._latencies else None,
+                'latency_p99': round(self._percentile(99), 3) if self._latencies else None
+            }
+
+# Gemini no tenía timeout: sin él un servicio degradado bloquea el thread indefinidamente
+GEMINI_TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT', 20))
+gemini_breaker = CircuitBreaker('gemini', min_timeout=3.0, max_timeout=GEMINI_TIMEOUT)
+
+# ==============================================================================
+# DEADLINE POR PETICIÓN
+# ==============================================================================
+
+# Presupuesto total de una búsqueda (validación de imagen + Gemini + SerpAPI); acota el p99 de /api/search
+SEARCH_DEADLINE_SECONDS = float(os.environ.get('SEARCH_DEADLINE_SECONDS', 10))
+# Tiempo que se reserva para SerpAPI al decidir si todavía cabe el análisis con Gemini
+SEARCH_DEADLINE_SERPAPI_RESERVE = float(os.environ.get('SEARCH_DEADLINE_SERPAPI_RESERVE', 2))
+# Por debajo de esto no vale la pena llamar a Gemini
+GEMINI_MIN_SECONDS = float(os.environ.get('GEMINI_MIN_SECONDS', 1.5))
+
+DEADLINE_SKIPS = metrics.counter('pricefinder_deadline_skips_total', 'Etapas omitidas por falta de presupuesto de tiempo', ('stage',))
+
+class Deadline:
+    """Instante límite de una petición (reloj monotónico); cada etapa usa el tiempo restante como timeout"""
+    __slots__ = ('expires_at',)
+    
+    def __init__(self, seconds=None, expires_at=None):
+        if expires_at is None:
+            expires_at = time.monotonic() + (SEARCH_DEADLINE_SECONDS if seconds is None else seconds)
+        self.expires_at = expires_at
+    
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+    
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+    
+    def timeout(self, cap=None, reserve=0.0):
+        """Tiempo restante menos `reserve`, acotado por `cap`; puede ser 0"""
+        remaining = max(0.0, self.remaining() - reserve)
+        return remaining if cap is None else min(cap, remaining)
+    
+    def child(self, seconds):
+        """Sub-deadline de como mucho `seconds` que nunca excede al actual"""
+        return Deadline(expires_at=min(self.expires_at, time.monotonic() + seconds))
+    
+    def skip(self, stage, cost=0.0):
+        """True (y lo registra) si no quedan `cost` segundos para la etapa"""
+        if self.remaining() > cost:
+            return False
+        DEADLINE_SKIPS.inc(stage)
+        return True
+
+def is_timeout_error(error):
+    """Timeout de requests/urllib3 o DeadlineExceeded de google-api-core (por nombre, sin importar el SDK)"""
+    # Con Retry en el adapter, requests envuelve el ReadTimeoutError de urllib3 en un ConnectionError
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return any(isinstance(e, (requests.exceptions.Timeout, PoolTimeoutError, TimeoutError)) or type(e).__name__ == 'DeadlineExceeded'
+               for e in (error, reason))
+
+def record_upstream_failure(breaker, error, stage, deadline_cut):
+    """Registra el fallo en el breaker salvo que sea un timeout impuesto por el deadline de la petición.
+    
+    Con `deadline_cut` el timeout fue menor que breaker.timeout(): un servicio sano pudo no alcanzar a
+    responder, y contarlo abriría el breaker compartido para todos los usuarios.
+    """
+    if deadline_cut and is_timeout_error(error):
+        breaker.release_probe()
+        DEADLINE_SKIPS.inc(stage)
+    else:
+        breaker.record_failure()
+
+# ==============================================================================
+# VERIFICACION LOCAL DE ID TOKENS DE FIREBASE
+# ==============================================================================
+
+FIREBASE_JWKS_URL = 'https://www.googleapis.com/service_accounts/v1/jwk/securetoken@system.gserviceaccount.com'
+# Prefijo DER de DigestInfo para SHA-256 (PKCS#1 v1.5)
+SHA256_DIGEST_INFO = bytes.fromhex('3031300d060960864801650304020105000420')
+
+def b64url_decode(data):
+    if isinstance(data, str):
+        data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+class FirebaseTokenVerifier:
+    """Verifica ID tokens de Firebase localmente: firma RS256 con las claves públicas de Google (JWKS en cache)"""
+    def __init__(self, project_id, jwks_url=FIREBASE_JWKS_URL, http=None, clock=time.time, leeway=60, cache_size=2048):
+        self.project_id = project_id
+        self.jwks_url = jwks_url
+        self.http = http or requests
+        self.clock = clock
+        self.leeway = leeway
+        self.cache_size = cache_size
+        self._keys = {}
+        self._keys_expire_at = 0
+        self._keys_fetched_at = 0
+        self._keys_lock = threading.Lock()
+        self._verified = OrderedDict()
+        self._verified_lock = threading.Lock()
+        self.cache_hits = 0
+        self.verified = 0
+        self.rejected = 0
+        self.key_fetches = 0
+    
+    def is_enabled(self):
+        return bool(self.project_id)
+    
+    def _fetch_keys(self, now):
+        response = self.http.get(self.jwks_url, timeout=5)
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get('keys', []):
+            if jwk.get('kty') == 'RSA' and jwk.get('kid'):
+                keys[jwk['kid']] = (int.from_bytes(b64url_decode(jwk['n']), 'big'), int.from_bytes(b64url_decode(jwk['e']), 'big'))
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        self._keys = keys
+        self._keys_expire_at = now + (int(match.group(1)) if match else 3600)
+        self._keys_fetched_at = now
+        self.key_fetches += 1
+    
+    def _get_key(self, kid):
+        now = self.clock()
+        with self._keys_lock:
+            # Recargar al vencer max-age, o ante un kid desconocido (rotación) como mucho una vez por minuto
+            stale = now >= self._keys_expire_at
+            unknown = kid not in self._keys and now - self._keys_fetched_at > 60
+            if stale or unknown:
+                try:
+                    self._fetch_keys(now)
+                except Exception as e:
+                    print(f"Error obteniendo claves públicas de Firebase: {e}")
+            return self._keys.get(kid)
+    
+    @staticmethod
+    def _verify_rs256(signing_input, signature, key):
+        n, e = key
+        size = (n.bit_length() + 7) // 8
+        if len(signature) != size:
+            return False
+        decoded = pow(int.from_bytes(signature, 'big'), e, n).to_bytes(size, 'big')
+        digest_info = SHA256_DIGEST_INFO + hashlib.sha256(signing_input).digest()
+        padding = size - 3 - len(digest_info)
+        if padding < 8:
+            return False
+        expected = b'\x00\x01' + b'\xff' * padding + b'\x00' + digest_info
+        return hmac.compare_digest(decoded, expected)
+    
+    def _reject(self, reason):
+        with self._verified_lock:
+            self.rejected += 1
+        print(f"ID token rechazado: {reason}")
+        return None
+    
+    def verify(self, token):
+        """Claims del token si es válido; None si no"""
+        if not self.project_id or not token:
+            return None
+        now = self.clock()
+        token_key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        with self._verified_lock:
+            claims = self._verified.get(token_key)
+            if claims is not None:
+                if claims['exp'] > now - self.leeway:
+                    self._verified.move_to_end(token_key)
+                    self.cache_hits += 1
+                    return claims
+                del self._verified[token_key]
+        
+        try:
+            header_b64, payload_b64, signature_b64 = token.split('.')
+            header = json.loads(b64url_decode(header_b64))
+            claims = json.loads(b64url_decode(payload_b64))
+            signature = b64url_decode(signature_b64)
+        except (ValueError, TypeError):
+            return self._reject('formato inválido')
+        # JSON válido no implica objetos: `W10` (una lista) o un kid no textual no deben llegar más lejos
+        if not isinstance(header, dict) or not isinstance(claims, dict):
+            return self._reject('formato inválido')
+        if not isinstance(header.get('kid'), str):
+            return self._reject('kid inválido')
+        
+        if header.get('alg') != 'RS256':
+            return self._reject('algoritmo no permitido')
+        key = self._get_key(header.get('kid'))
+        if key is None:
+            return self._reject('kid desconocido')
+        if not self._verify_rs256(f"{header_b64}.{payload_b64}".encode('ascii'), signature, key):
+            return self._reject('firma inválida')
+        
+        try:
+            if claims.get('aud') != self.project_id:
+                return self._reject('aud incorrecto')
+            if claims.get('iss') != f"https://securetoken.google.com/{self.project_id}":
+                return self._reject('iss incorrecto')
+            if not isinstance(claims.get('sub'), str) or not claims['sub'] or len(claims['sub']) > 128:
+                return self._reject('sub inválido')
+            if float(claims['exp']) <= now - self.leeway:
+                return self._reject('token expirado')
+            if float(claims['iat']) > now + self.leeway or float(claims.get('auth_time', 0)) > now + self.leeway:
+                return self._reject('emitido en el futuro')
+        except (KeyError, TypeError, ValueError):
+            return self._reject('claims incompletos')
+        
+        with self._verified_lock:
+            self.verified += 1
+            self._verified[token_key] = claims
+            while len(self._verified) > self.cache_size:
+                self._verified.popitem(last=False)
+        return claims
+    
+    def stats(self):
+        with self._verified_lock:
+            return {
+                'enabled': self.is_enabled(),
+                'cached_tokens': len(self._verified),
+                'cache_hits': self.cache_hits,
+                'verified': self.verified,
+                'rejected': self.rejected,
+                'key_fetches': self.key_fetches,
+                'keys': len(self._keys)
+            }
+
 # Firebase Auth Class
 class FirebaseAuth:
     def __init__(self):
         self.firebase_web_api_key = os.environ.get("FIREBASE_WEB_API_KEY")
+        # FIREBASE_AUTH_URL permite apuntar a un emulador o a un stand-in local (benchmarks)
+        self.auth_base_url = os.environ.get('FIREBASE_AUTH_URL', 'https://identitytoolkit.googleapis.com/v1').rstrip('/')
+        self.http = create_http_session(retries=int(os.environ.get('FIREBASE_RETRIES', 1)), methods=('POST',))
+        self.token_verifier = FirebaseTokenVerifier(
+            os.environ.get('FIREBASE_PROJECT_ID'),
+            jwks_url=os.environ.get('FIREBASE_JWKS_URL', FIREBASE_JWKS_URL),
+            http=create_http_session()
+        )
         if not self.firebase_web_api_key:
             print("WARNING: FIREBASE_WEB_API_KEY no configurada")
         else:
@@ -67,11 +719,11 @@ class FirebaseAuth:
         if not self.firebase_web_api_key:
             return {'success': False, 'message': 'Servicio no configurado', 'user_data': None, 'error_code': 'SERVICE_NOT_CONFIGURED'}
         
-        url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={self.firebase_web_api_key}"
+        url = f"{self.auth_base_url}/accounts:signInWithPassword?key={self.firebase_web_api_key}"
         payload = {'email': email, 'password': password, 'returnSecureToken': True}
         
         try:
-            response = requests.post(url, json=payload, timeout=8)
+            response = self.http.post(url, json=payload, timeout=8)
             response.raise_for_status()
             user_data = response.json()
             
@@ -106,115 +758,1762 @@ class FirebaseAuth:
         session['user_name'] = user_data['display_name']
         session['user_email'] = user_data['email']
         session['id_token'] = user_data['id_token']
-        session['login_time'] = datetime.now().isoformat()
+        session['login_time'] = int(time.time())
         session.permanent = True
     
     def clear_user_session(self):
-        important_data = {key: session.get(key) for key in ['timestamp'] if key in session}
+        important_data = {key: session.get(key) for key in ['last_seen'] if key in session}
         session.clear()
         for key, value in important_data.items():
             session[key] = value
     
-    def is_user_logged_in(self):
-        if 'user_id' not in session or session['user_id'] is None:
-            return False
-        if 'login_time' in session:
+    def get_bearer_token(self):
+        auth_header = request.headers.get('Authorization', '')
+        if auth_header.startswith('Bearer '):
+            return auth_header[7:].strip()
+        return None
+    
+    def get_token_claims(self):
+        """Claims del ID token enviado como 'Authorization: Bearer', verificado una vez por petición"""
+        if 'firebase_claims' not in g:
+            g.firebase_claims = self.token_verifier.verify(self.get_bearer_token())
+        return g.firebase_claims
+    
+    def is_user_logged_in(self):
+        if self.get_bearer_token():
+            return self.get_token_claims() is not None
+        if 'user_id' not in session or session['user_id'] is None:
+            return False
+        login_time = session_epoch(session.get('login_time'))
+        if login_time is not None and time.time() - login_time > 7200:  # 2 horas maximo
+            return False
+        return True
+    
+    def get_current_user(self):
+        if not self.is_user_logged_in():
+            return None
+        claims = self.get_token_claims() if self.get_bearer_token() else None
+        if claims:
+            email = claims.get('email', '')
+            return {
+                'user_id': claims['sub'],
+                'user_name': claims.get('name') or email.split('@')[0] or 'Usuario',
+                'user_email': email,
+                'id_token': self.get_bearer_token()
+            }
+        return {
+            'user_id': session.get('user_id'),
+            'user_name': session.get('user_name'),
+            'user_email': session.get('user_email'),
+            'id_token': session.get('id_token')
+        }
+
+firebase_auth = FirebaseAuth()
+
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not firebase_auth.is_user_logged_in():
+            if firebase_auth.get_bearer_token():
+                return jsonify({'success': False, 'error': 'Token inválido o expirado'}), 401
+            flash('Tu sesion ha expirado. Inicia sesion nuevamente.', 'warning')
+            return redirect(url_for('auth_login_page'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+# ==============================================================================
+# FUNCIONES DE BÚSQUEDA POR IMAGEN
+# ==============================================================================
+
+def compute_dhash(image, hash_size=8):
+    """Hash perceptual de diferencias (dHash) de 64 bits: estable ante re-codificación y redimensionado"""
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def compute_mean_color(image):
+    """Color medio (R, G, B) redondeado: el dHash solo ve luminancia y no distingue variantes de color"""
+    return tuple(image.convert('RGB').resize((1, 1), Image.Resampling.BOX).getpixel((0, 0)))
+
+class ImageQueryCache:
+    """Cache imagen -> consulta generada, por SHA-256 exacto o por dHash cercano (distancia de Hamming).
+    
+    La coincidencia cercana exige además un color medio parecido y se omite con hashes degenerados
+    (casi todos los bits iguales: fondos lisos o fotos sin textura), que colisionan entre productos distintos.
+    """
+    def __init__(self, max_size=512, ttl=86400, max_distance=4, hash_bits=64, max_color_delta=24, degenerate_bits=4):
+        self.max_size = max(1, int(max_size))
+        self.ttl = ttl
+        self.max_distance = max(0, int(max_distance))
+        self.hash_bits = hash_bits
+        self.max_color_delta = max(0, int(max_color_delta))
+        self.degenerate_bits = max(0, int(degenerate_bits))
+        # Con max_distance + 1 bandas, dos hashes a distancia <= max_distance comparten al menos una banda
+        band_count = self.max_distance + 1
+        band_width = -(-hash_bits // band_count)
+        self._bands = [(start, min(band_width, hash_bits - start)) for start in range(0, hash_bits, band_width)]
+        self._entries = OrderedDict()
+        self._band_index = {}
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.perceptual_hits = 0
+        self.misses = 0
+        self.degenerate = 0
+        self.evictions = 0
+    
+    def is_degenerate(self, phash):
+        bits = bin(phash).count('1')
+        return bits <= self.degenerate_bits or bits >= self.hash_bits - self.degenerate_bits
+    
+    def _band_keys(self, phash):
+        return [(i, (phash >> start) & ((1 << width) - 1)) for i, (start, width) in enumerate(self._bands)]
+    
+    def _remove(self, digest):
+        _, phash, _, _ = self._entries.pop(digest)
+        for band_key in self._band_keys(phash):
+            bucket = self._band_index.get(band_key)
+            if bucket is not None:
+                bucket.discard(digest)
+                if not bucket:
+                    del self._band_index[band_key]
+    
+    def _lookup(self, digest, now):
+        entry = self._entries.get(digest)
+        if entry is None:
+            return None
+        if now >= entry[2]:
+            self._remove(digest)
+            return None
+        self._entries.move_to_end(digest)
+        return entry[0]
+    
+    def get_exact(self, digest):
+        with self._lock:
+            search_query = self._lookup(digest, time.time())
+            if search_query is not None:
+                self.exact_hits += 1
+            return search_query
+    
+    def _color_matches(self, a, b):
+        if a is None or b is None:
+            return True
+        return max(abs(x - y) for x, y in zip(a, b)) <= self.max_color_delta
+    
+    def get_similar(self, phash, color=None):
+        now = time.time()
+        with self._lock:
+            if self.is_degenerate(phash):
+                self.degenerate += 1
+                self.misses += 1
+                return None
+            candidates = set()
+            for band_key in self._band_keys(phash):
+                candidates.update(self._band_index.get(band_key, ()))
+            best = None
+            for digest in candidates:
+                entry = self._entries.get(digest)
+                if entry is None:
+                    continue
+                distance = bin(entry[1] ^ phash).count('1')
+                if distance > self.max_distance or not self._color_matches(entry[3], color):
+                    continue
+                if best is None or distance < best[0]:
+                    best = (distance, digest)
+            search_query = self._lookup(best[1], now) if best else None
+            if search_query is None:
+                self.misses += 1
+            else:
+                self.perceptual_hits += 1
+            return search_query
+    
+    def set(self, digest, phash, search_query, color=None):
+        with self._lock:
+            if digest in self._entries:
+                self._remove(digest)
+            self._entries[digest] = (search_query, phash, time.time() + self.ttl, color)
+            # Los hashes degenerados solo sirven para la coincidencia exacta por digest
+            if not self.is_degenerate(phash):
+                for band_key in self._band_keys(phash):
+                    self._band_index.setdefault(band_key, set()).add(digest)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.perceptual_hits
+            lookups = hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'exact_hits': self.exact_hits,
+                'perceptual_hits': self.perceptual_hits,
+                'misses': self.misses,
+                'degenerate': self.degenerate,
+                'evictions': self.evictions,
+                'hit_rate': round(hits / lookups, 4) if lookups else 0.0
+            }
+
+image_query_cache = ImageQueryCache(
+    max_size=int(os.environ.get('IMAGE_CACHE_SIZE', 512)),
+    ttl=int(os.environ.get('IMAGE_CACHE_TTL', 86400)),
+    max_distance=int(os.environ.get('IMAGE_CACHE_MAX_DISTANCE', 4)),
+    max_color_delta=int(os.environ.get('IMAGE_CACHE_MAX_COLOR_DELTA', 24))
+)
+
+ALLOWED_IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP')
+MIN_IMAGE_SIDE = 10
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 50_000_000))
+GEMINI_IMAGE_SIZE = (1024, 1024)
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+class ImageUpload:
+    """Imagen subida: la cabecera se lee una sola vez y los píxeles se decodifican bajo demanda, una sola vez.
+    
+    Acepta bytes o un archivo con seek (p. ej. el SpooledTemporaryFile de Werkzeug) sin copiarlo.
+    """
+    def __init__(self, source, digest=None, byte_size=None):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            byte_size = len(source)
+            source = io.BytesIO(source)
+        self.stream = source
+        self.byte_size = byte_size
+        self._digest = digest
+        self._image = Image.open(source)  # Solo lee la cabecera
+        self.format = self._image.format
+        self.size = self._image.size
+        self._prepared = None
+    
+    @property
+    def digest(self):
+        if self._digest is None:
+            position = self.stream.tell()
+            self.stream.seek(0)
+            hasher = hashlib.sha256()
+            for chunk in iter(lambda: self.stream.read(UPLOAD_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+            self.stream.seek(position)
+            self._digest = hasher.hexdigest()
+        return self._digest
+    
+    def is_valid(self):
+        """Formato y dimensiones, sin decodificar píxeles"""
+        width, height = self.size
+        if width < MIN_IMAGE_SIDE or height < MIN_IMAGE_SIDE:
+            return False
+        if self.format not in ALLOWED_IMAGE_FORMATS:
+            return False
+        return width * height <= MAX_IMAGE_PIXELS
+    
+    def prepared(self):
+        """Imagen RGB reducida para Gemini; en JPEG el decodificador ya reduce la escala (draft)"""
+        if self._prepared is None:
+            image = self._image
+            if image.format == 'JPEG':
+                image.draft('RGB', GEMINI_IMAGE_SIZE)
+            if image.size[0] > GEMINI_IMAGE_SIZE[0] or image.size[1] > GEMINI_IMAGE_SIZE[1]:
+                image.thumbnail(GEMINI_IMAGE_SIZE, Image.Resampling.LANCZOS)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            else:
+                image.load()
+            self._prepared = image
+        return self._prepared
+
+def open_image_upload(image_content):
+    """ImageUpload para los bytes dados, o None si PIL no puede leer la cabecera"""
+    if isinstance(image_content, ImageUpload):
+        return image_content
+    if not PIL_AVAILABLE or not image_content:
+        return None
+    try:
+        return ImageUpload(image_content)
+    except Exception as e:
+        print(f"❌ Imagen ilegible: {e}")
+        return None
+
+def sniff_image_format(head):
+    """Formato según los primeros bytes (firma), antes de recibir el resto del archivo"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+@timed('read_upload')
+def read_image_upload(file_storage):
+    """Lee la imagen del formulario por bloques: firma, límite de tamaño y SHA-256 en una sola pasada.
+    
+    Devuelve (imagen, error); la imagen es un ImageUpload sobre el stream original, sin copias en memoria.
+    """
+    stream = file_storage.stream
+    head = stream.read(UPLOAD_CHUNK_SIZE)
+    if sniff_image_format(head) is None:
+        return None, 'Formato de imagen no soportado (JPG, PNG o WEBP)'
+    
+    hasher = hashlib.sha256(head)
+    byte_size = len(head)
+    for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+        byte_size += len(chunk)
+        if byte_size > MAX_UPLOAD_BYTES:
+            return None, 'La imagen es demasiado grande (máximo 10MB)'
+        hasher.update(chunk)
+    stream.seek(0)
+    print(f"📷 Imagen recibida: {byte_size} bytes")
+    
+    if not PIL_AVAILABLE:
+        return stream, None
+    try:
+        return ImageUpload(stream, digest=hasher.hexdigest(), byte_size=byte_size), None
+    except Exception as e:
+        print(f"❌ Imagen ilegible: {e}")
+        return None, 'Error al procesar la imagen'
+
+@timed('analyze_image')
+def analyze_image_with_gemini(image_content, deadline=None):
+    """Analiza imagen con Gemini Vision (acepta bytes o ImageUpload); con `deadline` se omite si no queda tiempo"""
+    if not GEMINI_READY or not PIL_AVAILABLE or not image_content:
+        print("❌ Gemini o PIL no disponible para análisis de imagen")
+        return None
+    
+    try:
+        upload = open_image_upload(image_content)
+        if upload is None:
+            return None
+        
+        # Misma imagen ya analizada: evitar la decodificación y la llamada a Gemini
+        digest = upload.digest
+        cached_query = image_query_cache.get_exact(digest)
+        if cached_query:
+            CACHE_REQUESTS.inc('image_query', 'hit')
+            print(f"🧠 Consulta de imagen desde cache: '{cached_query}'")
+            return cached_query
+        
+        deadline = deadline or Deadline()
+        if deadline.skip('prepare_image'):
+            print("⏱️ Sin tiempo para analizar la imagen - usando solo texto")
+            return None
+        
+        # Única decodificación: imagen reducida y en RGB
+        with STAGE_SECONDS.time('prepare_image'):
+            image = upload.prepared()
+            # Copias re-codificadas o redimensionadas de la misma foto
+            phash = compute_dhash(image)
+            color = compute_mean_color(image)
+        cached_query = image_query_cache.get_similar(phash, color)
+        if cached_query:
+            CACHE_REQUESTS.inc('image_query', 'similar')
+            image_query_cache.set(digest, phash, cached_query, color)
+            print(f"🧠 Consulta de imagen similar desde cache: '{cached_query}'")
+            return cached_query
+        CACHE_REQUESTS.inc('image_query', 'miss')
+        
+        # Gemini es opcional: solo si cabe sin dejar a SerpAPI sin presupuesto
+        if deadline.skip('gemini', SEARCH_DEADLINE_SERPAPI_RESERVE + GEMINI_MIN_SECONDS):
+            print("⏱️ Sin tiempo para Gemini - omitiendo análisis de imagen")
+            return None
+        
+        print("🖼️ Analizando imagen con Gemini Vision...")
+        
+        prompt = """
+        Analiza esta imagen de producto y genera una consulta de búsqueda específica en inglés para encontrarlo en tiendas online.
+        
+        Incluye:
+        - Nombre exacto del producto
+        - Marca (si es visible)
+        - Modelo o características distintivas
+        - Color, tamaño
+        - Categoría del producto
+        
+        Responde SOLO con la consulta de búsqueda optimizada para e-commerce.
+        Ejemplo: "blue tape painter's tape 2 inch width"
+        """
+        
+        # Antes de allow(): el import diferido y configure() pueden fallar, y una sonda half-open tomada
+        # sin registrar éxito ni fallo dejaría el breaker en half_open para siempre
+        model = genai.GenerativeModel('gemini-1.5-flash-latest')
+        
+        # Gemini degradado: seguir por la ruta de solo texto sin esperar
+        if not gemini_breaker.allow():
+            UPSTREAM_RESPONSES.inc('gemini', 'vision', 'circuit_open')
+            print("🔌 Gemini no disponible (circuit breaker abierto) - omitiendo análisis de imagen")
+            return None
+        
+        breaker_timeout = gemini_breaker.timeout()
+        gemini_timeout = deadline.timeout(breaker_timeout, reserve=SEARCH_DEADLINE_SERPAPI_RESERVE)
+        started = time.perf_counter()
+        try:
+            # Sin reintentos del cliente (por defecto reintenta 503 hasta 600 s); el breaker decide cuándo volver a intentar
+            response = model.generate_content([prompt, image], request_options={'timeout': gemini_timeout, 'retry': None})
+        except Exception as e:
+            record_upstream_failure(gemini_breaker, e, 'gemini', gemini_timeout < breaker_timeout)
+            UPSTREAM_RESPONSES.inc('gemini', 'vision', type(e).__name__)
+            raise
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, 'gemini', 'vision')
+        gemini_breaker.record_success(time.perf_counter() - started)
+        UPSTREAM_RESPONSES.inc('gemini', 'vision', 'ok')
+        
+        if response.text:
+            search_query = clean_gemini_query(response.text)
+            if not search_query:
+                return None
+            print(f"🧠 Consulta generada desde imagen: '{search_query}'")
+            image_query_cache.set(digest, phash, search_query, color)
+            return search_query
+        
+        return None
+            
+    except Exception as e:
+        print(f"❌ Error analizando imagen: {e}")
+        return None
+
+# ==============================================================================
+# CACHE DE RESULTADOS
+# ==============================================================================
+
+# Palabras vacías (inglés y español) que no cambian el producto buscado
+QUERY_STOPWORDS = frozenset("""
+a an and the of in on by at cheap online sale price
+el la los las un una unos unas de del y en por al precio comprar barato
+""".split())
+
+# Negación, dirección y alternativas: cambian el producto ('leche sin lactosa', 'usb c to hdmi'), así que
+# se conservan y, si aparecen, el orden de los tokens también
+QUERY_ORDER_WORDS = frozenset("""
+with without to for from or vs versus not no non
+sin con para hacia desde o ni
+""".split())
+
+# Comillas y signos que Gemini suele añadir alrededor de la consulta
+GEMINI_QUOTE_CHARS = '"\'`«»“”‘’'
+_PUNCTUATION_RE = re.compile(r"[^\w\s.+#]")
+_GEMINI_PREFIX_RE = re.compile(r'^(?:consulta(?: de búsqueda)?|search query|query)\s*:\s*', re.IGNORECASE)
+
+def clean_gemini_query(text):
+    """Limpia la respuesta de Gemini: primera línea, sin prefijos tipo 'Search query:' ni comillas envolventes"""
+    lines = [line.strip() for line in str(text or '').splitlines() if line.strip()]
+    if not lines:
+        return ''
+    query = _GEMINI_PREFIX_RE.sub('', lines[0]).strip()
+    query = query.strip(GEMINI_QUOTE_CHARS + ' .').strip()
+    return ' '.join(query.split())
+
+def canonicalize_query(query):
+    """Forma canónica: NFKC, minúsculas, sin puntuación ni palabras vacías; tokens ordenados salvo con QUERY_ORDER_WORDS"""
+    text = unicodedata.normalize('NFKC', str(query or '')).casefold()
+    text = _PUNCTUATION_RE.sub(' ', text)
+    tokens = [token.strip('.') for token in text.split()]
+    tokens = [token for token in tokens if token]
+    significant = [token for token in tokens if token not in QUERY_STOPWORDS]
+    # Si todo son palabras vacías se conserva la consulta completa
+    significant = significant or tokens
+    if QUERY_ORDER_WORDS.intersection(significant):
+        return ' '.join(significant)
+    return ' '.join(sorted(significant))
+
+class QueryCanonicalizer:
+    """Calcula claves de cache canónicas y mide cuántas consultas distintas colapsan en la misma clave"""
+    def __init__(self, max_tracked=5000, max_variants=8):
+        self.max_tracked = max(1, int(max_tracked))
+        self.max_variants = max(1, int(max_variants))
+        self._variants = OrderedDict()  # clave canónica -> formas simples vistas
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.merged_lookups = 0
+    
+    def key(self, query, record=True):
+        """Clave estable para una consulta (independiente del hash() aleatorio por proceso)"""
+        canonical = canonicalize_query(query)
+        key = 'search_' + hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+        if record:
+            self._record(key, ' '.join(str(query or '').lower().split()))
+        return key
+    
+    def _record(self, key, simple):
+        with self._lock:
+            self.lookups += 1
+            variants = self._variants.get(key)
+            if variants is None:
+                variants = self._variants[key] = set()
+                if len(self._variants) > self.max_tracked:
+                    self._variants.popitem(last=False)
+            else:
+                self._variants.move_to_end(key)
+            # Consulta que con la clave anterior (solo minúsculas y espacios) habría sido otra entrada
+            if variants and simple not in variants:
+                self.merged_lookups += 1
+            if len(variants) < self.max_variants:
+                variants.add(simple)
+    
+    def stats(self):
+        with self._lock:
+            collisions = sum(1 for variants in self._variants.values() if len(variants) > 1)
+            return {
+                'lookups': self.lookups,
+                'canonical_keys': len(self._variants),
+                'collisions': collisions,
+                'variants': sum(len(variants) for variants in self._variants.values()),
+                'merged_lookups': self.merged_lookups,
+                'merged_ratio': round(self.merged_lookups / self.lookups, 3) if self.lookups else 0.0
+            }
+
+query_canonicalizer = QueryCanonicalizer(int(os.environ.get('QUERY_CANONICAL_TRACKED', 5000)))
+
+def normalize_query_key(query, record=False):
+    """Clave de cache canónica para una consulta"""
+    return query_canonicalizer.key(query, record=record)
+
+class CacheBackend:
+    """Interfaz común de los backends de cache de búsqueda"""
+    fill_poll_interval = 0.05
+    
+    def lookup(self, key, record=True):
+        """(valor, vencido): las entradas vencidas se conservan stale_ttl segundos para stale-while-revalidate"""
+        raise NotImplementedError
+    
+    def get(self, key, record=True):
+        value, stale = self.lookup(key, record)
+        return None if stale else value
+    
+    def _hit_rate(self):
+        total = self.hits + self.stale_hits + self.misses
+        return round((self.hits + self.stale_hits) / total, 3) if total else 0.0
+    
+    def set(self, key, value, ttl=None, stale_ttl=None):
+        """Guarda `value` por `ttl` segundos; `stale_ttl` reemplaza la ventana stale del backend para esta entrada"""
+        raise NotImplementedError
+    
+    def delete(self, key):
+        raise NotImplementedError
+    
+    def stats(self):
+        return {}
+    
+    def acquire_fill(self, key, lock_ttl=15):
+        """Reserva el llenado de una clave entre workers; True si este proceso debe consultar"""
+        return True
+    
+    def release_fill(self, key):
+        pass
+    
+    def reset_after_fork(self):
+        """Descarta conexiones e identidad heredadas del proceso padre (gunicorn --preload)"""
+        pass
+    
+    def wait_for(self, key, timeout):
+        """Espera a que otro worker llene la clave; None si vence el tiempo"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            value = self.get(key, record=False)
+            if value is not None:
+                return value
+            time.sleep(self.fill_poll_interval)
+        return None
+
+class SearchCache(CacheBackend):
+    """Cache LRU con TTL por entrada, seguro entre threads (local al proceso)"""
+    def __init__(self, max_size=256, ttl=180, stale_ttl=0):
+        self.max_size = max(1, int(max_size))
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def lookup(self, key, record=True):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += record
+                return None, False
+            value, expires_at, stale_until = entry
+            now = time.time()
+            if now >= stale_until:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += record
+                return None, False
+            self._data.move_to_end(key)
+            if now >= expires_at:
+                self.stale_hits += record
+                return value, True
+            self.hits += record
+            return value, False
+    
+    def set(self, key, value, ttl=None, stale_ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        stale_until = expires_at + (self.stale_ttl if stale_ttl is None else stale_ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at, stale_until)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'stale_ttl': self.stale_ttl,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_rate': self._hit_rate(),
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+class SQLiteSearchCache(CacheBackend):
+    """Cache compartido entre workers del mismo host sobre SQLite en modo WAL"""
+    def __init__(self, path, max_size=1000, ttl=180, stale_ttl=0):
+        self.path = path
+        self.max_size = max(1, int(max_size))
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._init_schema()
+    
+    def reset_after_fork(self):
+        self._local = threading.local()
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+    
+    def _init_schema(self):
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL, stale_until REAL NOT NULL DEFAULT 0)')
+        # Archivos creados antes de la ventana stale por entrada: sus filas quedan vencidas y se reemplazan
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(cache_entries)')}
+        if 'stale_until' not in columns:
+            conn.execute('ALTER TABLE cache_entries ADD COLUMN stale_until REAL NOT NULL DEFAULT 0')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_entries_accessed ON cache_entries (accessed_at)')
+        conn.execute('CREATE TABLE IF NOT EXISTS fill_locks (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+    
+    def _count(self, attr, amount=1):
+        with self._stats_lock:
+            setattr(self, attr, getattr(self, attr) + amount)
+    
+    def lookup(self, key, record=True):
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute('SELECT value, expires_at, stale_until FROM cache_entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self._count('misses', record)
+                return None, False
+            if now >= row[2]:
+                conn.execute('DELETE FROM cache_entries WHERE key = ? AND stale_until <= ?', (key, now))
+                self._count('expirations')
+                self._count('misses', record)
+                return None, False
+            conn.execute('UPDATE cache_entries SET accessed_at = ? WHERE key = ?', (now, key))
+            stale = now >= row[1]
+            self._count('stale_hits' if stale else 'hits', record)
+            return json.loads(row[0]), stale
+        except (sqlite3.Error, ValueError) as e:
+            print(f"Error leyendo cache SQLite: {e}")
+            self._count('misses', record)
+            return None, False
+    
+    def set(self, key, value, ttl=None, stale_ttl=None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        stale_until = expires_at + (self.stale_ttl if stale_ttl is None else stale_ttl)
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('INSERT OR REPLACE INTO cache_entries (key, value, expires_at, accessed_at, stale_until) VALUES (?, ?, ?, ?, ?)',
+                             (key, dumps_json(value), expires_at, now, stale_until))
+                conn.execute('DELETE FROM cache_entries WHERE stale_until <= ?', (now,))
+                excess = conn.execute('SELECT COUNT(*) FROM cache_entries').fetchone()[0] - self.max_size
+                if excess > 0:
+                    conn.execute('DELETE FROM cache_entries WHERE key IN (SELECT key FROM cache_entries ORDER BY accessed_at LIMIT ?)', (excess,))
+                    with self._stats_lock:
+                        self.evictions += excess
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"Error escribiendo cache SQLite: {e}")
+    
+    def delete(self, key):
+        try:
+            self._connect().execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            print(f"Error borrando cache SQLite: {e}")
+    
+    def acquire_fill(self, key, lock_ttl=15):
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM fill_locks WHERE key = ? AND expires_at <= ?', (key, now))
+                cursor = conn.execute('INSERT OR IGNORE INTO fill_locks (key, owner, expires_at) VALUES (?, ?, ?)',
+                                      (key, self.owner, now + lock_ttl))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            print(f"Error reservando llenado en cache SQLite: {e}")
+            return True
+    
+    def release_fill(self, key):
+        try:
+            self._connect().execute('DELETE FROM fill_locks WHERE key = ? AND owner = ?', (key, self.owner))
+        except sqlite3.Error as e:
+            print(f"Error liberando llenado en cache SQLite: {e}")
+    
+    def stats(self):
+        try:
+            size = self._connect().execute('SELECT COUNT(*) FROM cache_entries').fetchone()[0]
+        except sqlite3.Error:
+            size = None
+        with self._stats_lock:
+            return {
+                'backend': 'sqlite',
+                'size': size,
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'stale_ttl': self.stale_ttl,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_rate': self._hit_rate(),
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+class RedisSearchCache(CacheBackend):
+    """Cache compartido sobre un cliente compatible con Redis (get/set/delete/zadd/zcard/zrange/zrem)"""
+    def __init__(self, client, max_size=1000, ttl=180, prefix='pricefinder:cache:', stale_ttl=0):
+        self.client = client
+        self.max_size = max(1, int(max_size))
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.prefix = prefix
+        self.lru_key = prefix + 'lru'
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def reset_after_fork(self):
+        # redis-py reabre su pool al detectar otro pid; solo cambia la identidad del dueño de los llenados
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    
+    def _count(self, attr, amount=1):
+        with self._stats_lock:
+            setattr(self, attr, getattr(self, attr) + amount)
+    
+    def lookup(self, key, record=True):
+        try:
+            raw = self.client.get(self.prefix + key)
+            if raw is None:
+                self._count('misses', record)
+                return None, False
+            now = time.time()
+            self.client.zadd(self.lru_key, {key: now})
+            if isinstance(raw, bytes):
+                raw = raw.decode('utf-8')
+            # Sobre {"v": valor, "e": vencimiento, "s": fin de la ventana stale}; Redis elimina la clave poco después
+            entry = json.loads(raw)
+            if now >= entry.get('s', entry['e'] + self.stale_ttl):
+                self._count('misses', record)
+                return None, False
+            stale = now >= entry['e']
+            self._count('stale_hits' if stale else 'hits', record)
+            return entry['v'], stale
+        except Exception as e:
+            print(f"Error leyendo cache Redis: {e}")
+            self._count('misses', record)
+            return None, False
+    
+    def set(self, key, value, ttl=None, stale_ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+        expires_at = time.time() + ttl
+        try:
+            self.client.set(self.prefix + key, dumps_json({'v': value, 'e': expires_at, 's': expires_at + stale_ttl}),
+                            ex=max(1, math.ceil(ttl + stale_ttl)))
+            self.client.zadd(self.lru_key, {key: time.time()})
+            excess = self.client.zcard(self.lru_key) - self.max_size
+            if excess > 0:
+                oldest = self.client.zrange(self.lru_key, 0, excess - 1)
+                for old_key in oldest:
+                    if isinstance(old_key, bytes):
+                        old_key = old_key.decode('utf-8')
+                    self.client.delete(self.prefix + old_key)
+                    self.client.zrem(self.lru_key, old_key)
+                self._count('evictions', len(oldest))
+        except Exception as e:
+            print(f"Error escribiendo cache Redis: {e}")
+    
+    def delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+            self.client.zrem(self.lru_key, key)
+        except Exception as e:
+            print(f"Error borrando cache Redis: {e}")
+    
+    def acquire_fill(self, key, lock_ttl=15):
+        try:
+            return bool(self.client.set(self.prefix + 'fill:' + key, self.owner, nx=True, ex=max(1, int(lock_ttl))))
+        except Exception as e:
+            print(f"Error reservando llenado en cache Redis: {e}")
+            return True
+    
+    def release_fill(self, key):
+        try:
+            lock_key = self.prefix + 'fill:' + key
+            owner = self.client.get(lock_key)
+            if isinstance(owner, bytes):
+                owner = owner.decode('utf-8')
+            if owner == self.owner:
+                self.client.delete(lock_key)
+        except Exception as e:
+            print(f"Error liberando llenado en cache Redis: {e}")
+    
+    def stats(self):
+        try:
+            size = self.client.zcard(self.lru_key)
+        except Exception:
+            size = None
+        with self._stats_lock:
+            return {
+                'backend': 'redis',
+                'size': size,
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'stale_ttl': self.stale_ttl,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_rate': self._hit_rate(),
+                'evictions': self.evictions
+            }
+
+class SingleFlight:
+    """Agrupa llamadas concurrentes con la misma clave en una sola ejecución"""
+    class _Call:
+        __slots__ = ('event', 'result', 'error')
+        
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.errors = 0
+    
+    def do(self, key, fn, timeout=None):
+        """Ejecuta fn() una vez por clave; los demás llamadores esperan y reciben el mismo resultado o excepción"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._Call()
+                self._calls[key] = call
+                self.executions += 1
+            else:
+                self.coalesced += 1
+        
+        if leader:
+            try:
+                call.result = fn()
+                return call.result
+            except BaseException as e:
+                call.error = e
+                with self._lock:
+                    self.errors += 1
+                raise
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.event.set()
+        
+        if not call.event.wait(timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError(f"Timeout esperando resultado en curso para {key}")
+        if call.error is not None:
+            raise call.error
+        return call.result
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'executions': self.executions,
+                'coalesced': self.coalesced,
+                'timeouts': self.timeouts,
+                'errors': self.errors
+            }
+
+class SpaceSaving:
+    """Top-k aproximado (algoritmo Space-Saving) con memoria acotada a `capacity` claves"""
+    def __init__(self, capacity=200):
+        self.capacity = max(1, int(capacity))
+        self._counters = {}  # clave -> [conteo, error, payload]
+        self._lock = threading.Lock()
+        self.total = 0
+        self.replacements = 0
+    
+    def record(self, key, payload=None):
+        with self._lock:
+            self.total += 1
+            counter = self._counters.get(key)
+            if counter is not None:
+                counter[0] += 1
+                counter[2] = payload
+                return
+            if len(self._counters) < self.capacity:
+                self._counters[key] = [1, 0, payload]
+                return
+            # Reemplazar la clave menos frecuente heredando su conteo como cota de error
+            victim = min(self._counters, key=lambda k: self._counters[k][0])
+            count = self._counters.pop(victim)[0]
+            self._counters[key] = [count + 1, count, payload]
+            self.replacements += 1
+    
+    def top(self, n):
+        """Devuelve [(clave, conteo, payload)] de las n claves más frecuentes"""
+        with self._lock:
+            items = sorted(self._counters.items(), key=lambda item: item[1][0], reverse=True)[:n]
+            return [(key, counter[0], counter[2]) for key, counter in items]
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'tracked': len(self._counters),
+                'capacity': self.capacity,
+                'total': self.total,
+                'replacements': self.replacements
+            }
+
+def create_cache_backend(max_size, ttl, backend=None, path=None, redis_prefix='pricefinder:cache:', stale_ttl=0):
+    """Crea el backend de cache según SEARCH_CACHE_BACKEND (memory, sqlite, redis)"""
+    backend = (backend or os.environ.get('SEARCH_CACHE_BACKEND', 'memory')).lower()
+    if backend == 'sqlite':
+        path = path or os.environ.get('SEARCH_CACHE_PATH') or os.path.join(tempfile.gettempdir(), 'price_finder_cache.sqlite3')
+        try:
+            cache = SQLiteSearchCache(path, max_size=max_size, ttl=ttl, stale_ttl=stale_ttl)
+            print(f"✅ Cache compartido en SQLite: {path}")
+            return cache
+        except sqlite3.Error as e:
+            print(f"❌ Error abriendo cache SQLite ({e}) - usando cache en memoria")
+    elif backend == 'redis':
+        try:
+            import redis
+            client = redis.Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+            print("✅ Cache compartido en Redis")
+            return RedisSearchCache(client, max_size=max_size, ttl=ttl, prefix=redis_prefix, stale_ttl=stale_ttl)
+        except ImportError:
+            print("⚠️ Paquete redis no disponible - usando cache en memoria")
+    return SearchCache(max_size=max_size, ttl=ttl, stale_ttl=stale_ttl)
+
+# Resultados de búsqueda guardados en el servidor por ID corto (en lugar de la cookie de sesión).
+# SQLite por defecto: /results?id=... debe funcionar en cualquier worker de gunicorn, no solo en el que buscó.
+# Redis si el cache de búsquedas ya lo usa; RESULT_STORE_BACKEND=memory solo para un único proceso.
+RESULT_STORE_BACKEND = os.environ.get('RESULT_STORE_BACKEND') or (
+    'redis' if os.environ.get('SEARCH_CACHE_BACKEND', '').lower() == 'redis' else 'sqlite')
+search_results = create_cache_backend(
+    int(os.environ.get('RESULT_STORE_SIZE', 5000)),
+    int(os.environ.get('RESULT_STORE_TTL', 3600)),
+    backend=RESULT_STORE_BACKEND,
+    path=os.environ.get('RESULT_STORE_PATH') or os.path.join(tempfile.gettempdir(), 'price_finder_results.sqlite3'),
+    redis_prefix='pricefinder:results:'
+)
+
+def save_search_result(query, products, search_type, user_email):
+    """Guarda el resultado y devuelve su ID para /results?id=..."""
+    search_id = secrets.token_urlsafe(9)
+    search_results.set(search_id, {
+        'query': query,
+        'products': products,
+        'timestamp': datetime.now().isoformat(),
+        'user': user_email,
+        'search_type': search_type
+    })
+    return search_id
+
+# ==============================================================================
+# HISTORIAL DE PRECIOS
+# ==============================================================================
+
+def percentile(sorted_values, pct):
+    """Percentil con interpolación lineal sobre una lista ya ordenada"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * pct / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+class PriceHistoryStore:
+    """Observaciones de precio append-only en SQLite; las escrituras se agrupan en un thread de fondo.
+    
+    El mismo thread borra cada `prune_interval` segundos las observaciones con más de `retention_days` días
+    (0 las conserva todas), lo que también acota cuántos precios carga summary() para los percentiles.
+    """
+    PRUNE_CHUNK = 5000
+    
+    def __init__(self, path, batch_size=500, flush_interval=2.0, queue_size=20000, retention_days=30, prune_interval=3600):
+        self.path = path
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.05, float(flush_interval))
+        self.retention_days = max(0.0, float(retention_days))
+        self.prune_interval = max(1.0, float(prune_interval))
+        self._next_prune = 0.0
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._local = threading.local()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+        self.pruned = 0
+        conn = self._connect()
+        conn.execute("""CREATE TABLE IF NOT EXISTS price_observations (
+            query_key TEXT NOT NULL,
+            store TEXT NOT NULL,
+            product_key TEXT NOT NULL,
+            price REAL NOT NULL,
+            observed_at INTEGER NOT NULL
+        )""")
+        # Índices cubrientes: las consultas por rango de tiempo no tocan la tabla
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_price_query_time ON price_observations (query_key, observed_at, price)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_price_query_store_time ON price_observations (query_key, store, observed_at, price)')
+        # Para el borrado por antigüedad, que no filtra por consulta
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_price_time ON price_observations (observed_at)')
+    
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+    
+    def record(self, query_key, products, observed_at=None):
+        """Encola las observaciones de una búsqueda; nunca bloquea la petición"""
+        observed_at = int(observed_at or time.time())
+        rows = []
+        for product in products:
+            price = product.get('price_numeric', 0)
+            # Los precios estimados (la fuente no publicaba precio) no son observaciones reales
+            if not price or price <= 0 or getattr(product, 'price_estimated', False):
+                continue
+            link = product.get('link', '')
+            product_key = link if link and link != '#' else product.get('title', '').lower()
+            rows.append((query_key, product.get('source', '').strip().lower(), product_key[:300], float(price), observed_at))
+        if not rows:
+            return 0
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(rows)
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += len(rows)
+            return 0
+        return len(rows)
+    
+    def reset_after_fork(self):
+        # El thread escritor y las conexiones SQLite del padre no existen en el hijo
+        self._local = threading.local()
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._next_prune = 0.0
+    
+    def _ensure_writer(self):
+        # Thread creado en la primera escritura (después del fork de gunicorn)
+        if self._writer is not None:
+            return
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name='price-history', daemon=True)
+                self._writer.start()
+    
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.extend(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._write(batch)
+            if self.retention_days and time.monotonic() >= self._next_prune:
+                self._next_prune = time.monotonic() + self.prune_interval
+                self.prune()
+    
+    def _write(self, rows):
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN')
+            try:
+                conn.executemany('INSERT INTO price_observations (query_key, store, product_key, price, observed_at) VALUES (?, ?, ?, ?, ?)', rows)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            with self._stats_lock:
+                self.written += len(rows)
+                self.batches += 1
+        except sqlite3.Error as e:
+            print(f"Error escribiendo historial de precios: {e}")
+            with self._stats_lock:
+                self.errors += 1
+                self.dropped += len(rows)
+    
+    def prune(self, now=None):
+        """Borra las observaciones fuera de la ventana de retención, en tandas cortas para no bloquear a otros workers"""
+        cutoff = int((now or time.time()) - self.retention_days * 86400)
+        deleted = 0
+        try:
+            conn = self._connect()
+            while True:
+                cursor = conn.execute('DELETE FROM price_observations WHERE rowid IN '
+                                      '(SELECT rowid FROM price_observations WHERE observed_at < ? LIMIT ?)', (cutoff, self.PRUNE_CHUNK))
+                deleted += cursor.rowcount
+                if cursor.rowcount < self.PRUNE_CHUNK:
+                    break
+        except sqlite3.Error as e:
+            print(f"Error depurando historial de precios: {e}")
+            with self._stats_lock:
+                self.errors += 1
+        with self._stats_lock:
+            self.pruned += deleted
+        return deleted
+    
+    def summary(self, query_key, since, until=None, store=None):
+        """Mínimo, máximo, promedio y percentiles de precio de una consulta en un rango de tiempo.
+        
+        Conteo, suma, mínimo y máximo se agregan en SQLite sobre el índice cubriente; para los percentiles
+        solo se trae la columna de precios (ordenarla en Python es más rápido que ORDER BY o ROW_NUMBER en SQLite).
+        """
+        until = int(until or time.time())
+        where = 'query_key = ?'
+        params = [query_key]
+        if store:
+            where += ' AND store = ?'
+            params.append(store.strip().lower())
+        where += ' AND observed_at BETWEEN ? AND ? AND price > 0'
+        params.extend([int(since), until])
+        conn = self._connect()
+        count, total, lowest, highest = conn.execute(
+            f'SELECT COUNT(*), SUM(price), MIN(price), MAX(price) FROM price_observations WHERE {where}', params).fetchone()
+        if not count:
+            return {'count': 0}
+        prices = sorted(row[0] for row in conn.execute(f'SELECT price FROM price_observations WHERE {where}', params))
+        return _summary(count, total, lowest, highest, [percentile(prices, pct) for pct in STATS_PERCENTILES], 0)
+    
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'backend': 'sqlite',
+                'queued_batches': self._queue.qsize(),
+                'written': self.written,
+                'batches': self.batches,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'pruned': self.pruned,
+                'retention_days': self.retention_days
+            }
+
+def create_price_history():
+    """Historial en PRICE_HISTORY_PATH; PRICE_HISTORY_ENABLED=0 lo desactiva"""
+    if os.environ.get('PRICE_HISTORY_ENABLED', '1').lower() in ('0', 'false', 'no'):
+        return None
+    path = os.environ.get('PRICE_HISTORY_PATH') or os.path.join(tempfile.gettempdir(), 'price_finder_history.sqlite3')
+    try:
+        return PriceHistoryStore(
+            path,
+            batch_size=int(os.environ.get('PRICE_HISTORY_BATCH_SIZE', 500)),
+            flush_interval=float(os.environ.get('PRICE_HISTORY_FLUSH_SECONDS', 2)),
+            retention_days=float(os.environ.get('PRICE_HISTORY_RETENTION_DAYS', 30)),
+            prune_interval=float(os.environ.get('PRICE_HISTORY_PRUNE_SECONDS', 3600))
+        )
+    except sqlite3.Error as e:
+        print(f"❌ Error abriendo historial de precios ({e}) - historial desactivado")
+        return None
+
+price_history = create_price_history()
+
+# ==============================================================================
+# LIMITE DE TASA PARA SERPAPI
+# ==============================================================================
+
+class TokenBucket:
+    """Token bucket por proceso: admisión inmediata dentro del presupuesto, cola con deadline si se excede"""
+    def __init__(self, rate, burst):
+        self.rate = max(0.001, float(rate))
+        self.capacity = max(1.0, float(burst))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+    
+    def _reserve(self, timeout):
+        """Reserva un token; devuelve los segundos a esperar o None si excede el timeout"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if wait > timeout:
+                self.rejected += 1
+                return None
+            # Los tokens pueden quedar negativos: las reservas posteriores esperan en orden
+            self._tokens -= 1
+            if wait > 0:
+                self.queued += 1
+            else:
+                self.admitted += 1
+            return wait
+    
+    def acquire(self, timeout=0):
+        wait = self._reserve(timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+    
+    def reset_after_fork(self):
+        pass
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'rate': self.rate,
+                'burst': self.capacity,
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected': self.rejected
+            }
+
+class SQLiteTokenBucket(TokenBucket):
+    """Token bucket compartido entre los workers del host mediante SQLite"""
+    def __init__(self, rate, burst, path, name='serpapi'):
+        super().__init__(rate, burst)
+        self.path = path
+        self.name = name
+        self._local = threading.local()
+        self._connect().execute('CREATE TABLE IF NOT EXISTS token_buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+    
+    def reset_after_fork(self):
+        self._local = threading.local()
+    
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+    
+    def _reserve(self, timeout):
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = conn.execute('SELECT tokens, updated FROM token_buckets WHERE name = ?', (self.name,)).fetchone()
+                tokens = self.capacity if row is None else min(self.capacity, row[0] + max(0.0, now - row[1]) * self.rate)
+                wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+                if wait <= timeout:
+                    tokens -= 1
+                conn.execute('INSERT OR REPLACE INTO token_buckets (name, tokens, updated) VALUES (?, ?, ?)', (self.name, tokens, now))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            print(f"Error en limitador compartido ({e}) - usando limitador local")
+            return super()._reserve(timeout)
+        with self._lock:
+            if wait > timeout:
+                self.rejected += 1
+                return None
+            if wait > 0:
+                self.queued += 1
+            else:
+                self.admitted += 1
+        return wait
+    
+    def stats(self):
+        data = super().stats()
+        data['backend'] = 'sqlite'
+        return data
+
+def create_rate_limiter():
+    """Limitador de SerpAPI según SERPAPI_QPS / SERPAPI_BURST; compartido si hay SERPAPI_RATE_LIMIT_PATH"""
+    rate = float(os.environ.get('SERPAPI_QPS', 5))
+    burst = float(os.environ.get('SERPAPI_BURST', 10))
+    path = os.environ.get('SERPAPI_RATE_LIMIT_PATH')
+    if path:
+        try:
+            return SQLiteTokenBucket(rate, burst, path)
+        except sqlite3.Error as e:
+            print(f"❌ Error abriendo limitador compartido ({e}) - usando limitador local")
+    return TokenBucket(rate, burst)
+
+class CacheWarmer:
+    """Refresca periódicamente las consultas más populares antes de que se enfríen, con un presupuesto de llamadas por hora"""
+    def __init__(self, finder, top_n=0, interval=60, budget_per_hour=120):
+        self.finder = finder
+        self.top_n = max(0, int(top_n))
+        self.interval = max(1.0, float(interval))
+        self.budget = TokenBucket(max(0.001, float(budget_per_hour)) / 3600, max(1, self.top_n))
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.cycles = 0
+        self.refreshed = 0
+        self.skipped_budget = 0
+        self.errors = 0
+    
+    @property
+    def enabled(self):
+        return self.top_n > 0
+    
+    def ensure_started(self):
+        """Arranca el thread en la primera búsqueda (no al importar, para no crear threads antes del fork de gunicorn)"""
+        if not self.enabled or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cache-warmer', daemon=True)
+                self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+    
+    def reset_after_fork(self):
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
             try:
-                login_time = datetime.fromisoformat(session['login_time'])
-                time_diff = (datetime.now() - login_time).total_seconds()
-                if time_diff > 7200:  # 2 horas maximo
-                    return False
-            except:
-                pass
-        return True
+                self.warm_once()
+            except Exception as e:
+                self.errors += 1
+                print(f"❌ Error en precalentamiento de cache: {e}")
     
-    def get_current_user(self):
-        if not self.is_user_logged_in():
-            return None
+    def warm_once(self):
+        """Refresca las top-N consultas ausentes o vencidas; devuelve cuántas se refrescaron"""
+        self.cycles += 1
+        refreshed = 0
+        for key, count, payload in self.finder.popular.top(self.top_n):
+            value, stale = self.finder.cache.lookup(key, record=False)
+            if value is not None and not stale:
+                continue
+            if not self.budget.acquire(timeout=0):
+                self.skipped_budget += 1
+                break
+            if self.finder.refresh(key, *payload):
+                refreshed += 1
+        self.refreshed += refreshed
+        return refreshed
+    
+    def stats(self):
         return {
-            'user_id': session.get('user_id'),
-            'user_name': session.get('user_name'),
-            'user_email': session.get('user_email'),
-            'id_token': session.get('id_token')
+            'enabled': self.enabled,
+            'running': self._thread is not None and self._thread.is_alive(),
+            'top_n': self.top_n,
+            'interval': self.interval,
+            'budget_per_hour': round(self.budget.rate * 3600, 1),
+            'cycles': self.cycles,
+            'refreshed': self.refreshed,
+            'skipped_budget': self.skipped_budget,
+            'errors': self.errors
         }
 
-firebase_auth = FirebaseAuth()
+# Pool compartido para consultar varios motores de SerpAPI en paralelo
+SEARCH_FANOUT_WORKERS = int(os.environ.get('SEARCH_FANOUT_WORKERS', 8))
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_FANOUT_WORKERS, thread_name_prefix='serpapi')
 
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if not firebase_auth.is_user_logged_in():
-            flash('Tu sesion ha expirado. Inicia sesion nuevamente.', 'warning')
-            return redirect(url_for('auth_login_page'))
-        return f(*args, **kwargs)
-    return decorated_function
+# Pool pequeño para refrescar entradas vencidas sin bloquear al usuario (stale-while-revalidate)
+CACHE_REFRESH_WORKERS = int(os.environ.get('CACHE_REFRESH_WORKERS', 2))
+refresh_executor = ThreadPoolExecutor(max_workers=CACHE_REFRESH_WORKERS, thread_name_prefix='cache-refresh')
+
+# Clave de resultados por motor de SerpAPI soportado
+RESULTS_KEYS = {
+    'google_shopping': 'shopping_results',
+    'bing_shopping': 'shopping_results'
+}
+
+# Parámetros propios de cada motor (además de q y location): cada API de SerpAPI tiene los suyos.
+# walmart (query), ebay (_nkw) y google (organic_results) no están: sus resultados no traen price/source
+# como los lee _process_results y cada producto terminaría con un precio inventado junto a ofertas reales
+ENGINE_PARAMS = {
+    'google_shopping': {'gl': 'us', 'num': 5},
+    'bing_shopping': {'cc': 'US', 'count': 5}
+}
 
 # ==============================================================================
-# FUNCIONES DE BÚSQUEDA POR IMAGEN
+# PRODUCTOS
 # ==============================================================================
 
-def analyze_image_with_gemini(image_content):
-    """Analiza imagen con Gemini Vision"""
-    if not GEMINI_READY or not PIL_AVAILABLE or not image_content:
-        print("❌ Gemini o PIL no disponible para análisis de imagen")
+def _to_number(value):
+    """Número tal como viene de SerpAPI (int/float) o texto numérico; None si no hay"""
+    if value is None or value == '' or isinstance(value, bool):
         return None
-    
+    if isinstance(value, (int, float)):
+        return value
     try:
-        # Convertir bytes a PIL Image
-        image = Image.open(io.BytesIO(image_content))
-        
-        # Optimizar imagen
-        max_size = (1024, 1024)
-        if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        print("🖼️ Analizando imagen con Gemini Vision...")
-        
-        prompt = """
-        Analiza esta imagen de producto y genera una consulta de búsqueda específica en inglés para encontrarlo en tiendas online.
-        
-        Incluye:
-        - Nombre exacto del producto
-        - Marca (si es visible)
-        - Modelo o características distintivas
-        - Color, tamaño
-        - Categoría del producto
-        
-        Responde SOLO con la consulta de búsqueda optimizada para e-commerce.
-        Ejemplo: "blue tape painter's tape 2 inch width"
-        """
-        
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        response = model.generate_content([prompt, image])
-        
-        if response.text:
-            search_query = response.text.strip()
-            print(f"🧠 Consulta generada desde imagen: '{search_query}'")
-            return search_query
-        
-        return None
-            
-    except Exception as e:
-        print(f"❌ Error analizando imagen: {e}")
+        text = str(value).replace(',', '').strip()
+        return int(text) if text.isdigit() else float(text)
+    except ValueError:
         return None
 
-def validate_image(image_content):
-    """Valida imagen"""
-    if not PIL_AVAILABLE or not image_content:
-        return False
+class Product:
+    """Resultado de búsqueda compacto: campos numéricos tipados y textos de visualización calculados al leerlos.
     
+    Conserva la interfaz de diccionario (get, [], keys) y el mismo JSON que los dicts anteriores.
+    Modificar con product[clave] = valor para invalidar el JSON memorizado."""
+    __slots__ = ('title', 'price_numeric', 'source', 'link', 'rating_value', 'review_count', 'image',
+                 'search_source', 'original_query', 'price_estimated', '_price_text', '_json')
+    
+    KEYS = ('title', 'price', 'price_numeric', 'source', 'link', 'rating', 'reviews', 'image', 'search_source', 'original_query')
+    
+    def __init__(self, title, price_numeric, source, link, rating=None, reviews=None, image='',
+                 search_source=None, original_query=None, price_text=None, price_estimated=False):
+        self.title = title
+        self.price_numeric = float(price_numeric)
+        # Precio inventado por _generate_realistic_price: se muestra, pero no es una observación real
+        self.price_estimated = price_estimated
+        self.source = source
+        self.link = link
+        self.rating_value = _to_number(rating)
+        self.review_count = _to_number(reviews)
+        self.image = image
+        self.search_source = search_source
+        self.original_query = original_query
+        # El texto original solo se guarda si difiere del formato estándar
+        self._price_text = price_text if price_text and price_text != f'${self.price_numeric:.2f}' else None
+        self._json = None
+    
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('title', ''), data.get('price_numeric', 0), data.get('source', ''), data.get('link', '#'),
+                   data.get('rating'), data.get('reviews'), data.get('image', ''),
+                   data.get('search_source'), data.get('original_query'), data.get('price'))
+    
+    @property
+    def price(self):
+        return self._price_text or f'${self.price_numeric:.2f}'
+    
+    @price.setter
+    def price(self, value):
+        self._price_text = str(value) if value else None
+    
+    @property
+    def rating(self):
+        return '' if self.rating_value is None else str(self.rating_value)
+    
+    @rating.setter
+    def rating(self, value):
+        self.rating_value = _to_number(value)
+    
+    @property
+    def reviews(self):
+        return '' if self.review_count is None else str(self.review_count)
+    
+    @reviews.setter
+    def reviews(self, value):
+        self.review_count = _to_number(value)
+    
+    def keys(self):
+        return [key for key in self.KEYS if key not in ('search_source', 'original_query') or getattr(self, key) is not None]
+    
+    def __contains__(self, key):
+        return key in self.keys()
+    
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+        self._json = None
+    
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.KEYS else None
+        return default if value is None else value
+    
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.keys()}
+    
+    def to_json(self):
+        """JSON del producto, memorizado: los resultados en cache se serializan una sola vez"""
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), separators=(',', ':'))
+        return self._json
+    
+    def __repr__(self):
+        return f"Product({self.title!r}, {self.price!r}, {self.source!r})"
+
+_JSON_FRAGMENT_RE = re.compile(r'"\\u0000(\d+):(\d+)"')
+
+def dumps_json(payload):
+    """json.dumps que inserta el JSON memorizado de cada Product en lugar de reconstruir sus diccionarios"""
+    fragments = []
+    nonce = id(fragments)
+    
+    def default(obj):
+        if isinstance(obj, Product):
+            fragments.append(obj.to_json())
+            return f'\x00{nonce}:{len(fragments) - 1}'
+        raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+    
+    body = json.dumps(payload, default=default, separators=(',', ':'))
+    if not fragments:
+        return body
+    return _JSON_FRAGMENT_RE.sub(lambda m: fragments[int(m.group(2))] if int(m.group(1)) == nonce else m.group(0), body)
+
+def json_response(payload, status=200):
+    return app.response_class(dumps_json(payload) + '\n', status=status, mimetype='application/json')
+
+class AppJSONProvider(DefaultJSONProvider):
+    """jsonify() acepta Product además de los tipos habituales"""
+    @staticmethod
+    def default(obj):
+        if isinstance(obj, Product):
+            return obj.to_dict()
+        return DefaultJSONProvider.default(obj)
+
+app.json = AppJSONProvider(app)
+
+# ==============================================================================
+# RANKING Y ESTADÍSTICAS DE PRECIOS
+# ==============================================================================
+
+# Reputación de tienda (0-1); las no listadas usan DEFAULT_STORE_REPUTATION
+STORE_REPUTATION = {
+    'amazon': 1.0, 'walmart': 0.95, 'target': 0.95, 'best buy': 0.95, 'costco': 0.95,
+    'home depot': 0.9, "lowe's": 0.9, 'newegg': 0.85, 'b&h': 0.85, 'ebay': 0.75
+}
+DEFAULT_STORE_REPUTATION = 0.6
+
+# RANKING_MODE=price mantiene el orden por precio (solo se descartan outliers)
+RANKING_PROFILES = {
+    'score': {'price': 0.55, 'rating': 0.2, 'reviews': 0.1, 'store': 0.15},
+    'price': {'price': 1.0, 'rating': 0.0, 'reviews': 0.0, 'store': 0.0}
+}
+RANKING_WEIGHTS = RANKING_PROFILES.get(os.environ.get('RANKING_MODE', 'score'), RANKING_PROFILES['score'])
+
+# Umbral del z-score modificado (mediana/MAD) para descartar precios atípicos
+OUTLIER_MAD_THRESHOLD = float(os.environ.get('OUTLIER_MAD_THRESHOLD', 3.5))
+STATS_PERCENTILES = (25, 50, 75, 90)
+# Por debajo de este tamaño el costo fijo de NumPy supera al bucle en Python
+NUMPY_MIN_CANDIDATES = int(os.environ.get('NUMPY_MIN_CANDIDATES', 100))
+
+_reputation_memo = {}
+
+def store_reputation(source):
+    reputation = _reputation_memo.get(source)
+    if reputation is not None:
+        return reputation
+    name = str(source or '').strip().lower()
+    reputation = STORE_REPUTATION.get(name)
+    if reputation is None:
+        reputation = next((value for store, value in STORE_REPUTATION.items() if store in name), DEFAULT_STORE_REPUTATION)
+    if len(_reputation_memo) < 4096:
+        _reputation_memo[source] = reputation
+    return reputation
+
+def _to_float(value):
+    if type(value) is float:
+        return value
+    if not value:
+        return 0.0
     try:
-        image = Image.open(io.BytesIO(image_content))
-        if image.size[0] < 10 or image.size[1] < 10:
-            return False
-        if image.format not in ['JPEG', 'PNG', 'WEBP']:
-            return False
-        return True
-    except:
-        return False
+        return float(value)
+    except (TypeError, ValueError):
+        try:
+            return float(str(value).replace(',', ''))
+        except ValueError:
+            return 0.0
+
+def product_columns(products):
+    """Representación columnar de los candidatos: (precios, ratings, reseñas, reputación) en un solo recorrido"""
+    prices, ratings, reviews, reputations = [], [], [], []
+    for product in products:
+        if type(product) is Product:
+            prices.append(product.price_numeric)
+            ratings.append(product.rating_value or 0.0)
+            reviews.append(product.review_count or 0.0)
+            reputations.append(store_reputation(product.source))
+            continue
+        prices.append(_to_float(product.get('price_numeric')))
+        ratings.append(_to_float(product.get('rating')))
+        reviews.append(_to_float(product.get('reviews')))
+        reputations.append(store_reputation(product.get('source', '')))
+    return prices, ratings, reviews, reputations
+
+def _summary(count, total, lowest, highest, quantiles, outliers):
+    return {
+        'count': count,
+        'min_price': round(lowest, 2),
+        'max_price': round(highest, 2),
+        'avg_price': round(total / count, 2),
+        **{f'p{pct}': round(value, 2) for pct, value in zip(STATS_PERCENTILES, quantiles)},
+        'outliers': outliers
+    }
+
+def _sorted_percentiles(values, pcts):
+    """Percentiles con interpolación lineal sobre un arreglo ya ordenado (evita np.percentile por llamada)"""
+    positions = (values.size - 1) * np.asarray(pcts, dtype=float) / 100.0
+    lower = positions.astype(int)
+    upper = np.minimum(lower + 1, values.size - 1)
+    return values[lower] + (values[upper] - values[lower]) * (positions - lower)
+
+def _rank_numpy(prices, ratings, reviews, reputations, weights):
+    p = np.asarray(prices, dtype=float)
+    valid = p > 0
+    inlier = valid.copy()
+    if valid.sum() >= 4:
+        median = _sorted_percentiles(np.sort(p[valid]), (50,))[0]
+        mad = _sorted_percentiles(np.sort(np.abs(p[valid] - median)), (50,))[0]
+        if mad > 0:
+            inlier &= 0.6745 * np.abs(p - median) / mad <= OUTLIER_MAD_THRESHOLD
+    kept = np.sort(p[inlier])
+    if not kept.size:
+        return list(range(len(prices))), None
+    lowest, highest = kept[0], kept[-1]
+    price_score = np.clip((highest - p) / (highest - lowest), 0, 1) if highest > lowest else np.ones_like(p)
+    r = np.asarray(reviews, dtype=float)
+    review_score = np.log1p(r) / np.log1p(r.max()) if r.max() > 0 else np.zeros_like(r)
+    score = (weights['price'] * price_score
+             + weights['rating'] * np.clip(np.asarray(ratings, dtype=float) / 5, 0, 1)
+             + weights['reviews'] * review_score
+             + weights['store'] * np.asarray(reputations, dtype=float))
+    # Los atípicos van al final: solo se muestran si faltan candidatos
+    score = np.where(inlier, score, score - 10)
+    order = np.argsort(-score, kind='stable').tolist()
+    stats = _summary(int(kept.size), float(kept.sum()), float(lowest), float(highest),
+                     _sorted_percentiles(kept, STATS_PERCENTILES).tolist(), int(valid.sum() - kept.size))
+    return order, stats
+
+def _rank_python(prices, ratings, reviews, reputations, weights):
+    valid = [p > 0 for p in prices]
+    inlier = list(valid)
+    valid_prices = sorted(p for p in prices if p > 0)
+    if len(valid_prices) >= 4:
+        median = percentile(valid_prices, 50)
+        mad = percentile(sorted(abs(p - median) for p in valid_prices), 50)
+        if mad > 0:
+            inlier = [ok and 0.6745 * abs(p - median) / mad <= OUTLIER_MAD_THRESHOLD for ok, p in zip(valid, prices)]
+    kept = sorted(p for p, ok in zip(prices, inlier) if ok)
+    if not kept:
+        return list(range(len(prices))), None
+    lowest, highest = kept[0], kept[-1]
+    max_reviews = max(reviews)
+    review_norm = math.log1p(max_reviews) if max_reviews > 0 else 0
+    scores = []
+    for p, rating, count, reputation, ok in zip(prices, ratings, reviews, reputations, inlier):
+        price_score = min(1.0, max(0.0, (highest - p) / (highest - lowest))) if highest > lowest else 1.0
+        score = (weights['price'] * price_score
+                 + weights['rating'] * min(1.0, max(0.0, rating / 5))
+                 + weights['reviews'] * (math.log1p(count) / review_norm if review_norm else 0.0)
+                 + weights['store'] * reputation)
+        scores.append(score if ok else score - 10)
+    order = sorted(range(len(prices)), key=lambda i: -scores[i])
+    stats = _summary(len(kept), sum(kept), lowest, highest,
+                     [percentile(kept, pct) for pct in STATS_PERCENTILES], sum(valid) - len(kept))
+    return order, stats
+
+def rank_products(products, limit=6, weights=None):
+    """Ordena por puntaje compuesto (precio, rating, reseñas, tienda) descartando precios atípicos; devuelve (ranking, stats)"""
+    if not products:
+        return [], None
+    columns = product_columns(products)
+    rank = _rank_numpy if NUMPY_AVAILABLE and len(products) >= NUMPY_MIN_CANDIDATES else _rank_python
+    order, stats = rank(*columns, weights or RANKING_WEIGHTS)
+    return [products[i] for i in order[:limit]], stats
+
+def price_summary(prices):
+    """Estadísticas de una lista de precios (sin descartar atípicos)"""
+    prices = [p for p in prices if p > 0]
+    if not prices:
+        return None
+    if NUMPY_AVAILABLE and len(prices) >= NUMPY_MIN_CANDIDATES:
+        values = np.sort(np.asarray(prices, dtype=float))
+        return _summary(int(values.size), float(values.sum()), float(values[0]), float(values[-1]),
+                        _sorted_percentiles(values, STATS_PERCENTILES).tolist(), 0)
+    prices.sort()
+    return _summary(len(prices), sum(prices), prices[0], prices[-1], [percentile(prices, pct) for pct in STATS_PERCENTILES], 0)
 
 # Price Finder Class - MODIFICADO para búsqueda por imagen
 class PriceFinder:
@@ -228,10 +2527,40 @@ class PriceFinder:
             os.environ.get('SERPAPI')
         )
         
-        self.base_url = "https://serpapi.com/search"
-        self.cache = {}
-        self.cache_ttl = 180
+        self.base_url = os.environ.get('SERPAPI_BASE_URL', "https://serpapi.com/search")
+        self.cache_ttl = int(os.environ.get('SEARCH_CACHE_TTL', 180))
+        self.cache = create_cache_backend(
+            int(os.environ.get('SEARCH_CACHE_SIZE', 256)),
+            self.cache_ttl,
+            stale_ttl=int(os.environ.get('SEARCH_CACHE_STALE_TTL', 600))
+        )
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+        self.popular = SpaceSaving(int(os.environ.get('CACHE_POPULARITY_CAPACITY', 200)))
+        self.warmer = CacheWarmer(
+            self,
+            top_n=int(os.environ.get('CACHE_WARM_TOP_N', 0)),
+            interval=float(os.environ.get('CACHE_WARM_INTERVAL', 60)),
+            budget_per_hour=float(os.environ.get('CACHE_WARM_BUDGET_PER_HOUR', 120))
+        )
+        self.cache_fill_wait = float(os.environ.get('SEARCH_CACHE_FILL_WAIT', 6))
+        self.inflight = SingleFlight()
+        self.inflight_wait = float(os.environ.get('SEARCH_INFLIGHT_WAIT', 12))
         self.timeouts = {'connect': 3, 'read': 8}
+        engines = [e.strip() for e in os.environ.get('SERPAPI_ENGINES', 'google_shopping').split(',') if e.strip()]
+        unsupported = [e for e in engines if e not in ENGINE_PARAMS]
+        if unsupported:
+            print(f"⚠️ Motores de SerpAPI no soportados ignorados: {', '.join(unsupported)} (soportados: {', '.join(ENGINE_PARAMS)})")
+        self.engines = [e for e in engines if e in ENGINE_PARAMS] or ['google_shopping']
+        self.locations = [l.strip() for l in os.environ.get('SERPAPI_LOCATIONS', 'United States').split('|') if l.strip()]
+        self.search_budget = float(os.environ.get('SEARCH_BUDGET_SECONDS', 8))
+        self.http = create_http_session(retries=int(os.environ.get('SERPAPI_RETRIES', 2)))
+        # Sin reintentos: para cuando el deadline no alcanza para un segundo intento
+        self.http_once = create_http_session(retries=0)
+        self.rate_limiter = create_rate_limiter()
+        self.rate_limit_wait = float(os.environ.get('SERPAPI_RATE_LIMIT_WAIT', 2))
+        self.breaker = CircuitBreaker('serpapi', min_timeout=1.0, max_timeout=self.timeouts['read'])
+        self.fallback_cache_ttl = 15
         self.blacklisted_stores = ['alibaba', 'aliexpress', 'temu', 'wish', 'banggood', 'dhgate', 'falabella', 'ripley', 'linio', 'mercadolibre']
         
         if not self.api_key:
@@ -290,26 +2619,62 @@ class PriceFinder:
             return f"https://www.google.com/search?tbm=shop&q={search_query}"
         return "#"
     
-    def _make_api_request(self, engine, query):
+    def _make_api_request(self, engine, query, location='United States', deadline=None):
         if not self.api_key:
             return None
+        deadline = deadline or Deadline(self.search_budget)
+        if deadline.skip('serpapi'):
+            return None
+        
+        # SerpAPI degradado: no ocupar el worker esperando el timeout completo
+        if not self.breaker.allow():
+            UPSTREAM_RESPONSES.inc('serpapi', engine, 'circuit_open')
+            return None
+        
+        with STAGE_SECONDS.time('rate_limit_wait'):
+            admitted = self.rate_limiter.acquire(deadline.timeout(self.rate_limit_wait))
+        if not admitted:
+            # La sonda half-open no llegó a salir: no cuenta como fallo del servicio
+            self.breaker.release_probe()
+            UPSTREAM_RESPONSES.inc('serpapi', engine, 'rate_limited')
+            print(f"⏳ Límite de tasa de SerpAPI excedido - omitiendo {engine}")
+            return None
+        if deadline.skip('serpapi', 0.1):
+            self.breaker.release_probe()
+            return None
         
-        params = {'engine': engine, 'q': query, 'api_key': self.api_key, 'num': 5, 'location': 'United States', 'gl': 'us'}
+        params = {'engine': engine, 'q': query, 'api_key': self.api_key, 'location': location, **ENGINE_PARAMS[engine]}
+        breaker_timeout = self.breaker.timeout()
+        read_timeout = max(0.1, deadline.timeout(breaker_timeout))
+        connect_timeout = min(self.timeouts['connect'], read_timeout)
+        # Los reintentos en 429/5xx solo si caben dentro del deadline
+        http = self.http if deadline.remaining() >= 2 * read_timeout else self.http_once
+        started = time.perf_counter()
         try:
-            time.sleep(0.3)
-            response = requests.get(self.base_url, params=params, timeout=(self.timeouts['connect'], self.timeouts['read']))
+            response = http.get(self.base_url, params=params, timeout=(connect_timeout, read_timeout))
+            UPSTREAM_RESPONSES.inc('serpapi', engine, str(response.status_code))
+            # 5xx y 429 indican un servicio degradado; otros códigos son respuestas válidas del servicio
+            if response.status_code >= 500 or response.status_code == 429:
+                self.breaker.record_failure()
+                return None
+            self.breaker.record_success(time.perf_counter() - started)
             if response.status_code != 200:
                 return None
             return response.json()
         except Exception as e:
+            record_upstream_failure(self.breaker, e, 'serpapi', read_timeout < breaker_timeout)
+            UPSTREAM_RESPONSES.inc('serpapi', engine, type(e).__name__)
             print(f"Error en request: {e}")
             return None
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, 'serpapi', engine)
     
+    @timed('process_results')
     def _process_results(self, data, engine):
         if not data:
             return []
         products = []
-        results_key = 'shopping_results' if engine == 'google_shopping' else 'organic_results'
+        results_key = RESULTS_KEYS[engine]
         if results_key not in data:
             return []
         
@@ -323,20 +2688,21 @@ class PriceFinder:
                 
                 price_str = item.get('price', '')
                 price_num = self._extract_price(price_str)
-                if price_num == 0:
+                estimated = price_num == 0
+                if estimated:
                     price_num = self._generate_realistic_price(title, len(products))
                     price_str = f"${price_num:.2f}"
                 
-                products.append({
-                    'title': self._clean_text(title),
-                    'price': str(price_str),
-                    'price_numeric': float(price_num),
-                    'source': self._clean_text(item.get('source', 'Tienda')),
-                    'link': self._get_valid_link(item),
-                    'rating': str(item.get('rating', '')),
-                    'reviews': str(item.get('reviews', '')),
-                    'image': ''
-                })
+                products.append(Product(
+                    title=self._clean_text(title),
+                    price_numeric=price_num,
+                    source=self._clean_text(item.get('source', 'Tienda')),
+                    link=self._get_valid_link(item),
+                    rating=item.get('rating'),
+                    reviews=item.get('reviews'),
+                    price_text=str(price_str),
+                    price_estimated=estimated
+                ))
                 if len(products) >= 3:
                     break
             except Exception as e:
@@ -344,17 +2710,27 @@ class PriceFinder:
                 continue
         return products
     
-    def search_products(self, query=None, image_content=None):
-        """Búsqueda mejorada con soporte para imagen"""
+    @timed('search')
+    def search_products(self, query=None, image_content=None, on_event=None, deadline=None):
+        """Búsqueda mejorada con soporte para imagen; on_event(evento, datos) recibe resultados parciales.
+        
+        `deadline` acota la búsqueda completa; sin él se usa SEARCH_DEADLINE_SECONDS desde ahora.
+        """
+        deadline = deadline or Deadline()
+        
         # Determinar consulta final
         final_query = None
         search_source = "text"
         
         if image_content and GEMINI_READY and PIL_AVAILABLE:
-            if validate_image(image_content):
+            # Validación por cabecera (formato y dimensiones) sin decodificar píxeles
+            with STAGE_SECONDS.time('validate_image'):
+                upload = open_image_upload(image_content)
+                valid = bool(upload and upload.is_valid())
+            if valid:
                 if query:
                     # Texto + imagen
-                    image_query = analyze_image_with_gemini(image_content)
+                    image_query = analyze_image_with_gemini(upload, deadline)
                     if image_query:
                         final_query = f"{query} {image_query}"
                         search_source = "combined"
@@ -365,7 +2741,7 @@ class PriceFinder:
                         print(f"📝 Imagen falló, usando solo texto")
                 else:
                     # Solo imagen
-                    final_query = analyze_image_with_gemini(image_content)
+                    final_query = analyze_image_with_gemini(upload, deadline)
                     search_source = "image"
                     print(f"🖼️ Búsqueda basada en imagen")
             else:
@@ -384,44 +2760,180 @@ class PriceFinder:
         
         final_query = final_query.strip()
         print(f"📝 Búsqueda final: '{final_query}' (fuente: {search_source})")
+        if on_event:
+            on_event('query', {'query': final_query, 'source': search_source})
         
         # Continuar con lógica de búsqueda existente
         if not self.api_key:
             print("Sin API key - usando ejemplos")
             return self._get_examples(final_query)
         
-        cache_key = f"search_{hash(final_query.lower())}"
-        if cache_key in self.cache:
-            cache_data, timestamp = self.cache[cache_key]
-            if (time.time() - timestamp) < self.cache_ttl:
-                return cache_data
+        cache_key = normalize_query_key(final_query, record=True)
+        self.popular.record(cache_key, (final_query, query, search_source))
+        self.warmer.ensure_started()
+        with STAGE_SECONDS.time('cache_lookup'):
+            cached, stale = self.cache.lookup(cache_key)
+        CACHE_REQUESTS.inc('search', 'miss' if cached is None else 'stale' if stale else 'hit')
+        if cached is not None:
+            if stale:
+                # Stale-while-revalidate: responder ya con la entrada vencida y refrescarla en segundo plano
+                self._refresh_in_background(cache_key, final_query, query, search_source)
+            return cached
         
-        start_time = time.time()
-        all_products = []
+        # SerpAPI degradado: responder de inmediato con ejemplos en lugar de ocupar el worker
+        if self.breaker.is_open:
+            print("🔌 SerpAPI no disponible (circuit breaker abierto) - usando ejemplos")
+            return self._get_examples(final_query)
         
-        if time.time() - start_time < 8:
-            query_optimized = f'"{final_query}" buy online'
-            data = self._make_api_request('google_shopping', query_optimized)
-            products = self._process_results(data, 'google_shopping')
-            all_products.extend(products)
+        # Presupuesto agotado (p. ej. por Gemini): responder con ejemplos sin guardarlos en cache
+        if deadline.skip('fan_out'):
+            print("⏱️ Deadline agotado antes de consultar SerpAPI - usando ejemplos")
+            return self._get_examples(final_query)
         
-        if not all_products:
-            all_products = self._get_examples(final_query)
+        # Búsquedas idénticas en curso dentro del proceso comparten una sola consulta a SerpAPI
+        try:
+            products = self.inflight.do(
+                cache_key,
+                lambda: self._fetch_and_cache(cache_key, final_query, query, search_source, on_event, deadline=deadline),
+                timeout=deadline.timeout(self.inflight_wait)
+            )
+        except TimeoutError as e:
+            print(f"⏱️ {e} - usando ejemplos")
+            return self._get_examples(final_query)
+        if products is None:
+            # Se unió a un refresco en segundo plano que no obtuvo resultados
+            products = self.cache.lookup(cache_key, record=False)[0] or self._get_examples(final_query)
+        return products
+    
+    def _refresh_in_background(self, cache_key, final_query, query, search_source):
+        with self._refreshing_lock:
+            if cache_key in self._refreshing:
+                return
+            self._refreshing.add(cache_key)
+        try:
+            refresh_executor.submit(self.refresh, cache_key, final_query, query, search_source)
+        except RuntimeError:
+            with self._refreshing_lock:
+                self._refreshing.discard(cache_key)
+    
+    def refresh(self, cache_key, final_query, query, search_source):
+        """Vuelve a consultar SerpAPI para una entrada; si falla conserva la entrada vencida. Devuelve True si se actualizó"""
+        try:
+            return self.inflight.do(
+                cache_key,
+                lambda: self._fetch_and_cache(cache_key, final_query, query, search_source, refresh=True),
+                timeout=self.inflight_wait
+            ) is not None
+        except Exception as e:
+            print(f"❌ Error refrescando '{final_query}': {e}")
+            return False
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(cache_key)
+    
+    def _fetch_and_cache(self, cache_key, final_query, query, search_source, on_event=None, refresh=False, deadline=None):
+        """Consulta SerpAPI para la consulta final y guarda el resultado en cache"""
+        deadline = deadline or Deadline()
+        # Single-flight entre workers: si otro worker ya está consultando, esperar su resultado
+        filling = self.cache.acquire_fill(cache_key)
+        if not filling:
+            if refresh:
+                # Otro worker ya está refrescando esta clave
+                return None
+            cached = self.cache.wait_for(cache_key, deadline.timeout(self.cache_fill_wait))
+            if cached is not None:
+                return cached
         
-        all_products.sort(key=lambda x: x['price_numeric'])
-        final_products = all_products[:6]
+        try:
+            with STAGE_SECONDS.time('fan_out'):
+                all_products = self._fan_out(final_query, on_event=on_event, deadline=deadline)
+            
+            from_upstream = bool(all_products)
+            if from_upstream and price_history:
+                # Todas las observaciones (no solo las 6 mostradas) van al historial en segundo plano
+                price_history.record(cache_key, all_products)
+            if not all_products:
+                if refresh:
+                    # Un refresco fallido no reemplaza resultados reales vencidos por ejemplos
+                    return None
+                all_products = self._get_examples(final_query)
+            
+            with STAGE_SECONDS.time('rank'):
+                final_products, _ = rank_products(all_products, limit=6)
+            
+            # Añadir metadata
+            for product in final_products:
+                product['search_source'] = search_source
+                product['original_query'] = query if query else "imagen"
+            
+            # Los ejemplos de respaldo se guardan poco tiempo y sin ventana stale para no ocultar resultados reales
+            if from_upstream:
+                self.cache.set(cache_key, final_products)
+            else:
+                self.cache.set(cache_key, final_products, ttl=self.fallback_cache_ttl, stale_ttl=0)
+            
+            return final_products
+        finally:
+            if filling:
+                self.cache.release_fill(cache_key)
+    
+    def _search_engine(self, engine, query, location, deadline):
+        data = self._make_api_request(engine, query, location, deadline=deadline)
+        return self._process_results(data, engine)
+    
+    def _dedupe_key(self, product):
+        link = product.get('link', '')
+        if link and link != '#' and 'google.com/search' not in link:
+            return link
+        return (product.get('title', '').lower(), product.get('source', '').lower())
+    
+    def _fan_out(self, final_query, budget=None, on_event=None, deadline=None):
+        """Consulta todos los motores/ubicaciones en paralelo bajo un presupuesto común; devuelve resultados parciales si alguno vence"""
+        query_optimized = f'"{final_query}" buy online'
+        budget = self.search_budget if budget is None else budget
+        deadline = deadline.child(budget) if deadline else Deadline(budget)
+        targets = [(engine, location) for engine in self.engines for location in self.locations]
         
-        # Añadir metadata
-        for product in final_products:
-            product['search_source'] = search_source
-            product['original_query'] = query if query else "imagen"
+        # Un solo motor: sin salto de thread
+        if len(targets) == 1:
+            engine, location = targets[0]
+            products = self._search_engine(engine, query_optimized, location, deadline)
+            if on_event and products:
+                on_event('products', {'engine': engine, 'location': location, 'products': products})
+            return products
         
-        self.cache[cache_key] = (final_products, time.time())
-        if len(self.cache) > 10:
-            oldest_key = min(self.cache.keys(), key=lambda k: self.cache[k][1])
-            del self.cache[oldest_key]
+        futures = {search_executor.submit(self._search_engine, engine, query_optimized, location, deadline): (engine, location)
+                   for engine, location in targets}
+        merged = []
+        seen = set()
+        pending = set(futures)
+        while pending:
+            remaining = deadline.remaining()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                engine, location = futures[future]
+                try:
+                    products = future.result()
+                except Exception as e:
+                    print(f"Error en motor {engine} ({location}): {e}")
+                    continue
+                batch = []
+                for product in products:
+                    key = self._dedupe_key(product)
+                    if key not in seen:
+                        seen.add(key)
+                        batch.append(product)
+                merged.extend(batch)
+                if on_event and batch:
+                    on_event('products', {'engine': engine, 'location': location, 'products': batch})
         
-        return final_products
+        for future in pending:
+            future.cancel()
+            engine, location = futures[future]
+            print(f"⏱️ Motor {engine} ({location}) excedió el presupuesto de búsqueda - resultados parciales")
+        return merged
     
     def _get_examples(self, query):
         stores = ['Amazon', 'Walmart', 'Target']
@@ -433,189 +2945,129 @@ class PriceFinder:
             if store == 'Amazon':
                 link = f"https://www.amazon.com/s?k={search_query}"
             elif store == 'Walmart':
-                link = f"https://www.walmart.com/search?q={search_query}"
-            else:
-                link = f"https://www.target.com/s?searchTerm={search_query}"
-            
-            examples.append({
-                'title': f'{self._clean_text(query)} - {["Mejor Precio", "Oferta", "Popular"][i]}',
-                'price': f'${price:.2f}',
-                'price_numeric': price,
-                'source': store,
-                'link': link,
-                'rating': ['4.5', '4.2', '4.0'][i],
-                'reviews': ['500', '300', '200'][i],
-                'image': '',
-                'search_source': 'example'
-            })
-        return examples
-
-# Instancia global de PriceFinder
-price_finder = PriceFinder()
-
-# Templates
-def render_page(title, content):
-    template = '''<!DOCTYPE html>
-<html lang="es">
-<head>
-    <title>''' + title + '''</title>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; padding: 15px; }
-        .container { max-width: 650px; margin: 0 auto; background: white; padding: 25px; border-radius: 12px; box-shadow: 0 8px 25px rgba(0,0,0,0.15); }
-        h1 { color: #1a73e8; text-align: center; margin-bottom: 8px; font-size: 1.8em; }
-        .subtitle { text-align: center; color: #666; margin-bottom: 25px; }
-        input { width: 100%; padding: 12px; margin: 8px 0; border: 2px solid #e1e5e9; border-radius: 6px; font-size: 16px; }
-        input:focus { outline: none; border-color: #1a73e8; }
-        button { width: 100%; padding: 12px; background: #1a73e8; color: white; border: none; border-radius: 6px; cursor: pointer; font-size: 16px; font-weight: 600; }
-        button:hover { background: #1557b0; }
-        .search-bar { display: flex; gap: 8px; margin-bottom: 20px; }
-        .search-bar input { flex: 1; }
-        .search-bar button { width: auto; padding: 12px 20px; }
-        .tips { background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 6px; margin-bottom: 15px; font-size: 14px; }
-        .error { background: #ffebee; color: #c62828; padding: 12px; border-radius: 6px; margin: 12px 0; display: none; }
-        .loading { text-align: center; padding: 30px; display: none; }
-        .spinner { border: 3px solid #f3f3f3; border-top: 3px solid #1a73e8; border-radius: 50%; width: 40px; height: 40px; animation: spin 1s linear infinite; margin: 0 auto 15px; }
-        @keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
-        .user-info { background: #e3f2fd; padding: 12px; border-radius: 6px; margin-bottom: 15px; text-align: center; font-size: 14px; display: flex; align-items: center; justify-content: center; }
-        .user-info a { color: #1976d2; text-decoration: none; font-weight: 600; }
-        .flash { padding: 12px; margin-bottom: 8px; border-radius: 6px; font-size: 14px; }
-        .flash.success { background-color: #d4edda; color: #155724; }
-        .flash.danger { background-color: #f8d7da; color: #721c24; }
-        .flash.warning { background-color: #fff3cd; color: #856404; }
-        .image-upload { background: #f8f9fa; border: 2px dashed #dee2e6; border-radius: 8px; padding: 20px; text-align: center; margin: 15px 0; transition: all 0.3s ease; }
-        .image-upload input[type="file"] { display: none; }
-        .image-upload label { cursor: pointer; color: #1a73e8; font-weight: 600; }
-        .image-upload:hover { border-color: #1a73e8; background: #e3f2fd; }
-        .image-preview { max-width: 150px; max-height: 150px; margin: 10px auto; border-radius: 8px; display: none; }
-        .or-divider { text-align: center; margin: 20px 0; color: #666; font-weight: 600; position: relative; }
-        .or-divider:before { content: ''; position: absolute; top: 50%; left: 0; right: 0; height: 1px; background: #dee2e6; z-index: 1; }
-        .or-divider span { background: white; padding: 0 15px; position: relative; z-index: 2; }
-    </style>
-</head>
-<body>''' + content + '''</body>
-</html>'''
-    return template
-
-AUTH_LOGIN_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="es">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Iniciar Sesion | Price Finder USA</title>
-    <style>
-        body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #4A90E2 0%, #50E3C2 100%); min-height: 100vh; display: flex; justify-content: center; align-items: center; padding: 20px; }
-        .auth-container { max-width: 420px; width: 100%; background: white; border-radius: 15px; box-shadow: 0 20px 40px rgba(0,0,0,0.1); overflow: hidden; }
-        .form-header { text-align: center; padding: 30px 25px 15px; background: linear-gradient(45deg, #2C3E50, #4A90E2); color: white; }
-        .form-header h1 { font-size: 1.8em; margin-bottom: 8px; }
-        .form-header p { opacity: 0.9; font-size: 1em; }
-        .form-body { padding: 25px; }
-        form { display: flex; flex-direction: column; gap: 18px; }
-        .input-group { display: flex; flex-direction: column; gap: 6px; }
-        .input-group label { font-weight: 600; color: #2C3E50; font-size: 14px; }
-        .input-group input { padding: 14px 16px; border: 2px solid #e0e0e0; border-radius: 8px; font-size: 16px; transition: border-color 0.3s ease; }
-        .input-group input:focus { outline: 0; border-color: #4A90E2; }
-        .submit-btn { background: linear-gradient(45deg, #4A90E2, #2980b9); color: white; border: none; padding: 14px 25px; font-size: 16px; font-weight: 600; border-radius: 8px; cursor: pointer; transition: transform 0.2s ease; }
-        .submit-btn:hover { transform: translateY(-2px); }
-        .flash-messages { list-style: none; padding: 0 25px 15px; }
-        .flash { padding: 12px; margin-bottom: 10px; border-radius: 6px; text-align: center; font-size: 14px; }
-        .flash.success { background-color: #d4edda; color: #155724; }
-        .flash.danger { background-color: #f8d7da; color: #721c24; }
-        .flash.warning { background-color: #fff3cd; color: #856404; }
-    </style>
-</head>
-<body>
-    <div class="auth-container">
-        <div class="form-header">
-            <h1>Price Finder USA</h1>
-            <p>Iniciar Sesion</p>
-        </div>
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                <ul class="flash-messages">
-                    {% for category, message in messages %}
-                        <li class="flash {{ category }}">{{ message }}</li>
-                    {% endfor %}
-                </ul>
-            {% endif %}
-        {% endwith %}
-        <div class="form-body">
-            <form action="{{ url_for('auth_login') }}" method="post">
-                <div class="input-group">
-                    <label for="email">Correo Electronico</label>
-                    <input type="email" name="email" id="email" required>
-                </div>
-                <div class="input-group">
-                    <label for="password">Contraseña</label>
-                    <input type="password" name="password" id="password" required>
-                </div>
-                <button type="submit" class="submit-btn">Entrar</button>
-            </form>
-        </div>
-    </div>
-</body>
-</html>
-"""
-
-# Routes
-@app.route('/auth/login-page')
-def auth_login_page():
-    return render_template_string(AUTH_LOGIN_TEMPLATE)
-
-@app.route('/auth/login', methods=['POST'])
-def auth_login():
-    email = request.form.get('email', '').strip()
-    password = request.form.get('password', '').strip()
-    
-    if not email or not password:
-        flash('Por favor completa todos los campos.', 'danger')
-        return redirect(url_for('auth_login_page'))
-    
-    print(f"Login attempt for {email}")
-    result = firebase_auth.login_user(email, password)
-    
-    if result['success']:
-        firebase_auth.set_user_session(result['user_data'])
-        flash(result['message'], 'success')
-        print(f"Successful login for {email}")
-        return redirect(url_for('index'))
-    else:
-        flash(result['message'], 'danger')
-        print(f"Failed login for {email}")
-        return redirect(url_for('auth_login_page'))
+                link = f"https://www.walmart.com/search?q={search_query}"
+            else:
+                link = f"https://www.target.com/s?searchTerm={search_query}"
+            
+            examples.append(Product(
+                title=f'{self._clean_text(query)} - {["Mejor Precio", "Oferta", "Popular"][i]}',
+                price_numeric=price,
+                source=store,
+                link=link,
+                rating=[4.5, 4.2, 4.0][i],
+                reviews=[500, 300, 200][i],
+                search_source='example'
+            ))
+        return examples
 
-@app.route('/auth/logout')
-def auth_logout():
-    firebase_auth.clear_user_session()
-    flash('Has cerrado la sesion correctamente.', 'success')
-    return redirect(url_for('auth_login_page'))
+# Instancia global de PriceFinder
+price_finder = PriceFinder()
 
-@app.route('/')
-def index():
-    if not firebase_auth.is_user_logged_in():
-        return redirect(url_for('auth_login_page'))
-    return redirect(url_for('search_page'))
+# ==============================================================================
+# ARRANQUE DE WORKERS (gunicorn --preload y fork)
+# ==============================================================================
 
-@app.route('/search')
-@login_required
-def search_page():
-    current_user = firebase_auth.get_current_user()
-    user_name = current_user['user_name'] if current_user else 'Usuario'
-    user_name_escaped = html.escape(user_name)
-    
-    # Verificar si búsqueda por imagen está disponible
-    image_search_available = GEMINI_READY and PIL_AVAILABLE
-    
-    content = '''
+# Con `gunicorn --preload webapp:app` el módulo se importa una vez en el master y los workers heredan el
+# estado de solo lectura (plantillas, tablas de reputación, JWKS). PRELOAD_HEAVY_MODULES=1 importa además
+# PIL, Gemini y NumPy en el master para que los workers compartan esas páginas en lugar de importarlos cada uno.
+PRELOAD_HEAVY_MODULES = os.environ.get('PRELOAD_HEAVY_MODULES', '').lower() in ('1', 'true', 'yes')
+
+def preload_heavy_modules():
+    """Importa los SDKs pesados sin crear clientes (configure() corre en cada worker tras el fork)"""
+    started = time.perf_counter()
+    for lazy in (Image, np):
+        if lazy is not None:
+            lazy.load()
+    if GEMINI_AVAILABLE:
+        importlib.import_module('google.generativeai')
+    # Objetos del master fuera del GC cíclico: los workers no ensucian (copian) sus páginas al recolectar
+    gc.freeze()
+    print(f"📦 Módulos pesados precargados en {time.perf_counter() - started:.2f} s")
+
+def reset_http_session(http):
+    """Cierra las conexiones keep-alive heredadas; el pool se vuelve a llenar en el proceso hijo"""
+    for adapter in http.adapters.values():
+        adapter.poolmanager.clear()
+
+def reinit_after_fork():
+    """Estado por proceso que el worker no debe heredar del master: threads, conexiones SQLite/HTTP y clientes de SDK"""
+    global search_executor, refresh_executor
+    # Un executor copiado cree tener threads que en el hijo no existen: sus tareas nunca correrían
+    search_executor = ThreadPoolExecutor(max_workers=SEARCH_FANOUT_WORKERS, thread_name_prefix='serpapi')
+    refresh_executor = ThreadPoolExecutor(max_workers=CACHE_REFRESH_WORKERS, thread_name_prefix='cache-refresh')
+    for http in (price_finder.http, price_finder.http_once, firebase_auth.http, firebase_auth.token_verifier.http):
+        if isinstance(http, requests.Session):
+            reset_http_session(http)
+    for component in (price_finder.cache, search_results, price_finder.rate_limiter, price_finder.warmer):
+        component.reset_after_fork()
+    if price_history:
+        price_history.reset_after_fork()
+    for lazy in (Image, np, genai, google_exceptions):
+        if lazy is not None:
+            lazy.reset_after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reinit_after_fork)
+
+if PRELOAD_HEAVY_MODULES:
+    preload_heavy_modules()
+
+# Templates
+# Hoja de estilos común: se sirve aparte con cache del navegador en lugar de repetirse en cada página
+APP_STYLESHEET = """* { margin: 0; padding: 0; box-sizing: border-box; }
+body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; padding: 15px; }
+.container { max-width: 650px; margin: 0 auto; background: white; padding: 25px; border-radius: 12px; box-shadow: 0 8px 25px rgba(0,0,0,0.15); }
+h1 { color: #1a73e8; text-align: center; margin-bottom: 8px; font-size: 1.8em; }
+.subtitle { text-align: center; color: #666; margin-bottom: 25px; }
+input { width: 100%; padding: 12px; margin: 8px 0; border: 2px solid #e1e5e9; border-radius: 6px; font-size: 16px; }
+input:focus { outline: none; border-color: #1a73e8; }
+button { width: 100%; padding: 12px; background: #1a73e8; color: white; border: none; border-radius: 6px; cursor: pointer; font-size: 16px; font-weight: 600; }
+button:hover { background: #1557b0; }
+.search-bar { display: flex; gap: 8px; margin-bottom: 20px; }
+.search-bar input { flex: 1; }
+.search-bar button { width: auto; padding: 12px 20px; }
+.tips { background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 6px; margin-bottom: 15px; font-size: 14px; }
+.error { background: #ffebee; color: #c62828; padding: 12px; border-radius: 6px; margin: 12px 0; display: none; }
+.loading { text-align: center; padding: 30px; display: none; }
+.spinner { border: 3px solid #f3f3f3; border-top: 3px solid #1a73e8; border-radius: 50%; width: 40px; height: 40px; animation: spin 1s linear infinite; margin: 0 auto 15px; }
+@keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
+.user-info { background: #e3f2fd; padding: 12px; border-radius: 6px; margin-bottom: 15px; text-align: center; font-size: 14px; display: flex; align-items: center; justify-content: center; }
+.user-info a { color: #1976d2; text-decoration: none; font-weight: 600; }
+.flash { padding: 12px; margin-bottom: 8px; border-radius: 6px; font-size: 14px; }
+.flash.success { background-color: #d4edda; color: #155724; }
+.flash.danger { background-color: #f8d7da; color: #721c24; }
+.flash.warning { background-color: #fff3cd; color: #856404; }
+.image-upload { background: #f8f9fa; border: 2px dashed #dee2e6; border-radius: 8px; padding: 20px; text-align: center; margin: 15px 0; transition: all 0.3s ease; }
+.image-upload input[type="file"] { display: none; }
+.image-upload label { cursor: pointer; color: #1a73e8; font-weight: 600; }
+.image-upload:hover { border-color: #1a73e8; background: #e3f2fd; }
+.image-preview { max-width: 150px; max-height: 150px; margin: 10px auto; border-radius: 8px; display: none; }
+.or-divider { text-align: center; margin: 20px 0; color: #666; font-weight: 600; position: relative; }
+.or-divider:before { content: ''; position: absolute; top: 50%; left: 0; right: 0; height: 1px; background: #dee2e6; z-index: 1; }
+.or-divider span { background: white; padding: 0 15px; position: relative; z-index: 2; }
+"""
+APP_STYLESHEET_ETAG = hashlib.sha256(APP_STYLESHEET.encode('utf-8')).hexdigest()[:16]
+
+BASE_TEMPLATE = """<!DOCTYPE html>
+<html lang="es">
+<head>
+    <title>{% block title %}Price Finder USA{% endblock %}</title>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <link rel="stylesheet" href="{{ url_for('app_stylesheet', v=stylesheet_version) }}">
+</head>
+<body>{% block content %}{% endblock %}</body>
+</html>"""
+
+SEARCH_TEMPLATE = """{% extends 'base.html' %}
+{% block title %}Busqueda{% endblock %}
+{% block content %}
     <div class="container">
         <div class="user-info">
-            <span><strong>''' + user_name_escaped + '''</strong></span>
+            <span><strong>{{ user_name }}</strong></span>
             <div style="display: inline-block; margin-left: 15px;">
-                <a href="''' + url_for('auth_logout') + '''" style="background: #dc3545; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
-                <a href="''' + url_for('index') + '''" style="background: #28a745; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Inicio</a>
+                <a href="{{ url_for('auth_logout') }}" style="background: #dc3545; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
+                <a href="{{ url_for('index') }}" style="background: #28a745; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Inicio</a>
             </div>
         </div>
         
@@ -628,26 +3080,31 @@ def search_page():
         {% endwith %}
         
         <h1>Buscar Productos</h1>
-        <p class="subtitle">''' + ('Búsqueda por texto o imagen' if image_search_available else 'Búsqueda por texto') + ''' - Resultados en 15 segundos</p>
+        <p class="subtitle">{{ 'Búsqueda por texto o imagen' if image_search_available else 'Búsqueda por texto' }} - Resultados en 15 segundos</p>
         
         <form id="searchForm" enctype="multipart/form-data">
             <div class="search-bar">
                 <input type="text" id="searchQuery" name="query" placeholder="Busca cualquier producto...">
                 <button type="submit">Buscar</button>
             </div>
+            {% if image_search_available %}
+            <div class="or-divider"><span>O sube una imagen</span></div>
             
-            ''' + ('<div class="or-divider"><span>O sube una imagen</span></div>' if image_search_available else '') + '''
-            
-            ''' + ('<div class="image-upload" id="imageUpload"><input type="file" id="imageFile" name="image_file" accept="image/*"><label for="imageFile">📷 Buscar por imagen<br><small>JPG o PNG hasta 10MB</small></label><img id="imagePreview" class="image-preview" src="#" alt="Vista previa"></div>' if image_search_available else '') + '''
+            <div class="image-upload" id="imageUpload"><input type="file" id="imageFile" name="image_file" accept="image/*"><label for="imageFile">📷 Buscar por imagen<br><small>JPG o PNG hasta 10MB</small></label><img id="imagePreview" class="image-preview" src="#" alt="Vista previa"></div>
+            {% endif %}
         </form>
         
         <div class="tips">
-            <h4>Sistema optimizado''' + (' + Búsqueda por Imagen:' if image_search_available else ':') + '''</h4>
+            <h4>Sistema optimizado{{ ' + Búsqueda por Imagen:' if image_search_available else ':' }}</h4>
             <ul style="margin: 8px 0 0 15px; font-size: 13px;">
                 <li><strong>Velocidad:</strong> Resultados en menos de 15 segundos</li>
                 <li><strong>USA:</strong> Amazon, Walmart, Target, Best Buy</li>
                 <li><strong>Filtrado:</strong> Sin Alibaba, Temu, AliExpress</li>
-                ''' + ('<li><strong>🖼️ IA:</strong> Identifica productos en imágenes automáticamente</li>' if image_search_available else '<li><strong>⚠️ Imagen:</strong> Configura GEMINI_API_KEY para activar</li>') + '''
+                {% if image_search_available %}
+                <li><strong>🖼️ IA:</strong> Identifica productos en imágenes automáticamente</li>
+                {% else %}
+                <li><strong>⚠️ Imagen:</strong> Configura GEMINI_API_KEY para activar</li>
+                {% endif %}
             </ul>
         </div>
         
@@ -661,8 +3118,7 @@ def search_page():
     
     <script>
         let searching = false;
-        const imageSearchAvailable = ''' + str(image_search_available).lower() + ''';
-        
+        const imageSearchAvailable = {{ 'true' if image_search_available else 'false' }};
         // Manejo de vista previa de imagen
         if (imageSearchAvailable) {
             document.getElementById('imageFile').addEventListener('change', function(e) {
@@ -725,7 +3181,7 @@ def search_page():
             .then(data => { 
                 hideLoading(); 
                 if (data.success) {
-                    window.location.href = '/results';
+                    window.location.href = '/results?id=' + encodeURIComponent(data.search_id);
                 } else {
                     showError(data.error || 'Error en la búsqueda');
                 }
@@ -750,151 +3206,432 @@ def search_page():
             e.textContent = msg; 
             e.style.display = 'block'; 
         }
-    </script>'''
+    </script>
+{% endblock %}"""
+
+RESULTS_TEMPLATE = """{% extends 'base.html' %}
+{% block title %}Resultados - Price Finder USA{% endblock %}
+{% block content %}
+        <div style="max-width: 800px; margin: 0 auto;">
+            <div style="background: rgba(255,255,255,0.15); padding: 12px; border-radius: 8px; margin-bottom: 15px; text-align: center; display: flex; align-items: center; justify-content: center;">
+                <span style="color: white; font-size: 14px;"><strong>{{ user_name }}</strong></span>
+                <div style="margin-left: 15px;">
+                    <a href="{{ url_for('auth_logout') }}" style="background: rgba(220,53,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
+                    <a href="{{ url_for('search_page') }}" style="background: rgba(40,167,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Nueva Busqueda</a>
+                </div>
+            </div>
+            
+            <h1 style="color: white; text-align: center; margin-bottom: 8px;">Resultados: "{{ query }}"</h1>
+            <p style="text-align: center; color: rgba(255,255,255,0.9); margin-bottom: 25px;">Busqueda completada</p>
+            {% if stats %}
+                <div style="background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 8px; margin-bottom: 20px;">
+                    <h3 style="color: #2e7d32; margin-bottom: 8px;">Resultados de búsqueda ({{ search_type_text }})</h3>
+                    <p><strong>{{ products|length }} productos encontrados</strong></p>
+                    <p><strong>Mejor precio: ${{ '%.2f'|format(stats.min_price) }}</strong></p>
+                    <p><strong>Precio promedio: ${{ '%.2f'|format(stats.avg_price) }}</strong></p>
+                </div>
+            {% endif %}
+            {% for product in products if product %}
+                <div style="border: 1px solid #ddd; border-radius: 8px; padding: 15px; margin-bottom: 15px; background: white; position: relative; box-shadow: 0 2px 4px rgba(0,0,0,0.08);">
+                    {% if loop.index0 < 3 %}<div style="position: absolute; top: 8px; right: 8px; background: {{ badge_colors[loop.index0] }}; color: white; padding: 4px 8px; border-radius: 12px; font-size: 11px; font-weight: bold;">{{ badges[loop.index0] }}</div>{% endif %}
+                    {% if product.search_source == 'image' %}<div style="position: absolute; top: 8px; left: 8px; background: #673ab7; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">📷 IMAGEN</div>
+                    {% elif product.search_source == 'combined' %}<div style="position: absolute; top: 8px; left: 8px; background: #607d8b; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">🔗 MIXTO</div>{% endif %}
+                    <h3 style="color: #1a73e8; margin-bottom: 8px; font-size: 16px; margin-top: {{ '20px' if product.search_source in ('image', 'combined') else '0' }};">{{ product.title or 'Producto' }}</h3>
+                    <div style="font-size: 28px; color: #2e7d32; font-weight: bold; margin: 12px 0;">{{ product.price or '$0.00' }} <span style="font-size: 12px; color: #666;">USD</span></div>
+                    <p style="color: #666; margin-bottom: 12px; font-size: 14px;">Tienda: {{ product.source or 'Tienda' }}</p>
+                    <a href="{{ product.link or '#' }}" target="_blank" rel="noopener noreferrer" style="background: #1a73e8; color: white; padding: 10px 16px; text-decoration: none; border-radius: 6px; font-weight: 600; display: inline-block; font-size: 14px;">Ver Producto</a>
+                </div>
+            {% endfor %}
+        </div>
+{% endblock %}"""
+
+AUTH_LOGIN_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="es">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Iniciar Sesion | Price Finder USA</title>
+    <style>
+        body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #4A90E2 0%, #50E3C2 100%); min-height: 100vh; display: flex; justify-content: center; align-items: center; padding: 20px; }
+        .auth-container { max-width: 420px; width: 100%; background: white; border-radius: 15px; box-shadow: 0 20px 40px rgba(0,0,0,0.1); overflow: hidden; }
+        .form-header { text-align: center; padding: 30px 25px 15px; background: linear-gradient(45deg, #2C3E50, #4A90E2); color: white; }
+        .form-header h1 { font-size: 1.8em; margin-bottom: 8px; }
+        .form-header p { opacity: 0.9; font-size: 1em; }
+        .form-body { padding: 25px; }
+        form { display: flex; flex-direction: column; gap: 18px; }
+        .input-group { display: flex; flex-direction: column; gap: 6px; }
+        .input-group label { font-weight: 600; color: #2C3E50; font-size: 14px; }
+        .input-group input { padding: 14px 16px; border: 2px solid #e0e0e0; border-radius: 8px; font-size: 16px; transition: border-color 0.3s ease; }
+        .input-group input:focus { outline: 0; border-color: #4A90E2; }
+        .submit-btn { background: linear-gradient(45deg, #4A90E2, #2980b9); color: white; border: none; padding: 14px 25px; font-size: 16px; font-weight: 600; border-radius: 8px; cursor: pointer; transition: transform 0.2s ease; }
+        .submit-btn:hover { transform: translateY(-2px); }
+        .flash-messages { list-style: none; padding: 0 25px 15px; }
+        .flash { padding: 12px; margin-bottom: 10px; border-radius: 6px; text-align: center; font-size: 14px; }
+        .flash.success { background-color: #d4edda; color: #155724; }
+        .flash.danger { background-color: #f8d7da; color: #721c24; }
+        .flash.warning { background-color: #fff3cd; color: #856404; }
+    </style>
+</head>
+<body>
+    <div class="auth-container">
+        <div class="form-header">
+            <h1>Price Finder USA</h1>
+            <p>Iniciar Sesion</p>
+        </div>
+        {% with messages = get_flashed_messages(with_categories=true) %}
+            {% if messages %}
+                <ul class="flash-messages">
+                    {% for category, message in messages %}
+                        <li class="flash {{ category }}">{{ message }}</li>
+                    {% endfor %}
+                </ul>
+            {% endif %}
+        {% endwith %}
+        <div class="form-body">
+            <form action="{{ url_for('auth_login') }}" method="post">
+                <div class="input-group">
+                    <label for="email">Correo Electronico</label>
+                    <input type="email" name="email" id="email" required>
+                </div>
+                <div class="input-group">
+                    <label for="password">Contraseña</label>
+                    <input type="password" name="password" id="password" required>
+                </div>
+                <button type="submit" class="submit-btn">Entrar</button>
+            </form>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+# Plantillas compiladas una sola vez y reutilizadas desde la cache de Jinja
+app.jinja_loader = DictLoader({
+    'base.html': BASE_TEMPLATE,
+    'search.html': SEARCH_TEMPLATE,
+    'results.html': RESULTS_TEMPLATE,
+    'auth_login.html': AUTH_LOGIN_TEMPLATE
+})
+app.jinja_env.globals['stylesheet_version'] = APP_STYLESHEET_ETAG[:8]
+
+def render_page(template_name, **context):
+    """render_template registrando su duración como etapa render:<plantilla>"""
+    with STAGE_SECONDS.time('render:' + template_name):
+        return render_template(template_name, **context)
+
+# Routes
+@app.route('/assets/app.css')
+def app_stylesheet():
+    response = Response(APP_STYLESHEET, mimetype='text/css')
+    response.set_etag(APP_STYLESHEET_ETAG)
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response.make_conditional(request)
+
+@app.route('/auth/login-page')
+def auth_login_page():
+    return render_page('auth_login.html')
+
+@app.route('/auth/login', methods=['POST'])
+def auth_login():
+    email = request.form.get('email', '').strip()
+    password = request.form.get('password', '').strip()
+    
+    if not email or not password:
+        flash('Por favor completa todos los campos.', 'danger')
+        return redirect(url_for('auth_login_page'))
+    
+    print(f"Login attempt for {email}")
+    result = firebase_auth.login_user(email, password)
     
-    return render_template_string(render_page('Busqueda', content))
+    if result['success']:
+        firebase_auth.set_user_session(result['user_data'])
+        flash(result['message'], 'success')
+        print(f"Successful login for {email}")
+        return redirect(url_for('index'))
+    else:
+        flash(result['message'], 'danger')
+        print(f"Failed login for {email}")
+        return redirect(url_for('auth_login_page'))
 
-@app.route('/api/search', methods=['POST'])
+@app.route('/auth/logout')
+def auth_logout():
+    firebase_auth.clear_user_session()
+    flash('Has cerrado la sesion correctamente.', 'success')
+    return redirect(url_for('auth_login_page'))
+
+@app.route('/')
+def index():
+    if not firebase_auth.is_user_logged_in():
+        return redirect(url_for('auth_login_page'))
+    return redirect(url_for('search_page'))
+
+@app.route('/search')
 @login_required
-def api_search():
+def search_page():
+    current_user = firebase_auth.get_current_user()
+    user_name = current_user['user_name'] if current_user else 'Usuario'
+    
+    # Verificar si búsqueda por imagen está disponible
+    image_search_available = GEMINI_READY and PIL_AVAILABLE
+    
+    return render_page('search.html', user_name=user_name, image_search_available=image_search_available)
+
+def parse_search_request():
+    """Lee consulta e imagen del formulario; devuelve (query, image_content, respuesta_error)"""
+    # Rechazar cuerpos demasiado grandes antes de leer el formulario
+    too_large = (jsonify({'success': False, 'error': 'La imagen es demasiado grande (máximo 10MB)'}), 400)
+    if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        return None, None, too_large
+    
     try:
-        # Obtener parámetros
         query = request.form.get('query', '').strip() if request.form.get('query') else None
         image_file = request.files.get('image_file')
+    except RequestEntityTooLarge:
+        # Cuerpo sin Content-Length (chunked) que superó MAX_CONTENT_LENGTH mientras se leía
+        return None, None, too_large
+    
+    # Procesar imagen si existe
+    image_content = None
+    if image_file and image_file.filename != '':
+        try:
+            image_content, error = read_image_upload(image_file)
+            if error:
+                return None, None, (jsonify({'success': False, 'error': error}), 400)
+        except Exception as e:
+            print(f"❌ Error al leer imagen: {e}")
+            return None, None, (jsonify({'success': False, 'error': 'Error al procesar la imagen'}), 400)
+    
+    # Validar que hay al menos una entrada
+    if not query and not image_content:
+        return None, None, (jsonify({'success': False, 'error': 'Debe proporcionar una consulta o una imagen'}), 400)
+    
+    # Limitar longitud de query
+    if query and len(query) > 80:
+        query = query[:80]
+    return query, image_content, None
+
+def current_user_email():
+    current_user = firebase_auth.get_current_user()
+    return (current_user or {}).get('user_email') or 'Unknown'
+
+def get_search_type(query, image_content):
+    return "imagen" if image_content and not query else "texto+imagen" if image_content and query else "texto"
+
+def compute_price_stats(products):
+    return price_summary([_to_float(p.get('price_numeric', 0)) for p in products])
+
+@app.route('/api/search', methods=['POST'])
+@login_required
+def api_search():
+    # El deadline empieza antes de validar la imagen: cubre la petición completa
+    deadline = Deadline()
+    try:
+        query, image_content, error_response = parse_search_request()
+        if error_response:
+            return error_response
         
-        # Procesar imagen si existe
-        image_content = None
-        if image_file and image_file.filename != '':
-            try:
-                image_content = image_file.read()
-                print(f"📷 Imagen recibida: {len(image_content)} bytes")
-                
-                # Validar tamaño (máximo 10MB)
-                if len(image_content) > 10 * 1024 * 1024:
-                    return jsonify({'success': False, 'error': 'La imagen es demasiado grande (máximo 10MB)'}), 400
-                    
-            except Exception as e:
-                print(f"❌ Error al leer imagen: {e}")
-                return jsonify({'success': False, 'error': 'Error al procesar la imagen'}), 400
-        
-        # Validar que hay al menos una entrada
-        if not query and not image_content:
-            return jsonify({'success': False, 'error': 'Debe proporcionar una consulta o una imagen'}), 400
-        
-        # Limitar longitud de query
-        if query and len(query) > 80:
-            query = query[:80]
-        
-        user_email = session.get('user_email', 'Unknown')
-        search_type = "imagen" if image_content and not query else "texto+imagen" if image_content and query else "texto"
+        user_email = current_user_email()
+        search_type = get_search_type(query, image_content)
         print(f"Search request from {user_email}: {search_type}")
         
         # Realizar búsqueda con soporte para imagen
-        products = price_finder.search_products(query=query, image_content=image_content)
+        products = price_finder.search_products(query=query, image_content=image_content, deadline=deadline)
         
-        session['last_search'] = {
-            'query': query or "búsqueda por imagen",
-            'products': products,
-            'timestamp': datetime.now().isoformat(),
-            'user': user_email,
-            'search_type': search_type
-        }
+        search_id = save_search_result(query or "búsqueda por imagen", products, search_type, user_email)
+        if not firebase_auth.get_bearer_token():
+            session['last_search_id'] = search_id
         
         print(f"Search completed for {user_email}: {len(products)} products found")
-        return jsonify({'success': True, 'products': products, 'total': len(products)})
+        return json_response({'success': True, 'products': products, 'total': len(products), 'search_id': search_id})
         
     except Exception as e:
         print(f"Search error: {e}")
         try:
             query = request.form.get('query', 'producto') if request.form.get('query') else 'producto'
             fallback = price_finder._get_examples(query)
-            session['last_search'] = {'query': str(query), 'products': fallback, 'timestamp': datetime.now().isoformat()}
-            return jsonify({'success': True, 'products': fallback, 'total': len(fallback)})
+            search_id = save_search_result(str(query), fallback, 'texto', current_user_email())
+            if not firebase_auth.get_bearer_token():
+                session['last_search_id'] = search_id
+            return json_response({'success': True, 'products': fallback, 'total': len(fallback), 'search_id': search_id})
         except:
             return jsonify({'success': False, 'error': 'Error interno del servidor'}), 500
 
+@app.route('/api/search/stream', methods=['POST'])
+@login_required
+def api_search_stream():
+    """Variante en streaming de /api/search: un objeto JSON por línea (NDJSON) a medida que hay resultados.
+    
+    Eventos: query (consulta derivada), products (lote por motor) y done (productos finales, estadísticas
+    y search_id para abrir /results?id=...). La sesión no se modifica: la cookie ya se envió al empezar el stream.
+    """
+    deadline = Deadline()
+    query, image_content, error_response = parse_search_request()
+    if error_response:
+        return error_response
+    
+    user_email = current_user_email()
+    search_type = get_search_type(query, image_content)
+    print(f"Streaming search request from {user_email}: {search_type}")
+    
+    events = queue.Queue()
+    
+    def publish(name, data):
+        # Los Product de los lotes siguen en uso por la búsqueda, que luego les añade search_source y
+        # original_query: el generador serializa copias para no memorizar un JSON sin esos campos
+        if 'products' in data:
+            data = dict(data, products=[product.to_dict() for product in data['products']])
+        events.put({'event': name, **data})
+    
+    def run_search():
+        try:
+            products = price_finder.search_products(
+                query=query,
+                image_content=image_content,
+                on_event=publish,
+                deadline=deadline
+            )
+        except Exception as e:
+            print(f"Streaming search error: {e}")
+            products = price_finder._get_examples(query or 'producto')
+        try:
+            search_id = save_search_result(query or "búsqueda por imagen", products, search_type, user_email)
+            events.put({'event': 'done', 'success': True, 'search_type': search_type, 'products': products,
+                        'total': len(products), 'stats': compute_price_stats(products), 'search_id': search_id})
+        finally:
+            events.put(None)
+    
+    threading.Thread(target=run_search, name='search-stream', daemon=True).start()
+    
+    def generate():
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield dumps_json(event) + '\n'
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+BATCH_MAX_QUERIES = int(os.environ.get('BATCH_MAX_QUERIES', 50))
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', 4))
+BATCH_DEADLINE_SECONDS = float(os.environ.get('BATCH_DEADLINE_SECONDS', 25))
+
+@app.route('/api/search/batch', methods=['POST'])
+@login_required
+def api_search_batch():
+    """Varias consultas de texto por petición: {"queries": [...], "concurrency": n, "deadline": segundos}.
+    
+    Las consultas idénticas (tras normalizar) se buscan una sola vez; los resultados vuelven en el orden recibido.
+    """
+    payload = request.get_json(silent=True)
+    queries = payload.get('queries') if isinstance(payload, dict) else None
+    if not isinstance(queries, list) or not queries:
+        return jsonify({'success': False, 'error': 'Debe proporcionar una lista de consultas'}), 400
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify({'success': False, 'error': f'Máximo {BATCH_MAX_QUERIES} consultas por lote'}), 400
+    
+    try:
+        concurrency = max(1, min(int(payload.get('concurrency', BATCH_MAX_CONCURRENCY)), BATCH_MAX_CONCURRENCY))
+        deadline = max(0.1, min(float(payload.get('deadline', BATCH_DEADLINE_SECONDS)), BATCH_DEADLINE_SECONDS))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Parámetros de lote inválidos'}), 400
+    
+    # Deduplicar por clave normalizada
+    keys = []
+    unique = {}
+    for raw_query in queries:
+        query = raw_query.strip()[:80] if isinstance(raw_query, str) else ''
+        key = normalize_query_key(query) if len(query) >= 2 else None
+        keys.append(key)
+        if key and key not in unique:
+            unique[key] = query
+    
+    print(f"Batch search from {current_user_email()}: {len(queries)} consultas ({len(unique)} únicas)")
+    
+    outcomes = {}
+    if unique:
+        executor = ThreadPoolExecutor(max_workers=min(concurrency, len(unique)), thread_name_prefix='batch')
+        batch_deadline = Deadline(deadline)
+        futures = {executor.submit(price_finder.search_products, query=query, deadline=batch_deadline): key
+                   for key, query in unique.items()}
+        done, _ = wait(futures, timeout=deadline)
+        executor.shutdown(wait=False, cancel_futures=True)
+        for future, key in futures.items():
+            if future not in done:
+                outcomes[key] = {'success': False, 'error': 'Tiempo del lote agotado'}
+                continue
+            try:
+                products = future.result()
+                outcomes[key] = {'success': True, 'products': products, 'total': len(products)}
+            except Exception as e:
+                print(f"Batch search error: {e}")
+                outcomes[key] = {'success': False, 'error': 'Error en la búsqueda'}
+    
+    results = []
+    for raw_query, key in zip(queries, keys):
+        outcome = outcomes.get(key) if key else {'success': False, 'error': 'Consulta inválida'}
+        results.append({'query': raw_query, **outcome})
+    
+    return json_response({
+        'success': True,
+        'results': results,
+        'total': len(results),
+        'unique_queries': len(unique),
+        'timed_out': sum(1 for outcome in outcomes.values() if outcome.get('error') == 'Tiempo del lote agotado')
+    })
+
+@app.route('/api/price-history')
+@login_required
+def api_price_history():
+    """Estadísticas de precio históricas: ?q=consulta&days=30&store=amazon"""
+    if not price_history:
+        return jsonify({'success': False, 'error': 'Historial de precios desactivado'}), 503
+    query = request.args.get('q', '').strip()[:80]
+    if len(query) < 2:
+        return jsonify({'success': False, 'error': 'Consulta inválida'}), 400
+    try:
+        days = max(0.01, min(float(request.args.get('days', 30)), 365))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Parámetro days inválido'}), 400
+    store = request.args.get('store', '').strip() or None
+    try:
+        since = time.time() - days * 86400
+        summary = price_history.summary(normalize_query_key(query), since, store=store)
+        return jsonify({'success': True, 'query': query, 'days': days, 'store': store, 'stats': summary})
+    except sqlite3.Error as e:
+        print(f"Price history error: {e}")
+        return jsonify({'success': False, 'error': 'Error consultando historial'}), 500
+
 @app.route('/results')
 @login_required
 def results_page():
     try:
-        if 'last_search' not in session:
+        # Por ID en la URL (enlace compartible) o la última búsqueda de la sesión
+        search_id = request.args.get('id') or session.get('last_search_id')
+        search_data = search_results.get(search_id) if search_id else None
+        if not search_data:
             flash('No hay busquedas recientes.', 'warning')
             return redirect(url_for('search_page'))
         
         current_user = firebase_auth.get_current_user()
         user_name = current_user['user_name'] if current_user else 'Usuario'
-        user_name_escaped = html.escape(user_name)
         
-        search_data = session['last_search']
-        products = search_data.get('products', [])
-        query = html.escape(str(search_data.get('query', 'busqueda')))
+        products = search_data.get('products', [])[:6]
         search_type = search_data.get('search_type', 'texto')
+        search_type_text = {"texto": "texto", "imagen": "imagen IA", "texto+imagen": "texto + imagen IA", "combined": "búsqueda mixta"}.get(search_type, search_type)
         
-        products_html = ""
-        badges = ['MEJOR', '2do', '3ro']
-        colors = ['#4caf50', '#ff9800', '#9c27b0']
-        
-        for i, product in enumerate(products[:6]):
-            if not product:
-                continue
-            
-            badge = '<div style="position: absolute; top: 8px; right: 8px; background: ' + colors[min(i, 2)] + '; color: white; padding: 4px 8px; border-radius: 12px; font-size: 11px; font-weight: bold;">' + badges[min(i, 2)] + '</div>' if i < 3 else ''
-            
-            # Badge de fuente de búsqueda
-            search_source_badge = ''
-            source = product.get('search_source', '')
-            if source == 'image':
-                search_source_badge = '<div style="position: absolute; top: 8px; left: 8px; background: #673ab7; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">📷 IMAGEN</div>'
-            elif source == 'combined':
-                search_source_badge = '<div style="position: absolute; top: 8px; left: 8px; background: #607d8b; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">🔗 MIXTO</div>'
-            
-            title = html.escape(str(product.get('title', 'Producto')))
-            price = html.escape(str(product.get('price', '$0.00')))
-            source_store = html.escape(str(product.get('source', 'Tienda')))
-            link = html.escape(str(product.get('link', '#')))
-            
-            products_html += '''
-                <div style="border: 1px solid #ddd; border-radius: 8px; padding: 15px; margin-bottom: 15px; background: white; position: relative; box-shadow: 0 2px 4px rgba(0,0,0,0.08);">
-                    ''' + badge + '''
-                    ''' + search_source_badge + '''
-                    <h3 style="color: #1a73e8; margin-bottom: 8px; font-size: 16px; margin-top: ''' + ('20px' if search_source_badge else '0') + ';">''' + title + '''</h3>
-                    <div style="font-size: 28px; color: #2e7d32; font-weight: bold; margin: 12px 0;">''' + price + ''' <span style="font-size: 12px; color: #666;">USD</span></div>
-                    <p style="color: #666; margin-bottom: 12px; font-size: 14px;">Tienda: ''' + source_store + '''</p>
-                    <a href="''' + link + '''" target="_blank" rel="noopener noreferrer" style="background: #1a73e8; color: white; padding: 10px 16px; text-decoration: none; border-radius: 6px; font-weight: 600; display: inline-block; font-size: 14px;">Ver Producto</a>
-                </div>'''
-        
-        prices = [p.get('price_numeric', 0) for p in products if p.get('price_numeric', 0) > 0]
-        stats = ""
-        if prices:
-            min_price = min(prices)
-            avg_price = sum(prices) / len(prices)
-            search_type_text = {"texto": "texto", "imagen": "imagen IA", "texto+imagen": "texto + imagen IA", "combined": "búsqueda mixta"}.get(search_type, search_type)
-            stats = '''
-                <div style="background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 8px; margin-bottom: 20px;">
-                    <h3 style="color: #2e7d32; margin-bottom: 8px;">Resultados de búsqueda (''' + search_type_text + ''')</h3>
-                    <p><strong>''' + str(len(products)) + ''' productos encontrados</strong></p>
-                    <p><strong>Mejor precio: $''' + f'{min_price:.2f}' + '''</strong></p>
-                    <p><strong>Precio promedio: $''' + f'{avg_price:.2f}' + '''</strong></p>
-                </div>'''
-        
-        content = '''
-        <div style="max-width: 800px; margin: 0 auto;">
-            <div style="background: rgba(255,255,255,0.15); padding: 12px; border-radius: 8px; margin-bottom: 15px; text-align: center; display: flex; align-items: center; justify-content: center;">
-                <span style="color: white; font-size: 14px;"><strong>''' + user_name_escaped + '''</strong></span>
-                <div style="margin-left: 15px;">
-                    <a href="''' + url_for('auth_logout') + '''" style="background: rgba(220,53,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
-                    <a href="''' + url_for('search_page') + '''" style="background: rgba(40,167,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Nueva Busqueda</a>
-                </div>
-            </div>
-            
-            <h1 style="color: white; text-align: center; margin-bottom: 8px;">Resultados: "''' + query + '''"</h1>
-            <p style="text-align: center; color: rgba(255,255,255,0.9); margin-bottom: 25px;">Busqueda completada</p>
-            
-            ''' + stats + '''
-            ''' + products_html + '''
-        </div>'''
-        
-        return render_template_string(render_page('Resultados - Price Finder USA', content))
+        return render_page(
+            'results.html',
+            user_name=user_name,
+            query=str(search_data.get('query', 'busqueda')),
+            products=products,
+            stats=compute_price_stats(products),
+            search_type_text=search_type_text,
+            badges=['MEJOR', '2do', '3ro'],
+            badge_colors=['#4caf50', '#ff9800', '#9c27b0']
+        )
     except Exception as e:
         print(f"Results page error: {e}")
         flash('Error al mostrar resultados.', 'danger')
@@ -903,38 +3640,84 @@ def results_page():
 @app.route('/api/health')
 def health_check():
     try:
+        breakers = {'serpapi': price_finder.breaker.stats(), 'gemini': gemini_breaker.stats()}
+        # DEGRADED: la app responde (ejemplos / solo texto) pero algún servicio externo está caído
+        degraded = any(stats['state'] != CircuitBreaker.CLOSED for stats in breakers.values())
         return jsonify({
-            'status': 'OK', 
+            'status': 'DEGRADED' if degraded else 'OK',
+            'circuit_breakers': breakers,
             'timestamp': datetime.now().isoformat(),
             'firebase_auth': 'enabled' if firebase_auth.firebase_web_api_key else 'disabled',
             'serpapi': 'enabled' if price_finder.is_api_configured() else 'disabled',
             'gemini_vision': 'enabled' if GEMINI_READY else 'disabled',
-            'pil_available': 'enabled' if PIL_AVAILABLE else 'disabled'
+            'pil_available': 'enabled' if PIL_AVAILABLE else 'disabled',
+            'search_cache': price_finder.cache.stats(),
+            'query_canonicalizer': query_canonicalizer.stats(),
+            'search_inflight': price_finder.inflight.stats(),
+            'cache_warmer': price_finder.warmer.stats(),
+            'query_popularity': price_finder.popular.stats(),
+            'serpapi_rate_limit': price_finder.rate_limiter.stats(),
+            'image_query_cache': image_query_cache.stats(),
+            'result_store': search_results.stats(),
+            'price_history': price_history.stats() if price_history else 'disabled',
+            'firebase_token_verifier': firebase_auth.token_verifier.stats(),
+            'lazy_modules': {name: lazy.stats() for name, lazy in (('pil', Image), ('gemini', genai), ('numpy', np)) if lazy is not None}
         })
     except Exception as e:
         return jsonify({'status': 'ERROR', 'message': str(e)}), 500
 
+metrics.gauge('pricefinder_cache_hit_ratio', 'Proporción de aciertos por cache (incluye entradas vencidas servidas)', ('cache',),
+              lambda: {('search',): price_finder.cache.stats()['hit_rate'], ('image_query',): image_query_cache.stats()['hit_rate']})
+metrics.gauge('pricefinder_circuit_state', 'Estado del circuit breaker (0 closed, 1 half_open, 2 open)', ('upstream',),
+              lambda: {(name,): {'closed': 0, 'half_open': 1, 'open': 2}[breaker.stats()['state']]
+                       for name, breaker in (('serpapi', price_finder.breaker), ('gemini', gemini_breaker))})
+metrics.gauge('pricefinder_upstream_timeout_seconds', 'Timeout adaptativo vigente por servicio externo', ('upstream',),
+              lambda: {('serpapi',): price_finder.breaker.timeout(), ('gemini',): gemini_breaker.timeout()})
+metrics.gauge('pricefinder_cache_entries', 'Entradas por cache', ('cache',),
+              lambda: {('search',): price_finder.cache.stats()['size'], ('result_store',): search_results.stats()['size']})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Métricas del proceso en formato Prometheus; METRICS_TOKEN exige Authorization: Bearer <token>"""
+    token = os.environ.get('METRICS_TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Middleware
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
 @app.before_request
 def before_request():
+    # Rutas exentas y clientes con ID token (sin estado): sin trabajo de sesión
+    if request.path in ActivitySessionInterface.exempt_paths or firebase_auth.get_bearer_token():
+        return
+    
+    now = int(time.time())
     if 'timestamp' in session:
-        try:
-            timestamp_str = session['timestamp']
-            if isinstance(timestamp_str, str) and len(timestamp_str) > 10:
-                last_activity = datetime.fromisoformat(timestamp_str)
-                time_diff = (datetime.now() - last_activity).total_seconds()
-                if time_diff > 1200:  # 20 minutos
-                    session.clear()
-        except:
+        # Cookie anterior con marca ISO: migrar a epoch
+        session['last_seen'] = session_epoch(session.pop('timestamp'))
+    
+    last_seen = session.get('last_seen')
+    if last_seen is not None:
+        if not isinstance(last_seen, int) or now - last_seen > SESSION_IDLE_TIMEOUT:
             session.clear()
+            last_seen = None
     
-    session['timestamp'] = datetime.now().isoformat()
+    # Ventana deslizante: solo se reescribe la cookie cada SESSION_TOUCH_INTERVAL segundos
+    if last_seen is None or now - last_seen >= SESSION_TOUCH_INTERVAL:
+        session['last_seen'] = now
 
 @app.after_request
 def after_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, request.endpoint or 'unknown', request.method, str(response.status_code))
     response.headers['X-Content-Type-Options'] = 'nosniff'
     response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    response.headers.setdefault('Cache-Control', 'no-cache, no-store, must-revalidate')
     return response
 
 # Error handlers
@@ -942,6 +3725,12 @@ def after_request(response):
 def not_found(error):
     return '<h1>404 - Pagina no encontrada</h1><p><a href="/">Volver al inicio</a></p>', 404
 
+@app.errorhandler(413)
+def request_too_large(error):
+    if request.path.startswith('/api/'):
+        return jsonify({'success': False, 'error': 'La petición es demasiado grande'}), 413
+    return '<h1>413 - Archivo demasiado grande</h1><p><a href="/">Volver al inicio</a></p>', 413
+
 @app.errorhandler(500)
 def internal_error(error):
     return '<h1>500 - Error interno</h1><p><a href="/">Volver al inicio</a></p>', 500